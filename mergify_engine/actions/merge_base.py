@@ -148,9 +148,11 @@ class MergeBaseAction(actions.Action):
     ) -> actions.EvaluatedActionRule:
         missing_conditions = []
         conditions = await self._get_branch_protection_conditions(ctxt)
+        memo = rules.get_evaluation_memo(ctxt)
         for condition in conditions:
-            if not await condition(ctxt.pull_request):
+            if not await condition(ctxt.pull_request, memo):
                 missing_conditions.append(condition)
+        memo.update_context_data(ctxt)
 
         ear = actions.EvaluatedActionRule(
             "due to branch protection",
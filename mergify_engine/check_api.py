@@ -28,6 +28,26 @@ if typing.TYPE_CHECKING:
 # e.g.: we want the engine to be retriggered if the state of this kind of checks changes.
 USER_CREATED_CHECKS = "user-created-checkrun"
 
+# NOTE(sileht): the check runs fields used by the engine, the others are
+# dropped when listing check runs
+CHECK_RUN_FIELDS = (
+    "id",
+    "app.id",
+    "app.name",
+    "app.owner.avatar_url",
+    "external_id",
+    "head_sha",
+    "check_suite.id",
+    "name",
+    "status",
+    "output",
+    "conclusion",
+    "started_at",
+    "completed_at",
+    "details_url",
+    "html_url",
+)
+
 
 class GitHubCheckRunOutputParameters(typing.TypedDict, total=False):
     title: str
@@ -87,6 +107,7 @@ async def get_checks_for_ref(
         async for check in ctxt.client.items(
             f"{ctxt.base_url}/commits/{sha}/check-runs",
             list_items="check_runs",
+            fields=CHECK_RUN_FIELDS,
             **kwargs,
         )
     ]
@@ -13,27 +13,57 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import asyncio
+import base64
+import collections
 import contextlib
+import contextvars
 import dataclasses
 import datetime
 import functools
+import hashlib
+import json
+import time
 import typing
 from urllib import parse
+import uuid
+import zlib
 
+import cachetools
 import daiquiri
 from datadog import statsd
 import httpx
 
 from mergify_engine import config
+from mergify_engine import crypto
 from mergify_engine import exceptions
 from mergify_engine import github_types
+from mergify_engine import json as mergify_json
+from mergify_engine import utils
 from mergify_engine.clients import github_app
 from mergify_engine.clients import http
+from mergify_engine.clients import profiler
 
 
 RATE_LIMIT_THRESHOLD = 20
+# NOTE(sileht): below this amount of remaining requests, low priority work is
+# deferred to keep the budget for merges and queue operations
+RATE_LIMIT_LOW_PRIORITY_THRESHOLD = 1000
 LOGGING_REQUESTS_THRESHOLD = 20
 LOGGING_REQUESTS_THRESHOLD_ABSOLUTE = 400
+HTTP_CACHE_EXPIRATION = 3600  # 1 hour
+ITEMS_PREFETCH_MAX_PAGES = 5
+# NOTE(sileht): one concurrent page for this amount of remaining requests
+ITEMS_PREFETCH_RATE_LIMIT_RATIO = 100
+# NOTE(sileht): the headers needed to replay a response body on 304
+HTTP_CACHE_REPLAYED_HEADERS = ("content-type", "link")
+CACHED_TOKEN_MAX_SIZE = 1000
+# NOTE(sileht): tokens are renewed a bit before GitHub expires them, so a
+# request never starts with a token that expires in the middle of it
+ACCESS_TOKEN_EXPIRATION_MARGIN = datetime.timedelta(minutes=5)
+ACCESS_TOKEN_LOCK_EXPIRATION = 10  # seconds
+ACCESS_TOKEN_LOCK_POLL_INTERVAL = 0.1  # seconds
+INSTALLATION_CACHE_EXPIRATION = 600  # 10 minutes
 
 LOG = daiquiri.getLogger(__name__)
 
@@ -44,14 +74,19 @@ class TooManyPages(Exception):
     response: httpx.Response
 
 
+@dataclasses.dataclass
+class GraphQLError(Exception):
+    errors: typing.List[typing.Dict[str, typing.Any]]
+
+
 @dataclasses.dataclass
 class CachedToken:
     STORAGE: typing.ClassVar[
-        typing.Dict[github_types.GitHubInstallationIdType, "CachedToken"]
-    ] = {}
+        typing.MutableMapping[github_types.GitHubInstallationIdType, "CachedToken"]
+    ] = cachetools.LRUCache(maxsize=CACHED_TOKEN_MAX_SIZE)
 
     installation_id: github_types.GitHubInstallationIdType
-    token: github_types.GitHubInstallationAccessToken
+    token: str
     expiration: datetime.datetime
 
     def __post_init__(self):
@@ -66,6 +101,123 @@ class CachedToken:
     def invalidate(self):
         CachedToken.STORAGE.pop(self.installation_id, None)
 
+    def is_expired(self) -> bool:
+        return (
+            self.expiration - ACCESS_TOKEN_EXPIRATION_MARGIN
+            <= datetime.datetime.utcnow()
+        )
+
+    @staticmethod
+    def _get_redis_key(installation_id: github_types.GitHubInstallationIdType) -> str:
+        return f"installation-token~{installation_id}"
+
+    @staticmethod
+    def _get_redis_lock_key(
+        installation_id: github_types.GitHubInstallationIdType,
+    ) -> str:
+        return f"installation-token-lock~{installation_id}"
+
+    @classmethod
+    async def get_from_redis(
+        cls,
+        redis: utils.RedisCache,
+        installation_id: github_types.GitHubInstallationIdType,
+    ) -> typing.Optional["CachedToken"]:
+        encrypted = await redis.get(cls._get_redis_key(installation_id))
+        if encrypted is None:
+            return None
+        try:
+            data = json.loads(crypto.decrypt(encrypted.encode()).decode())
+        except crypto.CryptoError:
+            LOG.warning(
+                "fail to decrypt cached installation token",
+                installation_id=installation_id,
+            )
+            return None
+        token = cls(
+            installation_id,
+            data["token"],
+            datetime.datetime.fromisoformat(data["expiration"]),
+        )
+        if token.is_expired():
+            token.invalidate()
+            return None
+        return token
+
+    async def save_to_redis(self, redis: utils.RedisCache) -> None:
+        ttl = (
+            self.expiration
+            - ACCESS_TOKEN_EXPIRATION_MARGIN
+            - datetime.datetime.utcnow()
+        )
+        if ttl.total_seconds() < 1:
+            return
+        data = {"token": self.token, "expiration": self.expiration.isoformat()}
+        await redis.set(
+            self._get_redis_key(self.installation_id),
+            crypto.encrypt(json.dumps(data).encode()).decode(),
+            ex=int(ttl.total_seconds()),
+        )
+
+    @classmethod
+    async def lock(
+        cls,
+        redis: utils.RedisCache,
+        installation_id: github_types.GitHubInstallationIdType,
+    ) -> typing.Optional[str]:
+        """Take the lock to create the token of an installation.
+
+        :return: the token needed to release the lock, None if it's already taken.
+        """
+        lock_token = uuid.uuid4().hex
+        if await redis.set(
+            cls._get_redis_lock_key(installation_id),
+            lock_token,
+            nx=True,
+            ex=ACCESS_TOKEN_LOCK_EXPIRATION,
+        ):
+            return lock_token
+        return None
+
+    UNLOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+    @classmethod
+    async def unlock(
+        cls,
+        redis: utils.RedisCache,
+        installation_id: github_types.GitHubInstallationIdType,
+        lock_token: str,
+    ) -> None:
+        # NOTE(sileht): if we took longer than the lock expiration, another
+        # process may own it now, so it's only deleted if it's still ours
+        await redis.eval(
+            cls.UNLOCK_SCRIPT, 1, cls._get_redis_lock_key(installation_id), lock_token
+        )
+
+    @classmethod
+    async def wait_from_redis(
+        cls,
+        redis: utils.RedisCache,
+        installation_id: github_types.GitHubInstallationIdType,
+    ) -> typing.Optional["CachedToken"]:
+        """Wait for the token another process is creating."""
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=ACCESS_TOKEN_LOCK_EXPIRATION
+        )
+        while datetime.datetime.utcnow() < deadline:
+            token = await cls.get_from_redis(redis, installation_id)
+            if token is not None:
+                return token
+            if not await redis.exists(cls._get_redis_lock_key(installation_id)):
+                return None
+            await asyncio.sleep(ACCESS_TOKEN_LOCK_POLL_INTERVAL)
+        return None
+
 
 class GithubActionAccessTokenAuth(httpx.Auth):
     owner_id: github_types.GitHubAccountIdType
@@ -145,11 +297,13 @@ class GithubAppInstallationAuth(httpx.Auth):
         self,
         owner_name: typing.Optional[github_types.GitHubLogin] = None,
         owner_id: typing.Optional[github_types.GitHubAccountIdType] = None,
+        redis_cache: typing.Optional[utils.RedisCache] = None,
     ) -> None:
         self.owner = owner_name
         self.owner_id = owner_id
 
-        self._cached_token = None
+        self._cached_token: typing.Optional[CachedToken] = None
+        self._redis_cache = redis_cache
         self.installation = None
         self.permissions_need_to_be_updated = None
 
@@ -165,30 +319,39 @@ class GithubAppInstallationAuth(httpx.Auth):
         self, request: httpx.Request
     ) -> typing.Generator[httpx.Request, httpx.Response, None]:
         if self.installation is None:
-            with self.response_body_read():
-                installation_response = yield self.build_installation_request()
-                if installation_response.status_code == 401:  # due to jwt
-                    installation_response = yield self.build_installation_request(
-                        force=True
-                    )
-                if installation_response.is_redirect:
-                    installation_response = yield self.build_installation_request(
-                        url=installation_response.headers["Location"],
-                    )
+            yield from self._installation_flow()
+        yield from self._access_token_flow(request)
 
-                if installation_response.status_code == 404:
-                    LOG.debug(
-                        "Mergify not installed",
-                        gh_owner=self.owner,
-                        gh_owner_id=self.owner_id,
-                        error_message=installation_response.json()["message"],
-                    )
-                    raise exceptions.MergifyNotInstalled()
+    def _installation_flow(
+        self,
+    ) -> typing.Generator[httpx.Request, httpx.Response, None]:
+        with self.response_body_read():
+            installation_response = yield self.build_installation_request()
+            if installation_response.status_code == 401:  # due to jwt
+                installation_response = yield self.build_installation_request(
+                    force=True
+                )
+            if installation_response.is_redirect:
+                installation_response = yield self.build_installation_request(
+                    url=installation_response.headers["Location"],
+                )
 
-                http.raise_for_status(installation_response)
+            if installation_response.status_code == 404:
+                LOG.debug(
+                    "Mergify not installed",
+                    gh_owner=self.owner,
+                    gh_owner_id=self.owner_id,
+                    error_message=installation_response.json()["message"],
+                )
+                raise exceptions.MergifyNotInstalled()
 
-                self._set_installation(installation_response)
+            http.raise_for_status(installation_response)
 
+            self._set_installation(installation_response.json())
+
+    def _access_token_flow(
+        self, request: httpx.Request
+    ) -> typing.Generator[httpx.Request, httpx.Response, None]:
         token = self._get_access_token()
         if token:
             request.headers["Authorization"] = f"token {token}"
@@ -219,6 +382,124 @@ class GithubAppInstallationAuth(httpx.Auth):
         request.headers["Authorization"] = f"token {token}"
         yield request
 
+    async def async_auth_flow(
+        self, request: httpx.Request
+    ) -> typing.AsyncGenerator[httpx.Request, httpx.Response]:
+        # NOTE(sileht): same as auth_flow(), but the installation and its token
+        # are first looked up in Redis, where all processes share them
+        redis = self._redis_cache
+        installation_cache_key = self._get_installation_cache_key()
+        installation_from_cache = (
+            redis is not None
+            and self.installation is None
+            and await self._load_installation(redis, installation_cache_key)
+        )
+
+        while True:
+            if self.installation is None:
+                flow = self._installation_flow()
+                next_request = next(flow)
+                while True:
+                    response = yield next_request
+                    await response.aread()
+                    try:
+                        next_request = flow.send(response)
+                    except StopIteration:
+                        break
+                if redis is not None:
+                    await redis.set(
+                        installation_cache_key,
+                        json.dumps(self.installation),
+                        ex=INSTALLATION_CACHE_EXPIRATION,
+                    )
+
+            locked_installation_id = None
+            lock_token = None
+            if redis is not None and self._get_access_token() is None:
+                lock_token = await self._load_access_token(
+                    redis, self.installation["id"]  # type: ignore[index]
+                )
+                if lock_token is not None:
+                    locked_installation_id = self.installation["id"]  # type: ignore[index]
+            token = self._cached_token
+
+            try:
+                flow = self._access_token_flow(request)
+                next_request = next(flow)
+                while True:
+                    response = yield next_request
+                    # NOTE(sileht): requires_response_body is shared by the
+                    # concurrent flows of this auth, so it can't be trusted here
+                    if next_request is not request:
+                        await response.aread()
+                    try:
+                        next_request = flow.send(response)
+                    except StopIteration:
+                        break
+
+                if (
+                    redis is not None
+                    and self._cached_token is not None
+                    and self._cached_token is not token
+                ):
+                    await self._cached_token.save_to_redis(redis)
+            except exceptions.MergifyNotInstalled:
+                if not installation_from_cache:
+                    raise
+                # NOTE(sileht): the cached installation may have been removed
+                # and the app installed again, retry with a fresh one
+                await redis.delete(installation_cache_key)  # type: ignore[union-attr]
+                self.installation = None
+                self._cached_token = None
+                installation_from_cache = False
+                continue
+            finally:
+                if lock_token is not None:
+                    await CachedToken.unlock(redis, locked_installation_id, lock_token)  # type: ignore[arg-type]
+            return
+
+    def _get_installation_cache_key(self) -> str:
+        if self.owner_id:
+            return f"installation~{self.owner_id}"
+        else:
+            return f"installation~{self.owner}"
+
+    async def _load_installation(
+        self, redis: utils.RedisCache, installation_cache_key: str
+    ) -> bool:
+        installation = await redis.get(installation_cache_key)
+        if installation is None:
+            return False
+        self._set_installation(json.loads(installation))
+        return True
+
+    async def _load_access_token(
+        self,
+        redis: utils.RedisCache,
+        installation_id: github_types.GitHubInstallationIdType,
+    ) -> typing.Optional[str]:
+        """Load the installation token shared by all processes.
+
+        :return: the lock token if the token is missing and this process is in
+        charge of creating it.
+        """
+        self._cached_token = await CachedToken.get_from_redis(redis, installation_id)
+        if self._cached_token is not None:
+            return None
+
+        # NOTE(sileht): only one process creates the token of an installation,
+        # the others wait for it
+        lock_token = await CachedToken.lock(redis, installation_id)
+        if lock_token is not None:
+            self._cached_token = await CachedToken.get_from_redis(
+                redis, installation_id
+            )
+            return lock_token
+
+        statsd.increment("http.client.installation_token.wait")
+        self._cached_token = await CachedToken.wait_from_redis(redis, installation_id)
+        return None
+
     def build_installation_request(self, url=None, force=False):
         if url is None:
             if self.owner_id:
@@ -239,10 +520,8 @@ class GithubAppInstallationAuth(httpx.Auth):
         headers["Authorization"] = f"Bearer {github_app.get_or_create_jwt(force)}"
         return httpx.Request(method, url, headers=headers)
 
-    def _set_installation(self, installation_response):
-        self.installation: github_types.GitHubInstallation = (
-            installation_response.json()
-        )
+    def _set_installation(self, installation: github_types.GitHubInstallation) -> None:
+        self.installation = installation
         self.owner_id = self.installation["account"]["id"]
         self.owner = self.installation["account"]["login"]
         self.permissions_need_to_be_updated = github_app.permissions_need_to_be_updated(
@@ -264,10 +543,9 @@ class GithubAppInstallationAuth(httpx.Auth):
         return self._cached_token.token
 
     def _get_access_token(self):
-        now = datetime.datetime.utcnow()
         if not self._cached_token:
             return None
-        elif self._cached_token.expiration <= now:
+        elif self._cached_token.is_expired():
             LOG.info(
                 "Token expired",
                 gh_owner=self.owner,
@@ -294,11 +572,14 @@ _T_get_auth = typing.Union[GithubAppInstallationAuth, GithubActionAccessTokenAut
 def get_auth(
     owner_name: typing.Optional[github_types.GitHubLogin] = None,
     owner_id: typing.Optional[github_types.GitHubAccountIdType] = None,
+    redis_cache: typing.Optional[utils.RedisCache] = None,
 ) -> _T_get_auth:
     if config.GITHUB_APP:
         if owner_name is None and owner_id is None:
             raise ValueError("No owner provided")
-        return GithubAppInstallationAuth(owner_name=owner_name, owner_id=owner_id)
+        return GithubAppInstallationAuth(
+            owner_name=owner_name, owner_id=owner_id, redis_cache=redis_cache
+        )
     else:
         return GithubActionAccessTokenAuth()
 
@@ -328,17 +609,42 @@ def _check_rate_limit(response: httpx.Response) -> None:
         raise exceptions.RateLimited(delta, remaining)
 
 
+LOW_PRIORITY: "contextvars.ContextVar[bool]" = contextvars.ContextVar(
+    "github_requests_low_priority", default=False
+)
+
+
+@contextlib.contextmanager
+def low_priority() -> typing.Iterator[None]:
+    """Mark the GitHub requests done in this block as deferrable.
+
+    They raise RateLimitBudgetExhausted as soon as the installation budget goes below
+    RATE_LIMIT_LOW_PRIORITY_THRESHOLD.
+    """
+    token = LOW_PRIORITY.set(True)
+    try:
+        yield
+    finally:
+        LOW_PRIORITY.reset(token)
+
+
 class AsyncGithubInstallationClient(http.AsyncClient):
     auth: _T_get_auth
 
-    def __init__(self, auth: _T_get_auth):
-        self._requests: typing.List[typing.Tuple[str, str]] = []
+    def __init__(
+        self,
+        auth: _T_get_auth,
+        redis_cache: typing.Optional[utils.RedisCache] = None,
+    ):
         self._requests_ratio: int = 1
+        self._redis_cache = redis_cache
+        self._inflight_requests: typing.Dict[str, "asyncio.Task[httpx.Response]"] = {}
         super().__init__(
             base_url=config.GITHUB_API_URL,
             auth=auth,
-            **http.DEFAULT_CLIENT_OPTIONS,  # type: ignore
+            **http.DEFAULT_CLIENT_OPTIONS,
         )
+        self.profile = profiler.RequestsProfile(self.base_url.host)
 
         for method in ("get", "post", "put", "patch", "delete", "head"):
             setattr(self, method, self._inject_options(getattr(self, method)))
@@ -366,40 +672,345 @@ class AsyncGithubInstallationClient(http.AsyncClient):
         )
         return response.json()
 
+    async def graphql(self, query: str, **variables: typing.Any) -> typing.Any:
+        response = await self.post(
+            "/graphql", json={"query": query, "variables": variables}
+        )
+        data = response.json()
+        if data.get("errors"):
+            raise GraphQLError(data["errors"])
+        return data["data"]
+
+    @staticmethod
+    def _get_last_page(response: httpx.Response) -> typing.Optional[int]:
+        last_url = response.links.get("last", {}).get("url")
+        if not last_url:
+            return None
+        last_page = int(parse.parse_qs(parse.urlparse(last_url).query)["page"][0])
+        if last_page > 100:
+            raise TooManyPages(last_page, response)
+        return last_page
+
+    @staticmethod
+    def _get_page_url(next_url: str, page: int) -> str:
+        parsed = parse.urlparse(next_url)
+        query = parse.parse_qs(parsed.query)
+        query["page"] = [str(page)]
+        return parse.urlunparse(parsed._replace(query=parse.urlencode(query, True)))
+
+    @staticmethod
+    def _get_prefetch_pages(response: httpx.Response) -> int:
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        if remaining is None:
+            return ITEMS_PREFETCH_MAX_PAGES
+        return max(
+            1,
+            min(
+                ITEMS_PREFETCH_MAX_PAGES,
+                int(remaining) // ITEMS_PREFETCH_RATE_LIMIT_RATIO,
+            ),
+        )
+
     async def items(
-        self, url, api_version=None, oauth_token=None, list_items=None, **params
+        self,
+        url,
+        api_version=None,
+        oauth_token=None,
+        list_items=None,
+        fields=None,
+        **params,
     ):
-        while True:
-            response = await self.get(
-                url, api_version=api_version, oauth_token=oauth_token, params=params
-            )
-            last_url = response.links.get("last", {}).get("url")
-            if last_url:
-                last_page = int(
-                    parse.parse_qs(parse.urlparse(last_url).query).get("page")[0]
-                )
-                if last_page > 100:
-                    raise TooManyPages(last_page, response)
+        """Iterate over the items of all the pages of a listing.
 
+        When `fields` is set, only these dotted field paths of the items are
+        kept, e.g.: ("number", "head.sha").
+        """
+        if fields is not None:
+            fields_tree = mergify_json.get_fields_tree(fields)
+
+        def get_items(response):
             items = response.json()
             if list_items:
                 items = items[list_items]
-            for item in items:
-                yield item
-            if "next" in response.links:
-                url = response.links["next"]["url"]
-                params = None
-            else:
-                break
+            if fields is not None:
+                # NOTE(sileht): each page is decoded at once, json.loads is
+                # faster than any decoding done item by item in Python
+                items = [mergify_json.project(item, fields_tree) for item in items]
+            return items
+
+        response = await self.get(
+            url, api_version=api_version, oauth_token=oauth_token, params=params
+        )
+        last_page = self._get_last_page(response)
+        for item in get_items(response):
+            yield item
+
+        if "next" not in response.links:
+            return
+
+        next_url = response.links["next"]["url"]
+        next_page = parse.parse_qs(parse.urlparse(next_url).query).get("page")
+        if last_page is None or next_page is None:
+            # NOTE(sileht): without page numbers, we can only walk pages one by one
+            while True:
+                response = await self.get(
+                    next_url, api_version=api_version, oauth_token=oauth_token
+                )
+                for item in get_items(response):
+                    yield item
+                if "next" not in response.links:
+                    return
+                next_url = response.links["next"]["url"]
+
+        # NOTE(sileht): the remaining pages are known, fetch them concurrently but
+        # yield their items in order
+        pages = collections.deque(
+            self._get_page_url(next_url, page)
+            for page in range(int(next_page[0]), last_page + 1)
+        )
+        pending: typing.Deque[asyncio.Task[httpx.Response]] = collections.deque()
+        prefetch_pages = self._get_prefetch_pages(response)
+        try:
+            while pages or pending:
+                while pages and len(pending) < prefetch_pages:
+                    pending.append(
+                        asyncio.create_task(
+                            self.get(
+                                pages.popleft(),
+                                api_version=api_version,
+                                oauth_token=oauth_token,
+                            )
+                        )
+                    )
+                response = await pending.popleft()
+                prefetch_pages = self._get_prefetch_pages(response)
+                for item in get_items(response):
+                    yield item
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def _get_http_cache_key(
+        self, method: str, url: str, kwargs: typing.Dict[str, typing.Any]
+    ) -> typing.Optional[str]:
+        # NOTE(sileht): requests done with a user token are not cached, the body
+        # may depend on the user permissions
+        if (
+            method != "GET"
+            or self._redis_cache is None
+            or self.auth.owner is None
+            or isinstance(kwargs.get("auth"), GithubTokenAuth)
+        ):
+            return None
+        return f"http-cache~{self.auth.owner}~{self._get_request_digest(url, kwargs)}"
+
+    @staticmethod
+    def _get_request_digest(url: str, kwargs: typing.Dict[str, typing.Any]) -> str:
+        params = kwargs.get("params") or {}
+        accept = kwargs.get("headers", {}).get(
+            "Accept", http.DEFAULT_CLIENT_OPTIONS["headers"]["Accept"]  # type: ignore[index]
+        )
+        return hashlib.sha256(
+            f"{url}|{sorted(params.items())}|{accept}".encode()
+        ).hexdigest()
+
+    async def _get_http_cache(
+        self, cache_key: str, kwargs: typing.Dict[str, typing.Any]
+    ) -> typing.Dict[str, str]:
+        cached: typing.Dict[str, str] = await self._redis_cache.hgetall(cache_key)  # type: ignore[union-attr]
+        if cached:
+            headers = kwargs["headers"] = kwargs.get("headers", {}).copy()
+            if "etag" in cached:
+                headers["If-None-Match"] = cached["etag"]
+            if "last-modified" in cached:
+                headers["If-Modified-Since"] = cached["last-modified"]
+        return cached
+
+    async def _update_http_cache(
+        self, cache_key: str, cached: typing.Dict[str, str], reply: httpx.Response
+    ) -> httpx.Response:
+        tags = [f"hostname:{self.base_url.host}"]
+        if reply.status_code == 304 and cached:
+            content = zlib.decompress(base64.b64decode(cached["body"]))
+            headers = httpx.Headers(reply.headers)
+            for name in ("content-encoding", "content-length"):
+                headers.pop(name, None)
+            for name in HTTP_CACHE_REPLAYED_HEADERS:
+                if name in cached:
+                    headers[name] = cached[name]
+            statsd.increment("http.client.cache.hit", tags=tags)
+            statsd.increment("http.client.cache.bytes_saved", len(content), tags=tags)
+            return httpx.Response(
+                200, headers=headers, content=content, request=reply.request
+            )
+
+        statsd.increment("http.client.cache.miss", tags=tags)
+        if reply.status_code == 200 and (
+            "etag" in reply.headers or "last-modified" in reply.headers
+        ):
+            # TODO(sileht): move to msgpack when we remove redis-cache connection
+            # from decode_responses=True (eg: MRGFY-285)
+            entry = {
+                name: reply.headers[name]
+                for name in ("etag", "last-modified") + HTTP_CACHE_REPLAYED_HEADERS
+                if name in reply.headers
+            }
+            entry["body"] = base64.b64encode(zlib.compress(reply.content)).decode()
+            pipe = await self._redis_cache.pipeline()  # type: ignore[union-attr]
+            await pipe.delete(cache_key)
+            await pipe.hmset(cache_key, entry)
+            await pipe.expire(cache_key, HTTP_CACHE_EXPIRATION)
+            await pipe.execute()
+        return reply
+
+    def _get_rate_limit_budget_key(self, resource: str) -> typing.Optional[str]:
+        if self._redis_cache is None or self.auth.owner is None:
+            return None
+        return f"rate-limit-budget~{self.auth.owner}~{resource}"
+
+    async def check_rate_limit_budget(
+        self, low_priority: bool = False, resource: str = "core"
+    ) -> None:
+        """Raise RateLimitBudgetExhausted if the budget of this resource is spent."""
+        budget_key = self._get_rate_limit_budget_key(resource)
+        if budget_key is None:
+            return
+
+        budget = await self._redis_cache.hgetall(budget_key)  # type: ignore[union-attr]
+        if not budget:
+            return
+
+        remaining = int(budget["remaining"])
+        threshold = (
+            RATE_LIMIT_LOW_PRIORITY_THRESHOLD if low_priority else RATE_LIMIT_THRESHOLD
+        )
+        if remaining >= threshold:
+            return
+
+        countdown = (
+            datetime.datetime.utcfromtimestamp(int(budget["reset"]))
+            - datetime.datetime.utcnow()
+        )
+        if countdown <= datetime.timedelta():
+            return
+
+        statsd.increment(
+            "http.client.rate_limit.throttled",
+            tags=[
+                f"hostname:{self.base_url.host}",
+                f"low_priority:{low_priority}",
+                f"resource:{resource}",
+            ],
+        )
+        raise exceptions.RateLimitBudgetExhausted(countdown, remaining)
+
+    async def _update_rate_limit_budget(self, response: httpx.Response) -> None:
+        # NOTE(sileht): REST and GraphQL APIs have their own budget
+        resource = response.headers.get("X-RateLimit-Resource", "core")
+        budget_key = self._get_rate_limit_budget_key(resource)
+        if (
+            budget_key is None
+            or "X-RateLimit-Remaining" not in response.headers
+            or "X-RateLimit-Reset" not in response.headers
+        ):
+            return
+
+        budget = {
+            "remaining": int(response.headers["X-RateLimit-Remaining"]),
+            "limit": int(response.headers.get("X-RateLimit-Limit", 0)),
+            "reset": int(response.headers["X-RateLimit-Reset"]),
+        }
+        # NOTE(sileht): responses may come back out of order, so within the same
+        # window only a lower remaining value is taken into account
+        await self._redis_cache.eval(  # type: ignore[union-attr]
+            self.UPDATE_RATE_LIMIT_BUDGET_SCRIPT,
+            1,
+            budget_key,
+            budget["remaining"],
+            budget["limit"],
+            budget["reset"],
+        )
+
+        # NOTE(sileht): installations are not tagged to not create one serie per
+        # installation, histograms give the distribution of their budgets
+        tags = [f"hostname:{self.base_url.host}", f"resource:{resource}"]
+        statsd.histogram(
+            "http.client.rate_limit.remaining", budget["remaining"], tags=tags
+        )
+        statsd.histogram("http.client.rate_limit.limit", budget["limit"], tags=tags)
+
+    UPDATE_RATE_LIMIT_BUDGET_SCRIPT = """
+local budget_key = KEYS[1]
+local remaining = tonumber(ARGV[1])
+local limit = ARGV[2]
+local reset = tonumber(ARGV[3])
+
+local current = redis.call("HMGET", budget_key, "remaining", "reset")
+if current[1] and tonumber(current[2]) == reset and tonumber(current[1]) <= remaining then
+    return
+end
+redis.call("HSET", budget_key, "remaining", remaining, "limit", limit, "reset", reset)
+redis.call("EXPIREAT", budget_key, reset)
+"""
 
     async def request(self, method, url, *args, **kwargs):
+        # NOTE(sileht): the budget is checked for each caller, as callers sharing
+        # an in-flight request may not have the same priority
+        if not isinstance(kwargs.get("auth"), GithubTokenAuth):
+            await self.check_rate_limit_budget(
+                LOW_PRIORITY.get(),
+                resource="graphql" if url == "/graphql" else "core",
+            )
+
+        # NOTE(sileht): identical GETs sent while one is pending share its
+        # response, requests done with a user token may not see the same thing
+        if method != "GET" or args or isinstance(kwargs.get("auth"), GithubTokenAuth):
+            return await self._request(method, url, *args, **kwargs)
+
+        key = self._get_request_digest(url, kwargs)
+        task = self._inflight_requests.get(key)
+        if task is None:
+            task = asyncio.create_task(self._request(method, url, **kwargs))
+            self._inflight_requests[key] = task
+            task.add_done_callback(functools.partial(self._inflight_request_done, key))
+        else:
+            statsd.increment(
+                "http.client.requests.coalesced",
+                tags=[f"hostname:{self.base_url.host}"],
+            )
+        # NOTE(sileht): a caller being cancelled must not cancel the request
+        # of the others
+        return await asyncio.shield(task)
+
+    def _inflight_request_done(
+        self, key: str, task: "asyncio.Task[httpx.Response]"
+    ) -> None:
+        if self._inflight_requests.get(key) is task:
+            del self._inflight_requests[key]
+        if not task.cancelled():
+            # NOTE(sileht): mark the exception as retrieved, when all callers
+            # have been cancelled nobody will
+            task.exception()
+
+    async def _request(self, method, url, *args, **kwargs):
+        cache_key = self._get_http_cache_key(method, url, kwargs)
+        if cache_key is not None:
+            cached = await self._get_http_cache(cache_key, kwargs)
+
         reply = None
+        error_response = None
+        started_at = time.monotonic()
         try:
             with statsd.timed(
                 "http.client.request.time", tags=[f"hostname:{self.base_url.host}"]
             ):
                 reply = await super().request(method, url, *args, **kwargs)
         except http.HTTPClientSideError as e:
+            error_response = e.response
+            if not isinstance(kwargs.get("auth"), GithubTokenAuth):
+                await self._update_rate_limit_budget(e.response)
             if e.status_code == 403:
                 _check_rate_limit(e.response)
             raise
@@ -412,7 +1023,20 @@ class AsyncGithubInstallationClient(http.AsyncClient):
                 "http.client.requests",
                 tags=[f"hostname:{self.base_url.host}", f"status_code:{status_code}"],
             )
-            self._requests.append((method, url))
+            response = reply or error_response
+            self.profile.record(
+                method,
+                url,
+                kwargs.get("params"),
+                time.monotonic() - started_at,
+                0 if response is None else response.num_bytes_downloaded,
+                reply is None,
+            )
+
+        if not isinstance(kwargs.get("auth"), GithubTokenAuth):
+            await self._update_rate_limit_budget(reply)
+        if cache_key is not None:
+            reply = await self._update_http_cache(cache_key, cached, reply)
         return reply
 
     async def aclose(self):
@@ -423,11 +1047,14 @@ class AsyncGithubInstallationClient(http.AsyncClient):
         await super().__aexit__(exc_type, exc_value, traceback)
         self._generate_metrics()
 
+    def _get_circuit_breaker_tenant(self) -> typing.Optional[str]:
+        return self.auth.owner
+
     def set_requests_ratio(self, ratio: int) -> None:
         self._requests_ratio = ratio
 
     def _generate_metrics(self):
-        nb_requests = len(self._requests)
+        nb_requests = self.profile.nb_requests
         statsd.histogram(
             "http.client.session",
             nb_requests,
@@ -444,17 +1071,20 @@ class AsyncGithubInstallationClient(http.AsyncClient):
                 nb_requests / self._requests_ratio,
                 nb_requests,
                 gh_owner=self.auth.owner,
-                requests=self._requests,
+                requests=self.profile.summary(),
                 requests_ratio=self._requests_ratio,
             )
-        self._requests = []
+        self.profile.reset()
 
 
 def aget_client(
     owner_name: typing.Optional[github_types.GitHubLogin] = None,
     owner_id: typing.Optional[github_types.GitHubAccountIdType] = None,
     auth: typing.Optional[_T_get_auth] = None,
+    redis_cache: typing.Optional[utils.RedisCache] = None,
 ) -> AsyncGithubInstallationClient:
     return AsyncGithubInstallationClient(
-        auth or get_auth(owner_name=owner_name, owner_id=owner_id)
+        auth
+        or get_auth(owner_name=owner_name, owner_id=owner_id, redis_cache=redis_cache),
+        redis_cache=redis_cache,
     )
@@ -15,10 +15,19 @@
 # under the License.
 
 
+import asyncio
+import collections
+import dataclasses
 import datetime
 import json
+import time
+import typing
+from urllib import parse
 
+import cachetools
 import daiquiri
+from datadog import statsd
+import httpcore
 import httpx
 import tenacity
 from werkzeug.http import parse_date
@@ -34,6 +43,18 @@ DEFAULT_CLIENT_OPTIONS = {
     "timeout": httpx.Timeout(5.0, read=10.0),
 }
 
+POOL_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=50)
+# NOTE(sileht): GitHub keeps idle connections opened for a while, reusing them
+# saves the TCP and TLS handshakes of the next client
+POOL_KEEPALIVE_EXPIRY = 60.0
+# NOTE(sileht): a circuit opens when at least half of the requests of the last
+# minute failed, then a single probe is sent every 30 seconds until one succeeds
+CIRCUIT_BREAKER_WINDOW = 60.0
+CIRCUIT_BREAKER_MIN_REQUESTS = 20
+CIRCUIT_BREAKER_FAILURE_RATIO = 0.5
+CIRCUIT_BREAKER_OPEN_DURATION = 30.0
+CIRCUIT_BREAKERS_MAX_SIZE = 10000
+
 HTTPStatusError = httpx.HTTPStatusError
 RequestError = httpx.RequestError
 
@@ -78,6 +99,155 @@ STATUS_CODE_TO_EXC = {
     503: HTTPServiceUnavailable,
 }
 
+CIRCUIT_BREAKER_FAILURES = (RequestError, HTTPServerSideError, HTTPTooManyRequests)
+
+
+@dataclasses.dataclass
+class CircuitOpen(Exception):
+    hostname: str
+    endpoint_class: str
+    countdown: datetime.timedelta
+
+
+CircuitStateT = typing.Literal["closed", "open", "half-open"]
+CIRCUIT_STATES: typing.Dict[CircuitStateT, int] = {
+    "closed": 0,
+    "half-open": 1,
+    "open": 2,
+}
+
+
+@dataclasses.dataclass
+class CircuitBreaker:
+    hostname: str
+    endpoint_class: str
+    tenant: typing.Optional[str] = None
+    state: CircuitStateT = "closed"
+    opened_at: float = 0.0
+    probing: bool = False
+    outcomes: typing.Deque[typing.Tuple[float, bool]] = dataclasses.field(
+        default_factory=collections.deque
+    )
+
+    @property
+    def _tags(self) -> typing.List[str]:
+        return [
+            f"hostname:{self.hostname}",
+            f"endpoint_class:{self.endpoint_class}",
+        ]
+
+    def _set_state(self, state: CircuitStateT) -> None:
+        if state != self.state:
+            LOG.info(
+                "circuit breaker state changed",
+                hostname=self.hostname,
+                endpoint_class=self.endpoint_class,
+                tenant=self.tenant,
+                previous_state=self.state,
+                state=state,
+            )
+            self.state = state
+        statsd.gauge(
+            "http.client.circuit_breaker.state", CIRCUIT_STATES[state], tags=self._tags
+        )
+
+    def before_request(self) -> bool:
+        """Raise CircuitOpen if the request must not be sent.
+
+        Return True if the request is the probe of a half-opened circuit.
+        """
+        if self.state == "closed":
+            return False
+
+        now = time.monotonic()
+        if (
+            self.state == "open"
+            and now - self.opened_at >= CIRCUIT_BREAKER_OPEN_DURATION
+        ):
+            self._set_state("half-open")
+
+        if self.state == "half-open" and not self.probing:
+            self.probing = True
+            return True
+
+        statsd.increment("http.client.circuit_breaker.rejected", tags=self._tags)
+        raise CircuitOpen(
+            self.hostname,
+            self.endpoint_class,
+            datetime.timedelta(
+                seconds=max(0, self.opened_at + CIRCUIT_BREAKER_OPEN_DURATION - now)
+            ),
+        )
+
+    def record(self, failed: bool, probe: bool) -> None:
+        now = time.monotonic()
+        if probe:
+            self.probing = False
+            if failed:
+                self._open(now)
+            else:
+                self.outcomes.clear()
+                self._set_state("closed")
+            return
+
+        self.outcomes.append((now, failed))
+        while self.outcomes and self.outcomes[0][0] < now - CIRCUIT_BREAKER_WINDOW:
+            self.outcomes.popleft()
+
+        if (
+            self.state == "closed"
+            and len(self.outcomes) >= CIRCUIT_BREAKER_MIN_REQUESTS
+            and sum(f for _, f in self.outcomes) / len(self.outcomes)
+            >= CIRCUIT_BREAKER_FAILURE_RATIO
+        ):
+            self._open(now)
+
+    def cancel_probe(self) -> None:
+        self.probing = False
+
+    def _open(self, now: float) -> None:
+        self.opened_at = now
+        if self.state == "closed":
+            statsd.increment("http.client.circuit_breaker.opened", tags=self._tags)
+        self._set_state("open")
+
+
+_CIRCUIT_BREAKERS: typing.MutableMapping[
+    typing.Tuple[str, str, typing.Optional[str]], CircuitBreaker
+] = cachetools.LRUCache(maxsize=CIRCUIT_BREAKERS_MAX_SIZE)
+
+
+def get_endpoint_class(url: httpx.URL) -> str:
+    """Return the group of endpoints an url belongs to.
+
+    e.g.: /repos/owner/repo/pulls/1/files -> repos/pulls
+    """
+    segments = [s for s in parse.unquote(url.path).split("/") if s]
+    if not segments:
+        return "/"
+    elif segments[0] == "repos" and len(segments) > 3:
+        return f"repos/{segments[3]}"
+    return segments[0]
+
+
+def get_circuit_breaker(
+    url: httpx.URL, tenant: typing.Optional[str] = None
+) -> CircuitBreaker:
+    """Return the circuit breaker of this url for a tenant, shared by the process.
+
+    A tenant failing requests (e.g.: the files of a huge pull request) only
+    opens its own circuits.
+    """
+    key = (url.host, get_endpoint_class(url), tenant)
+    breaker = _CIRCUIT_BREAKERS.get(key)
+    if breaker is None:
+        breaker = _CIRCUIT_BREAKERS[key] = CircuitBreaker(*key)
+    return breaker
+
+
+def reset_circuit_breakers() -> None:
+    _CIRCUIT_BREAKERS.clear()
+
 
 def wait_retry_after_header(retry_state):
     exc = retry_state.outcome.exception()
@@ -147,9 +317,7 @@ def after_log(retry_state):
 
 connectivity_issue_retry = tenacity.retry(
     reraise=True,
-    retry=tenacity.retry_if_exception_type(
-        (RequestError, HTTPServerSideError, HTTPTooManyRequests)
-    ),
+    retry=tenacity.retry_if_exception_type(CIRCUIT_BREAKER_FAILURES),
     wait=tenacity.wait_combine(
         wait_retry_after_header, tenacity.wait_exponential(multiplier=0.2)
     ),
@@ -182,9 +350,97 @@ def raise_for_status(resp):
     raise exc_class(message, request=resp.request, response=resp)
 
 
+class SharedConnectionPool(httpcore.AsyncConnectionPool):
+    """HTTP/2 connection pool shared by all the clients of an event loop.
+
+    Clients don't own it, closing them keeps the connections alive.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        super().__init__(
+            ssl_context=httpx.create_ssl_context(http2=True),
+            max_connections=POOL_LIMITS.max_connections,
+            max_keepalive_connections=POOL_LIMITS.max_keepalive_connections,
+            keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+            http2=True,
+        )
+
+    @staticmethod
+    def _get_metric_tags(origin: typing.Tuple[bytes, bytes, int]) -> typing.List[str]:
+        return [f"hostname:{origin[1].decode()}"]
+
+    async def _get_connection_from_pool(self, origin):
+        connection = await super()._get_connection_from_pool(origin)
+        if connection is not None:
+            statsd.increment(
+                "http.client.connections.reused", tags=self._get_metric_tags(origin)
+            )
+        return connection
+
+    async def _add_to_pool(self, connection, timeout):
+        await super()._add_to_pool(connection, timeout)
+        statsd.increment(
+            "http.client.connections.created",
+            tags=self._get_metric_tags(connection.origin),
+        )
+
+    async def aclose(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        await super().aclose()
+
+
+_SHARED_CONNECTION_POOL: typing.Optional[SharedConnectionPool] = None
+
+
+def get_shared_connection_pool() -> SharedConnectionPool:
+    global _SHARED_CONNECTION_POOL
+    # NOTE(sileht): connections are bound to the event loop that opened them
+    loop = asyncio.get_event_loop()
+    if _SHARED_CONNECTION_POOL is None or _SHARED_CONNECTION_POOL.loop is not loop:
+        _SHARED_CONNECTION_POOL = SharedConnectionPool(loop)
+    return _SHARED_CONNECTION_POOL
+
+
+async def shutdown_shared_connection_pool() -> None:
+    global _SHARED_CONNECTION_POOL
+    if _SHARED_CONNECTION_POOL is not None:
+        await _SHARED_CONNECTION_POOL.shutdown()
+        _SHARED_CONNECTION_POOL = None
+
+
 class AsyncClient(httpx.AsyncClient):
+    def __init__(self, *args: typing.Any, **kwargs: typing.Any) -> None:
+        kwargs.setdefault("transport", get_shared_connection_pool())
+        super().__init__(*args, **kwargs)
+
+    def _get_circuit_breaker_tenant(self) -> typing.Optional[str]:
+        return None
+
     @connectivity_issue_retry
     async def request(self, method, url, *args, **kwargs):
-        resp = await super().request(method, url, *args, **kwargs)
+        # NOTE(sileht): once the circuit is opened, the next attempts fail fast
+        # with CircuitOpen, which is not retried
+        breaker = get_circuit_breaker(
+            self._merge_url(url), self._get_circuit_breaker_tenant()
+        )
+        probe = breaker.before_request()
+        try:
+            resp = await super().request(method, url, *args, **kwargs)
+        except RequestError:
+            breaker.record(failed=True, probe=probe)
+            raise
+        except BaseException:
+            if probe:
+                breaker.cancel_probe()
+            raise
+        breaker.record(
+            failed=(
+                httpx.codes.is_server_error(resp.status_code) or resp.status_code == 429
+            ),
+            probe=probe,
+        )
         raise_for_status(resp)
         return resp
@@ -0,0 +1,193 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2021 Mergify SAS
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import contextlib
+import contextvars
+import dataclasses
+import re
+import typing
+from urllib import parse
+
+from datadog import statsd
+
+from mergify_engine import config
+
+
+PhaseT = typing.Literal["engine", "rules", "actions", "summary", "merge_train"]
+
+PHASE: "contextvars.ContextVar[PhaseT]" = contextvars.ContextVar(
+    "github_requests_phase", default="engine"
+)
+
+# NOTE(sileht): the segment following these ones is a parameter
+PARAMETER_SEGMENTS = {
+    "users": "{user}",
+    "orgs": "{org}",
+    "branches": "{branch}",
+    "commits": "{ref}",
+    "collaborators": "{user}",
+    "members": "{user}",
+    "memberships": "{user}",
+    "teams": "{team}",
+    "labels": "{label}",
+    "compare": "{basehead}",
+}
+# NOTE(sileht): all the segments following these ones are a single parameter
+PARAMETER_TAIL_SEGMENTS = {
+    "contents": "{path}",
+    "refs": "{ref}",
+    "ref": "{ref}",
+    "matching-refs": "{ref}",
+}
+NUMBER_RE = re.compile(r"^[0-9]+$")
+SHA_RE = re.compile(r"^[0-9a-f]{40}$")
+
+
+@contextlib.contextmanager
+def phase(name: PhaseT) -> typing.Iterator[None]:
+    """Attribute the GitHub requests done in this block to an engine phase."""
+    token = PHASE.set(name)
+    try:
+        yield
+    finally:
+        PHASE.reset(token)
+
+
+def get_endpoint_template(url: str) -> str:
+    """Return the endpoint of an url with its parameters replaced by placeholders.
+
+    e.g.: /repos/mergifyio/engine/pulls/123/files -> /repos/{owner}/{repo}/pulls/{number}/files
+    """
+    path = parse.urlparse(url).path
+    api_path = parse.urlparse(config.GITHUB_API_URL).path.rstrip("/")
+    if api_path and path.startswith(api_path):
+        path = path[len(api_path) :]
+
+    segments = [s for s in path.split("/") if s]
+    template: typing.List[str] = []
+    i = 0
+    while i < len(segments):
+        segment = segments[i]
+        previous = segments[i - 1] if i > 0 else None
+        if previous == "repos" and i + 1 < len(segments):
+            template.extend(("{owner}", "{repo}"))
+            i += 2
+            continue
+        elif previous in PARAMETER_TAIL_SEGMENTS:
+            template.append(PARAMETER_TAIL_SEGMENTS[previous])
+            break
+        elif previous in PARAMETER_SEGMENTS:
+            template.append(PARAMETER_SEGMENTS[previous])
+        elif NUMBER_RE.match(segment):
+            template.append("{number}")
+        elif SHA_RE.match(segment):
+            template.append("{sha}")
+        else:
+            template.append(segment)
+        i += 1
+    return "/" + "/".join(template)
+
+
+def _is_next_page(
+    url: str, params: typing.Optional[typing.Dict[str, typing.Any]]
+) -> bool:
+    page = (params or {}).get("page")
+    if page is None:
+        page = parse.parse_qs(parse.urlparse(url).query).get("page", ["1"])[0]
+    return str(page) != "1"
+
+
+@dataclasses.dataclass
+class EndpointCost:
+    requests: int = 0
+    pages: int = 0
+    bytes: int = 0
+    time: float = 0.0
+    errors: int = 0
+
+
+EndpointKeyT = typing.Tuple[PhaseT, str, str]
+
+
+@dataclasses.dataclass
+class RequestsProfile:
+    """GitHub API usage of a client, grouped by phase, method and endpoint."""
+
+    hostname: str
+    costs: typing.Dict[EndpointKeyT, EndpointCost] = dataclasses.field(
+        default_factory=dict
+    )
+
+    @property
+    def nb_requests(self) -> int:
+        return sum(cost.requests for cost in self.costs.values())
+
+    def record(
+        self,
+        method: str,
+        url: str,
+        params: typing.Optional[typing.Dict[str, typing.Any]],
+        elapsed: float,
+        nbytes: int,
+        failed: bool,
+    ) -> None:
+        key = (PHASE.get(), method, get_endpoint_template(url))
+        cost = self.costs.setdefault(key, EndpointCost())
+        cost.requests += 1
+        cost.bytes += nbytes
+        cost.time += elapsed
+
+        tags = [
+            f"hostname:{self.hostname}",
+            f"phase:{key[0]}",
+            f"method:{key[1]}",
+            f"endpoint:{key[2]}",
+        ]
+        statsd.histogram("http.client.endpoint.time", elapsed, tags=tags)
+        statsd.histogram("http.client.endpoint.bytes", nbytes, tags=tags)
+        if _is_next_page(url, params):
+            cost.pages += 1
+            statsd.increment("http.client.endpoint.pages", tags=tags)
+        if failed:
+            cost.errors += 1
+            statsd.increment("http.client.endpoint.errors", tags=tags)
+
+    def get_hot_endpoints(
+        self, limit: typing.Optional[int] = None
+    ) -> typing.List[typing.Tuple[EndpointKeyT, EndpointCost]]:
+        return sorted(
+            self.costs.items(), key=lambda item: item[1].requests, reverse=True
+        )[:limit]
+
+    def summary(self, limit: int = 10) -> typing.Dict[str, int]:
+        return {
+            " ".join(key): cost.requests for key, cost in self.get_hot_endpoints(limit)
+        }
+
+    def dump(self) -> str:
+        lines = [
+            f"{'phase':<12} {'method':<7} {'endpoint':<60} "
+            f"{'requests':>8} {'pages':>6} {'errors':>6} {'bytes':>10} {'time':>8}"
+        ]
+        for (phase_name, method, endpoint), cost in self.get_hot_endpoints():
+            lines.append(
+                f"{phase_name:<12} {method:<7} {endpoint:<60} "
+                f"{cost.requests:>8} {cost.pages:>6} {cost.errors:>6} "
+                f"{cost.bytes:>10} {cost.time:>7.3f}s"
+            )
+        return "\n".join(lines)
+
+    def reset(self) -> None:
+        self.costs = {}
@@ -127,6 +127,10 @@ Schema = voluptuous.Schema(
             int
         ),
         voluptuous.Required("STREAM_MAX_BATCH", default=100): voluptuous.Coerce(int),
+        voluptuous.Required(
+            "STREAM_MAX_CONCURRENT_REPOSITORIES", default=1
+        ): voluptuous.All(voluptuous.Coerce(int), voluptuous.Range(min=1)),
+        voluptuous.Required("GRAPHQL_LOADER", default=False): CoercedBool,
         GitHubAppRequired("CACHE_TOKEN_SECRET"): str,
         voluptuous.Required("CONTEXT", default="mergify"): str,
         voluptuous.Required("GIT_EMAIL", default="noreply@mergify.io"): str,
@@ -178,6 +182,8 @@ BOT_USER_ID: int
 STORAGE_URL: str
 STREAM_URL: str
 STREAM_MAX_BATCH: int
+STREAM_MAX_CONCURRENT_REPOSITORIES: int
+GRAPHQL_LOADER: bool
 INTEGRATION_ID: int
 SUBSCRIPTION_BASE_URL: str
 OAUTH_CLIENT_ID: str
@@ -13,6 +13,7 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import asyncio
 import base64
 import contextlib
 import dataclasses
@@ -23,6 +24,7 @@ import typing
 from urllib import parse
 
 import daiquiri
+from datadog import statsd
 import first
 import jinja2.exceptions
 import jinja2.meta
@@ -44,6 +46,7 @@ from mergify_engine.clients import http
 
 
 if typing.TYPE_CHECKING:
+    from mergify_engine import rules
     from mergify_engine import worker
 
 SUMMARY_SHA_EXPIRATION = 60 * 60 * 24 * 31  # ~ 1 Month
@@ -59,6 +62,12 @@ class T_PayloadEventSource(typing.TypedDict):
     timestamp: str
 
 
+class OpenedPullRequest(typing.TypedDict):
+    number: github_types.GitHubPullRequestNumber
+    base_ref: github_types.GitHubRefType
+    head_sha: github_types.SHAType
+
+
 @dataclasses.dataclass
 class PullRequestAttributeError(AttributeError):
     name: str
@@ -172,6 +181,7 @@ class Installation:
 class RepositoryCache(typing.TypedDict, total=False):
     mergify_config: typing.Optional[MergifyConfigFile]
     branches: typing.Dict[github_types.GitHubRefType, github_types.GitHubBranch]
+    opened_pulls: typing.List[OpenedPullRequest]
 
 
 @dataclasses.dataclass
@@ -210,6 +220,8 @@ class Repository(object):
         ".github/mergify.yml",
     ]
 
+    CONFIG_FILE_EXPIRATION = 3600  # 1 hour
+
     @staticmethod
     def get_config_location_cache_key(
         owner_login: github_types.GitHubLogin,
@@ -217,6 +229,50 @@ class Repository(object):
     ) -> str:
         return f"config-location~{owner_login}~{repo_name}"
 
+    @staticmethod
+    def get_config_file_cache_key(
+        owner_login: github_types.GitHubLogin,
+        repo_name: github_types.GitHubRepositoryName,
+    ) -> str:
+        return f"config-file~{owner_login}~{repo_name}"
+
+    @classmethod
+    async def clear_config_file_cache(
+        cls,
+        redis: utils.RedisCache,
+        owner_login: github_types.GitHubLogin,
+        repo_name: github_types.GitHubRepositoryName,
+    ) -> None:
+        await redis.delete(cls.get_config_file_cache_key(owner_login, repo_name))
+
+    async def _get_cached_config_file(self) -> typing.Optional[MergifyConfigFile]:
+        cached = await self.installation.redis.hgetall(
+            self.get_config_file_cache_key(self.installation.owner_login, self.name)
+        )
+        if not cached:
+            return None
+        return MergifyConfigFile(
+            type="file",
+            content=cached["content"],
+            path=cached["path"],
+            sha=cached["sha"],
+            decoded_content=base64.b64decode(bytearray(cached["content"], "utf-8")),
+        )
+
+    async def _set_cached_config_file(self, config_file: MergifyConfigFile) -> None:
+        key = self.get_config_file_cache_key(self.installation.owner_login, self.name)
+        pipe = await self.installation.redis.pipeline()
+        await pipe.hmset(
+            key,
+            {
+                "content": config_file["content"],
+                "path": config_file["path"],
+                "sha": config_file["sha"],
+            },
+        )
+        await pipe.expire(key, self.CONFIG_FILE_EXPIRATION)
+        await pipe.execute()
+
     async def iter_mergify_config_files(
         self,
         ref: typing.Optional[github_types.SHAType] = None,
@@ -262,6 +318,13 @@ class Repository(object):
         if "mergify_config" in self._cache:
             return self._cache["mergify_config"]
 
+        cached_config_file = await self._get_cached_config_file()
+        if cached_config_file is not None:
+            statsd.increment("engine.mergify_config_file.cache.hit")
+            self._cache["mergify_config"] = cached_config_file
+            return cached_config_file
+
+        statsd.increment("engine.mergify_config_file.cache.miss")
         config_location_cache = self.get_config_location_cache_key(
             self.installation.owner_login, self.name
         )
@@ -273,6 +336,7 @@ class Repository(object):
                 await self.installation.redis.set(
                     config_location_cache, config_file["path"], ex=60 * 60 * 24 * 31
                 )
+            await self._set_cached_config_file(config_file)
             self._cache["mergify_config"] = config_file
             return config_file
 
@@ -391,6 +455,135 @@ class Repository(object):
             "write",
         )
 
+    OPENED_PULLS_CACHE_KEY_PREFIX = "opened_pulls"
+    OPENED_PULLS_CACHE_KEY_DELIMITER = "/"
+    OPENED_PULLS_EXPIRATION = 3600  # 1 hour
+    # NOTE(sileht): this field is set only by a full listing, it tells apart an
+    # index of a repository without opened pull requests from a cold one.
+    OPENED_PULLS_LOADED_FIELD = "loaded"
+
+    UPDATE_OPENED_PULL_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+if ARGV[2] == "" then
+    return redis.call("HDEL", KEYS[1], ARGV[1])
+end
+return redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+"""
+
+    @classmethod
+    def _opened_pulls_cache_key_for_repo(
+        cls,
+        owner_id: github_types.GitHubAccountIdType,
+        repo_name: github_types.GitHubRepositoryName,
+    ) -> str:
+        return (
+            f"{cls.OPENED_PULLS_CACHE_KEY_PREFIX}"
+            f"{cls.OPENED_PULLS_CACHE_KEY_DELIMITER}{owner_id}"
+            f"{cls.OPENED_PULLS_CACHE_KEY_DELIMITER}{repo_name}"
+        )
+
+    @staticmethod
+    def _to_opened_pull_request(
+        pull: github_types.GitHubPullRequest,
+    ) -> OpenedPullRequest:
+        return OpenedPullRequest(
+            number=pull["number"],
+            base_ref=pull["base"]["ref"],
+            head_sha=pull["head"]["sha"],
+        )
+
+    @classmethod
+    async def update_opened_pulls_cache(
+        cls, redis: utils.RedisCache, pull: github_types.GitHubPullRequest
+    ) -> None:
+        """Update the opened pull requests index with a pull request event.
+
+        The index is only updated when it has been loaded, a partial index
+        would hide the pull requests not seen in events.
+        """
+        if pull["state"] == "open":
+            value = json.dumps(cls._to_opened_pull_request(pull))
+        else:
+            value = ""
+        await redis.eval(
+            cls.UPDATE_OPENED_PULL_SCRIPT,
+            1,
+            cls._opened_pulls_cache_key_for_repo(
+                pull["base"]["repo"]["owner"]["id"], pull["base"]["repo"]["name"]
+            ),
+            pull["number"],
+            value,
+        )
+
+    async def _get_opened_pulls_from_index(
+        self,
+    ) -> typing.Optional[typing.List[OpenedPullRequest]]:
+        index = await self.installation.redis.hgetall(
+            self._opened_pulls_cache_key_for_repo(self.installation.owner_id, self.name)
+        )
+        if index.pop(self.OPENED_PULLS_LOADED_FIELD, None) is None:
+            return None
+        return sorted(
+            (typing.cast(OpenedPullRequest, json.loads(raw)) for raw in index.values()),
+            key=lambda p: p["number"],
+            reverse=True,
+        )
+
+    async def _load_opened_pulls_index(self) -> typing.List[OpenedPullRequest]:
+        opened_pulls = [
+            self._to_opened_pull_request(p)
+            async for p in self.installation.client.items(
+                f"{self.base_url}/pulls", fields=("number", "base.ref", "head.sha")
+            )
+        ]
+        key = self._opened_pulls_cache_key_for_repo(
+            self.installation.owner_id, self.name
+        )
+        pipe = await self.installation.redis.pipeline()
+        await pipe.delete(key)
+        await pipe.hset(key, self.OPENED_PULLS_LOADED_FIELD, 1)
+        for p in opened_pulls:
+            await pipe.hset(key, p["number"], json.dumps(p))
+        await pipe.expire(key, self.OPENED_PULLS_EXPIRATION)
+        await pipe.execute()
+        return opened_pulls
+
+    async def get_opened_pulls(self) -> typing.List[OpenedPullRequest]:
+        """Get the opened pull requests of the repository.
+
+        The list comes from an index kept up to date by pull request events.
+        When the index is cold or expired, it is rebuilt from a full listing.
+        """
+        if "opened_pulls" not in self._cache:
+            opened_pulls = await self._get_opened_pulls_from_index()
+            if opened_pulls is None:
+                opened_pulls = await self._load_opened_pulls_index()
+            self._cache["opened_pulls"] = opened_pulls
+        return self._cache["opened_pulls"]
+
+
+PrefetchKeyT = typing.Literal[
+    "consolidated_reviews", "files", "pull_check_runs", "pull_statuses"
+]
+
+# NOTE(sileht): remote data needed by the attributes, the others are part of
+# the pull request payload
+ATTRIBUTES_PREFETCH_KEYS: typing.Dict[str, typing.Tuple[PrefetchKeyT, ...]] = {
+    "files": ("files",),
+    "approved-reviews-by": ("consolidated_reviews",),
+    "dismissed-reviews-by": ("consolidated_reviews",),
+    "changes-requested-reviews-by": ("consolidated_reviews",),
+    "commented-reviews-by": ("consolidated_reviews",),
+    "status-success": ("pull_check_runs", "pull_statuses"),
+    "status-failure": ("pull_check_runs", "pull_statuses"),
+    "status-neutral": ("pull_check_runs", "pull_statuses"),
+    "check-success": ("pull_check_runs", "pull_statuses"),
+    "check-failure": ("pull_check_runs", "pull_statuses"),
+    "check-neutral": ("pull_check_runs", "pull_statuses"),
+}
+
 
 class ContextCache(typing.TypedDict, total=False):
     consolidated_reviews: typing.Tuple[
@@ -403,6 +596,7 @@ class ContextCache(typing.TypedDict, total=False):
     is_behind: bool
     files: typing.List[github_types.GitHubFile]
     commits: typing.List[github_types.GitHubBranchCommit]
+    conditions_memo: "rules.ContextEvaluationMemo"
 
 
 @dataclasses.dataclass
@@ -583,6 +777,32 @@ class Context(object):
         )
         return self._cache["consolidated_reviews"]
 
+    async def prefetch_attributes(self, attributes: typing.Iterable[str]) -> None:
+        """Fetch concurrently the remote data needed by these attributes.
+
+        Data not needed by any of these attributes is never fetched.
+        """
+        fetchers: typing.Dict[
+            PrefetchKeyT, typing.Callable[[], typing.Awaitable[typing.Any]]
+        ] = {
+            "consolidated_reviews": self.consolidated_reviews,
+            "files": lambda: self.files,
+            "pull_check_runs": lambda: self.pull_check_runs,
+            "pull_statuses": lambda: self.pull_statuses,
+        }
+        keys = {
+            key
+            for name in attributes
+            for key in ATTRIBUTES_PREFETCH_KEYS.get(name, ())
+            if key not in self._cache
+        }
+        results = await asyncio.gather(
+            *(fetchers[key]() for key in sorted(keys)), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
     async def _get_consolidated_data(self, name):
         if name == "assignee":
             return [a["login"] for a in self.pull["assignees"]]
@@ -947,7 +1167,8 @@ class Context(object):
             async for file in typing.cast(
                 typing.AsyncIterable[github_types.GitHubFile],
                 self.client.items(
-                    f"{self.base_url}/pulls/{self.pull['number']}/files?per_page=100"
+                    f"{self.base_url}/pulls/{self.pull['number']}/files?per_page=100",
+                    fields=("filename", "contents_url"),
                 ),
             )
         ]
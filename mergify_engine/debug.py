@@ -28,6 +28,7 @@ from mergify_engine import rules
 from mergify_engine import subscription
 from mergify_engine import user_tokens
 from mergify_engine import utils
+from mergify_engine import worker
 from mergify_engine.actions import merge_base
 from mergify_engine.clients import github
 from mergify_engine.clients import http
@@ -100,25 +101,32 @@ async def report_dashboard_synchro(
 
 
 async def report_worker_status(owner: github_types.GitHubLogin) -> None:
-    stream_name = f"stream~{owner}".encode()
+    stream_prefix = f"stream~{owner}~".encode()
     r = await utils.create_aredis_for_stream()
-    streams = await r.zrangebyscore("streams", min=0, max="+inf", withscores=True)
 
-    for pos, item in enumerate(streams):  # noqa: B007
-        if item[0] == stream_name:
-            break
+    for shard_key in worker.get_shard_keys():
+        streams = await r.zrangebyscore(shard_key, min=0, max="+inf", withscores=True)
+        for pos, (stream_name, score) in enumerate(streams):  # noqa: B007
+            if stream_name.startswith(stream_prefix):
+                break
+        else:
+            continue
+        break
     else:
         print("* WORKER: Installation not queued to process")
         return
 
-    planned = datetime.datetime.utcfromtimestamp(streams[pos]).isoformat()
+    planned = datetime.datetime.utcfromtimestamp(score).isoformat()
 
     attempts = await r.hget("attempts", stream_name) or 0
+    deficit = float(await r.hget(worker.DEFICITS_KEY, stream_name) or 0)
     print(
         "* WORKER: Installation queued, "
+        f" shard: {shard_key},"
         f" pos: {pos}/{len(streams)},"
         f" next_run: {planned},"
-        f" attempts: {attempts}"
+        f" attempts: {attempts},"
+        f" slice debt: {-deficit:.2f}s"
     )
 
     size = await r.xlen(stream_name)
@@ -322,5 +330,14 @@ async def report(
 def main() -> None:
     parser = argparse.ArgumentParser(description="Debugger for mergify")
     parser.add_argument("url", help="Pull request url")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the GitHub API requests done to build the report",
+    )
     args = parser.parse_args()
-    asyncio.run(report(args.url))
+    result = asyncio.run(report(args.url))
+    if args.profile and result is not None:
+        client = result.client if isinstance(result, context.Context) else result
+        print("* GITHUB API REQUESTS:")
+        print(client.profile.dump())
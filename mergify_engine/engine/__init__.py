@@ -21,10 +21,12 @@ from mergify_engine import check_api
 from mergify_engine import config
 from mergify_engine import context
 from mergify_engine import github_types
+from mergify_engine import graphql_loader
 from mergify_engine import rules
 from mergify_engine import subscription
 from mergify_engine import utils
 from mergify_engine.clients import github
+from mergify_engine.clients import profiler
 from mergify_engine.engine import actions_runner
 from mergify_engine.engine import commands_runner
 from mergify_engine.engine import queue_runner
@@ -205,7 +207,7 @@ async def run(
 
     # BRANCH CONFIGURATION CHECKING
     try:
-        mergify_config = rules.get_mergify_config(config_file)
+        mergify_config = await rules.get_cached_mergify_config(ctxt.redis, config_file)
     except rules.InvalidRules as e:  # pragma: no cover
         ctxt.log.info(
             "The Mergify configuration is invalid",
@@ -256,11 +258,36 @@ async def run(
                 await ctxt.clear_cached_last_summary_head_sha()
                 break
 
+    with profiler.phase("rules"):
+        if config.GRAPHQL_LOADER:
+            await graphql_loader.load(
+                [ctxt],
+                graphql_loader.get_cache_keys(
+                    rules.get_attributes(
+                        mergify_config["pull_request_rules"],
+                        mergify_config["queue_rules"],
+                    )
+                ),
+            )
+        # NOTE(sileht): only the rules about to be evaluated are worth
+        # prefetching, queue rules of other pull requests are evaluated
+        # only once they are queued
+        if ctxt.is_merge_queue_pr():
+            await ctxt.prefetch_attributes(
+                rules.get_attributes(mergify_config["queue_rules"])
+            )
+        else:
+            await ctxt.prefetch_attributes(
+                rules.get_attributes(mergify_config["pull_request_rules"])
+            )
+
     ctxt.log.debug("engine handle actions")
-    if ctxt.is_merge_queue_pr():
-        await queue_runner.handle(mergify_config["queue_rules"], ctxt)
-    else:
-        await actions_runner.handle(mergify_config["pull_request_rules"], ctxt)
+    with rules.shared_evaluation_memo(ctxt):
+        if ctxt.is_merge_queue_pr():
+            with profiler.phase("merge_train"):
+                await queue_runner.handle(mergify_config["queue_rules"], ctxt)
+        else:
+            await actions_runner.handle(mergify_config["pull_request_rules"], ctxt)
 
 
 async def create_initial_summary(
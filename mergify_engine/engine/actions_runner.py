@@ -24,6 +24,8 @@ from mergify_engine import doc
 from mergify_engine import exceptions
 from mergify_engine import github_types
 from mergify_engine import rules
+from mergify_engine.clients import github
+from mergify_engine.clients import profiler
 
 
 NOT_APPLICABLE_TEMPLATE = """<details>
@@ -205,11 +207,26 @@ async def post_summary(ctxt, match, summary_check, conclusions, previous_conclus
             previous_conclusions=previous_conclusions,
         )
 
-        await ctxt.set_summary_check(
-            check_api.Result(
-                check_api.Conclusion.SUCCESS, title=summary_title, summary=summary
-            )
+        result = check_api.Result(
+            check_api.Conclusion.SUCCESS, title=summary_title, summary=summary
         )
+        if (
+            not summary_check
+            or ctxt.user_refresh_requested()
+            or ctxt.admin_refresh_requested()
+        ):
+            await ctxt.set_summary_check(result)
+            return
+
+        # NOTE(sileht): rewriting an existing summary can wait, the next engine
+        # run will post it if the budget is back, a real rate limit is still
+        # raised to retry the whole run
+        try:
+            with github.low_priority():
+                await ctxt.set_summary_check(result)
+        except exceptions.RateLimitBudgetExhausted:
+            ctxt.log.info("summary update deferred, rate limit budget is low")
+            statsd.increment("engine.summary.deferred")
     else:
         ctxt.log.info(
             "summary unchanged",
@@ -471,11 +488,16 @@ async def run_actions(
 async def handle(
     pull_request_rules: rules.PullRequestRules, ctxt: context.Context
 ) -> None:
-    match = await pull_request_rules.get_pull_request_rule(ctxt)
+    with profiler.phase("rules"):
+        match = await pull_request_rules.get_pull_request_rule(ctxt)
     checks = {c["name"]: c for c in await ctxt.pull_engine_check_runs}
 
     summary_check = checks.get(ctxt.SUMMARY_NAME)
     previous_conclusions = load_conclusions(ctxt, summary_check)
 
-    conclusions = await run_actions(ctxt, match, checks, previous_conclusions)
-    await post_summary(ctxt, match, summary_check, conclusions, previous_conclusions)
+    with profiler.phase("actions"):
+        conclusions = await run_actions(ctxt, match, checks, previous_conclusions)
+    with profiler.phase("summary"):
+        await post_summary(
+            ctxt, match, summary_check, conclusions, previous_conclusions
+        )
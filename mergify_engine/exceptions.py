@@ -34,6 +34,10 @@ class RateLimited(Exception):
     remaining: int
 
 
+class RateLimitBudgetExhausted(RateLimited):
+    """The request has not been sent, the installation budget is too low."""
+
+
 @dataclasses.dataclass
 class EngineNeedRetry(Exception):
     pass
@@ -87,6 +91,8 @@ def need_retry(
         # NOTE(sileht): when we are close to reset date, and since utc time between us and
         # github differ a bit, we can have negative delta, so set a minimun for retrying
         return max(exception.countdown, RATE_LIMIT_RETRY_MIN)
+    elif isinstance(exception, http.CircuitOpen):
+        return max(exception.countdown, RATE_LIMIT_RETRY_MIN)
     elif isinstance(exception, EngineNeedRetry):
         return datetime.timedelta(minutes=1)
 
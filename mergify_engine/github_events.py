@@ -15,6 +15,7 @@
 # under the License.
 
 import dataclasses
+import itertools
 import typing
 import uuid
 
@@ -34,6 +35,9 @@ from mergify_engine.engine import commands_runner
 
 LOG = daiquiri.getLogger(__name__)
 
+# NOTE(sileht): GitHub puts at most this number of commits in push events
+PUSH_EVENT_MAX_COMMITS = 20
+
 
 def meter_event(
     event_type: github_types.GitHubEventType, event: github_types.GitHubEvent
@@ -134,6 +138,18 @@ async def filter_and_dispatch(
         repo_name = event["repository"]["name"]
         pull_number = event["pull_request"]["number"]
 
+        if event["action"] in (
+            "opened",
+            "reopened",
+            "closed",
+            "synchronize",
+            "edited",
+        ):
+            await context.Repository.update_opened_pulls_cache(
+                redis_cache, event["pull_request"]
+            )
+            await _update_pulls_by_sha(redis_cache, event)
+
         if event["repository"]["archived"]:
             ignore_reason = "repository archived"
 
@@ -209,6 +225,11 @@ async def filter_and_dispatch(
         owner_id = event["repository"]["owner"]["id"]
         repo_name = event["repository"]["name"]
 
+        if _is_mergify_config_file_changed(event):
+            await context.Repository.clear_config_file_cache(
+                redis_cache, owner_login, repo_name
+            )
+
         if event["repository"]["archived"]:
             ignore_reason = "repository archived"
 
@@ -380,27 +401,95 @@ async def filter_and_dispatch(
         raise IgnoredEvent(event_type, event_id, ignore_reason)
 
 
-SHA_EXPIRATION = 60
+PULLS_BY_SHA_EXPIRATION = 60 * 60 * 24  # 1 day
+
+
+def _get_pulls_by_sha_key(
+    owner_login: github_types.GitHubLogin,
+    repo_name: github_types.GitHubRepositoryName,
+    sha: github_types.SHAType,
+) -> str:
+    return f"pulls-by-sha~{owner_login}~{repo_name}~{sha}"
+
+
+def _is_mergify_config_file_changed(event: github_types.GitHubEventPush) -> bool:
+    if event["ref"] != f"refs/heads/{event['repository']['default_branch']}":
+        return False
+
+    # NOTE(sileht): the commits list of a forced push doesn't tell what have been
+    # removed and GitHub truncates it to the last commits
+    if event["forced"] or len(event["commits"]) >= PUSH_EVENT_MAX_COMMITS:
+        return True
+
+    return any(
+        filename in context.Repository.MERGIFY_CONFIG_FILENAMES
+        for commit in event["commits"]
+        for filename in itertools.chain(
+            commit["added"], commit["removed"], commit["modified"]
+        )
+    )
+
+
+async def _update_pulls_by_sha(
+    redis_cache: utils.RedisCache, event: github_types.GitHubEventPullRequest
+) -> None:
+    owner_login = event["repository"]["owner"]["login"]
+    repo_name = event["repository"]["name"]
+    pull = event["pull_request"]
+    key = _get_pulls_by_sha_key(owner_login, repo_name, pull["head"]["sha"])
+
+    pipe = await redis_cache.pipeline()
+    if event["action"] == "synchronize":
+        event = typing.cast(github_types.GitHubEventPullRequestSynchronize, event)
+        await pipe.srem(
+            _get_pulls_by_sha_key(owner_login, repo_name, event["before"]),
+            pull["number"],
+        )
+    if pull["state"] == "open":
+        await pipe.sadd(key, pull["number"])
+        await pipe.expire(key, PULLS_BY_SHA_EXPIRATION)
+    else:
+        await pipe.srem(key, pull["number"])
+    await pipe.execute()
+
+
+async def _get_opened_pulls(
+    installation: context.Installation,
+    repo_name: github_types.GitHubRepositoryName,
+) -> typing.List[context.OpenedPullRequest]:
+    try:
+        return await installation.get_repository(repo_name).get_opened_pulls()
+    except Exception as e:
+        if exceptions.should_be_ignored(e):
+            return []
+        raise
 
 
 async def _get_github_pulls_from_sha(
     installation: context.Installation,
     repo_name: github_types.GitHubRepositoryName,
     sha: github_types.SHAType,
-    pulls: typing.List[github_types.GitHubPullRequest],
 ) -> typing.List[github_types.GitHubPullRequestNumber]:
-    cache_key = f"sha~{installation.owner_login}~{repo_name}~{sha}"
-    pull_number = await installation.redis.get(cache_key)
-    if pull_number is None:
-        for pull in pulls:
-            if pull["head"]["sha"] == sha:
-                await installation.redis.set(
-                    cache_key, pull["number"], ex=SHA_EXPIRATION
-                )
-                return [pull["number"]]
-        return []
-    else:
-        return [github_types.GitHubPullRequestNumber(int(pull_number))]
+    key = _get_pulls_by_sha_key(installation.owner_login, repo_name, sha)
+    pull_numbers = await installation.redis.smembers(key)
+    if pull_numbers:
+        return sorted(
+            github_types.GitHubPullRequestNumber(int(p)) for p in pull_numbers
+        )
+
+    # NOTE(sileht): the sha of pull requests that didn't get any events since the
+    # index expired are not known, look for them in the opened pull requests
+    pulls = [
+        p["number"]
+        for p in await _get_opened_pulls(installation, repo_name)
+        if p["head_sha"] == sha
+    ]
+    if pulls:
+        pipe = await installation.redis.pipeline()
+        await pipe.sadd(key, *pulls)
+        await pipe.expire(key, PULLS_BY_SHA_EXPIRATION)
+        await pipe.execute()
+    return pulls
 
 
 async def extract_pull_numbers_from_event(
@@ -408,7 +497,6 @@ async def extract_pull_numbers_from_event(
     repo_name: github_types.GitHubRepositoryName,
     event_type: github_types.GitHubEventType,
     data: github_types.GitHubEvent,
-    opened_pulls: typing.List[github_types.GitHubPullRequest],
 ) -> typing.List[github_types.GitHubPullRequestNumber]:
     # NOTE(sileht): Don't fail if we received even on repo that doesn't exists anymore
     if event_type == "refresh":
@@ -416,19 +504,27 @@ async def extract_pull_numbers_from_event(
         if (pull_request_number := data.get("pull_request_number")) is not None:
             return [pull_request_number]
         elif (ref := data.get("ref")) is None:
-            return [p["number"] for p in opened_pulls]
+            return [
+                p["number"] for p in await _get_opened_pulls(installation, repo_name)
+            ]
         else:
             branch = ref[11:]  # refs/heads/
-            return [p["number"] for p in opened_pulls if p["base"]["ref"] == branch]
+            return [
+                p["number"]
+                for p in await _get_opened_pulls(installation, repo_name)
+                if p["base_ref"] == branch
+            ]
     elif event_type == "push":
         data = typing.cast(github_types.GitHubEventPush, data)
         branch = data["ref"][11:]  # refs/heads/
-        return [p["number"] for p in opened_pulls if p["base"]["ref"] == branch]
+        return [
+            p["number"]
+            for p in await _get_opened_pulls(installation, repo_name)
+            if p["base_ref"] == branch
+        ]
     elif event_type == "status":
         data = typing.cast(github_types.GitHubEventStatus, data)
-        return await _get_github_pulls_from_sha(
-            installation, repo_name, data["sha"], opened_pulls
-        )
+        return await _get_github_pulls_from_sha(installation, repo_name, data["sha"])
     elif event_type == "check_suite":
         data = typing.cast(github_types.GitHubEventCheckSuite, data)
         # NOTE(sileht): This list may contains Pull Request from another org/user fork...
@@ -442,9 +538,7 @@ async def extract_pull_numbers_from_event(
         ]
         if not pulls:
             sha = data[event_type]["head_sha"]
-            pulls = await _get_github_pulls_from_sha(
-                installation, repo_name, sha, opened_pulls
-            )
+            pulls = await _get_github_pulls_from_sha(installation, repo_name, sha)
         return pulls
     elif event_type == "check_run":
         data = typing.cast(github_types.GitHubEventCheckRun, data)
@@ -459,23 +553,19 @@ async def extract_pull_numbers_from_event(
         ]
         if not pulls:
             sha = data[event_type]["head_sha"]
-            pulls = await _get_github_pulls_from_sha(
-                installation, repo_name, sha, opened_pulls
-            )
+            pulls = await _get_github_pulls_from_sha(installation, repo_name, sha)
         return pulls
     else:
         return []
 
 
-async def send_refresh(
-    redis_cache: utils.RedisCache,
-    redis_stream: utils.RedisStream,
+def _build_refresh_event(
     repository: github_types.GitHubRepository,
     pull_request_number: typing.Optional[github_types.GitHubPullRequestNumber] = None,
     ref: typing.Optional[github_types.GitHubRefType] = None,
     action: github_types.GitHubEventRefreshActionType = "user",
-) -> None:
-    data = github_types.GitHubEventRefresh(
+) -> github_types.GitHubEventRefresh:
+    return github_types.GitHubEventRefresh(
         {
             "action": action,
             "ref": ref,
@@ -494,6 +584,50 @@ async def send_refresh(
             },
         }
     )
+
+
+async def send_refresh(
+    redis_cache: utils.RedisCache,
+    redis_stream: utils.RedisStream,
+    repository: github_types.GitHubRepository,
+    pull_request_number: typing.Optional[github_types.GitHubPullRequestNumber] = None,
+    ref: typing.Optional[github_types.GitHubRefType] = None,
+    action: github_types.GitHubEventRefreshActionType = "user",
+) -> None:
+    data = _build_refresh_event(repository, pull_request_number, ref, action)
     await filter_and_dispatch(
         redis_cache, redis_stream, "refresh", str(uuid.uuid4()), data
     )
+
+
+async def send_pull_refreshes(
+    redis_stream: utils.RedisStream,
+    repository: github_types.GitHubRepository,
+    pull_request_numbers: typing.List[github_types.GitHubPullRequestNumber],
+    action: github_types.GitHubEventRefreshActionType = "user",
+) -> None:
+    """Send a refresh event for many pull requests of a repository at once."""
+    events: typing.List[worker.T_PushedEvent] = []
+    for pull_request_number in pull_request_numbers:
+        data = _build_refresh_event(repository, pull_request_number, action=action)
+        meter_event("refresh", data)
+        events.append(
+            (pull_request_number, "refresh", _extract_slim_event("refresh", data))
+        )
+
+    await worker.push_many(
+        redis_stream,
+        repository["owner"]["id"],
+        repository["owner"]["login"],
+        repository["name"],
+        events,
+    )
+
+    LOG.info(
+        "GithubApp event pushed to worker",
+        event_type="refresh",
+        sender="<internal>",
+        gh_owner=repository["owner"]["login"],
+        gh_repo=repository["name"],
+        gh_pulls=pull_request_numbers,
+    )
@@ -262,6 +262,11 @@ class GitHubEventPullRequest(GitHubEvent):
     pull_request: GitHubPullRequest
 
 
+class GitHubEventPullRequestSynchronize(GitHubEventPullRequest):
+    before: SHAType
+    after: SHAType
+
+
 GitHubEventPullRequestReviewCommentActionType = typing.Literal[
     "created",
     "edited",
@@ -317,11 +322,20 @@ class GitHubEventIssueComment(GitHubEvent):
     comment: GitHubComment
 
 
+class GitHubEventPushCommit(typing.TypedDict):
+    id: SHAType
+    added: typing.List[str]
+    removed: typing.List[str]
+    modified: typing.List[str]
+
+
 class GitHubEventPush(GitHubEvent):
     repository: GitHubRepository
     ref: GitHubRefType
     before: SHAType
     after: SHAType
+    forced: bool
+    commits: typing.List[GitHubEventPushCommit]
 
 
 class GitHubEventStatus(GitHubEvent):
@@ -0,0 +1,264 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2021 Mergify SAS
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import itertools
+import json
+import typing
+from urllib import parse
+
+import daiquiri
+from datadog import statsd
+
+from mergify_engine import config
+from mergify_engine import context
+from mergify_engine import exceptions
+from mergify_engine import github_types
+from mergify_engine.clients import github
+from mergify_engine.clients import http
+
+
+LOG = daiquiri.getLogger(__name__)
+
+# NOTE(sileht): a GraphQL connection returns at most 100 nodes, longer lists are
+# left to the REST getters of the context
+PAGE_SIZE = 100
+
+CacheKeyT = typing.Literal["reviews", "files", "pull_statuses"]
+
+ATTRIBUTES_CACHE_KEYS: typing.Dict[str, CacheKeyT] = {
+    "files": "files",
+    "approved-reviews-by": "reviews",
+    "dismissed-reviews-by": "reviews",
+    "changes-requested-reviews-by": "reviews",
+    "commented-reviews-by": "reviews",
+    "status-success": "pull_statuses",
+    "status-failure": "pull_statuses",
+    "status-neutral": "pull_statuses",
+    "check-success": "pull_statuses",
+    "check-failure": "pull_statuses",
+    "check-neutral": "pull_statuses",
+}
+
+PULL_REQUEST_FIELDS: typing.Dict[CacheKeyT, str] = {
+    "reviews": f"""
+reviews(first: {PAGE_SIZE}) {{
+  pageInfo {{ hasNextPage }}
+  nodes {{
+    databaseId
+    state
+    body
+    author {{
+      __typename
+      login
+      avatarUrl
+      ... on User {{ databaseId }}
+      ... on Bot {{ databaseId }}
+    }}
+  }}
+}}""",
+    "files": f"""
+files(first: {PAGE_SIZE}) {{
+  pageInfo {{ hasNextPage }}
+  nodes {{ path }}
+}}""",
+}
+
+COMMIT_STATUSES_FIELDS = """
+... on Commit {
+  status {
+    contexts { context state description targetUrl avatarUrl }
+  }
+}"""
+
+
+class IncompleteData(Exception):
+    pass
+
+
+def get_cache_keys(attributes: typing.Iterable[str]) -> typing.Set[CacheKeyT]:
+    """Return the context cache keys needed to evaluate these attributes."""
+    return {
+        ATTRIBUTES_CACHE_KEYS[name]
+        for name in attributes
+        if name in ATTRIBUTES_CACHE_KEYS
+    }
+
+
+def _get_nodes(connection: typing.Dict[str, typing.Any]) -> typing.List[typing.Any]:
+    if connection["pageInfo"]["hasNextPage"]:
+        raise IncompleteData()
+    return typing.cast(typing.List[typing.Any], connection["nodes"])
+
+
+def _to_reviews(
+    ctxt: context.Context, data: typing.Dict[str, typing.Any]
+) -> typing.List[github_types.GitHubReview]:
+    reviews = []
+    for node in _get_nodes(data["reviews"]):
+        author = node["author"]
+        if author is None or author.get("databaseId") is None:
+            # NOTE(sileht): ghost users and organizations, REST knows better
+            raise IncompleteData()
+        reviews.append(
+            github_types.GitHubReview(
+                {
+                    "id": node["databaseId"],
+                    "user": {
+                        "id": author["databaseId"],
+                        "login": author["login"],
+                        "type": author["__typename"],
+                        "avatar_url": author["avatarUrl"],
+                    },
+                    "body": node["body"],
+                    "state": node["state"],
+                }  # type: ignore[typeddict-item]
+            )
+        )
+    return reviews
+
+
+def _to_files(
+    ctxt: context.Context, data: typing.Dict[str, typing.Any]
+) -> typing.List[github_types.GitHubFile]:
+    return [
+        github_types.GitHubFile(
+            {
+                "filename": node["path"],
+                "contents_url": (
+                    f"{config.GITHUB_API_URL}{ctxt.base_url}/contents/{parse.quote(node['path'])}"
+                    f"?ref={ctxt.pull['head']['sha']}"
+                ),
+            }
+        )
+        for node in _get_nodes(data["files"])
+    ]
+
+
+def _to_statuses(
+    data: typing.Optional[typing.Dict[str, typing.Any]]
+) -> typing.List[github_types.GitHubStatus]:
+    if data is None or data["status"] is None:
+        return []
+    return [
+        github_types.GitHubStatus(
+            {
+                "context": status["context"],
+                # NOTE(sileht): EXPECTED is set by branch protection before the
+                # first status is posted, REST doesn't return it
+                "state": "pending"
+                if status["state"] == "EXPECTED"
+                else status["state"].lower(),
+                "description": status["description"],
+                "target_url": status["targetUrl"],
+                "avatar_url": status["avatarUrl"],
+            }
+        )
+        for status in data["status"]["contexts"]
+    ]
+
+
+CONVERTERS: typing.Dict[
+    CacheKeyT,
+    typing.Callable[[context.Context, typing.Dict[str, typing.Any]], typing.Any],
+] = {
+    "reviews": _to_reviews,
+    "files": _to_files,
+}
+
+
+def _build_query(
+    ctxts: typing.List[context.Context], cache_keys: typing.Set[CacheKeyT]
+) -> str:
+    fields = []
+    for ctxt in ctxts:
+        pull_fields = "".join(
+            PULL_REQUEST_FIELDS[key]
+            for key in sorted(cache_keys)
+            if key in PULL_REQUEST_FIELDS and key not in ctxt._cache
+        )
+        if pull_fields:
+            fields.append(
+                f"pull_{ctxt.pull['number']}: pullRequest(number: {ctxt.pull['number']})"
+                f" {{{pull_fields}}}"
+            )
+        if "pull_statuses" in cache_keys and "pull_statuses" not in ctxt._cache:
+            fields.append(
+                f"statuses_{ctxt.pull['number']}: "
+                f"object(oid: {json.dumps(ctxt.pull['head']['sha'])})"
+                f" {{{COMMIT_STATUSES_FIELDS}}}"
+            )
+    if not fields:
+        return ""
+    return (
+        "query($owner: String!, $name: String!) {"
+        f" repository(owner: $owner, name: $name) {{{''.join(fields)}}} }}"
+    )
+
+
+async def load(
+    ctxts: typing.List[context.Context], cache_keys: typing.Set[CacheKeyT]
+) -> None:
+    """Fill the cache of these contexts with one GraphQL query per repository.
+
+    Nothing is raised, anything not loaded is fetched later by the REST getters.
+    """
+    if not cache_keys:
+        return
+
+    for repository, grouped_ctxts in itertools.groupby(
+        sorted(ctxts, key=lambda c: c.repository.name), key=lambda c: c.repository
+    ):
+        repo_ctxts = list(grouped_ctxts)
+        query = _build_query(repo_ctxts, cache_keys)
+        if not query:
+            continue
+
+        try:
+            data = (
+                await repository.installation.client.graphql(
+                    query,
+                    owner=repository.installation.owner_login,
+                    name=repository.name,
+                )
+            )["repository"]
+        except (
+            http.HTTPClientSideError,
+            http.HTTPServerSideError,
+            http.CircuitOpen,
+            exceptions.RateLimited,
+            github.GraphQLError,
+        ) as e:
+            LOG.warning(
+                "fail to load pull requests data with GraphQL",
+                gh_owner=repository.installation.owner_login,
+                gh_repo=repository.name,
+                error=str(e),
+            )
+            statsd.increment("engine.graphql_loader.failure")
+            continue
+
+        for ctxt in repo_ctxts:
+            pull_data = data.get(f"pull_{ctxt.pull['number']}")
+            for key, converter in CONVERTERS.items():
+                if pull_data is None or key not in cache_keys or key in ctxt._cache:
+                    continue
+                try:
+                    ctxt._cache[key] = converter(ctxt, pull_data)
+                except IncompleteData:
+                    statsd.increment("engine.graphql_loader.incomplete")
+
+            statuses_alias = f"statuses_{ctxt.pull['number']}"
+            if statuses_alias in data:
+                ctxt._cache["pull_statuses"] = _to_statuses(data[statuses_alias])
@@ -62,3 +62,33 @@ def dumps(v: typing.Any) -> str:
 
 def loads(v: typing.Union[str, bytes]) -> typing.Any:
     return json.loads(v, object_hook=_decode_enum)
+
+
+# NOTE(sileht): values are FieldsTreeT too, mypy doesn't support recursive types
+FieldsTreeT = typing.Dict[str, typing.Any]
+
+
+def get_fields_tree(fields: typing.Iterable[str]) -> FieldsTreeT:
+    """Convert dotted field paths to a tree usable by `project`."""
+    tree: FieldsTreeT = {}
+    for field in fields:
+        node = tree
+        for name in field.split("."):
+            node = node.setdefault(name, {})
+    return tree
+
+
+def project(value: typing.Any, tree: FieldsTreeT) -> typing.Any:
+    """Keep only the fields of the tree, a leaf keeps the whole value."""
+    if not tree:
+        return value
+    elif isinstance(value, dict):
+        return {
+            name: project(value[name], subtree)
+            for name, subtree in tree.items()
+            if name in value
+        }
+    elif isinstance(value, list):
+        return [project(v, tree) for v in value]
+    else:
+        return value
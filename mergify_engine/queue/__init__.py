@@ -108,17 +108,18 @@ class QueueBase(abc.ABC):
 
         from mergify_engine import github_events  # circular reference
 
+        pull_numbers = [
+            pull_number
+            for pull_number in await self.get_pulls()
+            if pull_number != except_pull_request
+        ]
+        if not pull_numbers:
+            return
+
         async with utils.aredis_for_stream() as redis_stream:
-            for pull_number in await self.get_pulls():
-                if (
-                    except_pull_request is not None
-                    and except_pull_request == pull_number
-                ):
-                    continue
-                await github_events.send_refresh(
-                    self.repository.installation.redis,
-                    redis_stream,
-                    repository,
-                    pull_request_number=pull_number,
-                    action="internal",
-                )
+            await github_events.send_pull_refreshes(
+                redis_stream,
+                repository,
+                pull_numbers,
+                action="internal",
+            )
@@ -13,29 +13,47 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import base64
+import contextlib
+import copy
 import dataclasses
 import functools
 import itertools
+import json
 import operator
 import typing
+import zlib
 
+import cachetools
 import daiquiri
+from datadog import statsd
 import voluptuous
 import yaml
 
 from mergify_engine import actions
 from mergify_engine import context
+from mergify_engine import github_types
+from mergify_engine import utils
 from mergify_engine.rules import filter
 from mergify_engine.rules import types
 
 
 LOG = daiquiri.getLogger(__name__)
 
+MERGIFY_CONFIG_CACHE_SIZE = 256
+MERGIFY_CONFIG_CACHE_EXPIRATION = 60 * 60 * 24 * 7  # 1 week
+# NOTE(sileht): bump it each time the configuration format changes
+MERGIFY_CONFIG_CACHE_VERSION = 2
+
+_MERGIFY_CONFIG_CACHE: typing.MutableMapping[
+    github_types.SHAType, "MergifyConfig"
+] = cachetools.LRUCache(maxsize=MERGIFY_CONFIG_CACHE_SIZE)
+
 
 def RuleCondition(value: str) -> filter.Filter:
     try:
         return filter.Filter.parse(value)
-    except filter.parser.pyparsing.ParseException as e:
+    except filter.parser.ConditionParsingError as e:
         raise voluptuous.Invalid(
             message=f"Invalid condition '{value}'. {str(e)}", error_message=str(e)
         )
@@ -45,6 +63,56 @@ def RuleCondition(value: str) -> filter.Filter:
         )
 
 
+@dataclasses.dataclass
+class ContextEvaluationMemo(filter.EvaluationMemo):
+    # The pull request data the results have been computed from
+    context_data: typing.Dict[str, typing.Any] = dataclasses.field(default_factory=dict)
+
+    @staticmethod
+    def _get_context_data(ctxt: context.Context) -> typing.Dict[str, typing.Any]:
+        context_data = {
+            key: value for key, value in ctxt._cache.items() if key != "conditions_memo"
+        }
+        context_data["pull"] = ctxt.pull
+        return context_data
+
+    def is_outdated(self, ctxt: context.Context) -> bool:
+        context_data = self._get_context_data(ctxt)
+        return any(
+            context_data.get(key) is not value
+            for key, value in self.context_data.items()
+        )
+
+    def update_context_data(self, ctxt: context.Context) -> None:
+        self.context_data = self._get_context_data(ctxt)
+
+
+@contextlib.contextmanager
+def shared_evaluation_memo(ctxt: context.Context) -> typing.Iterator[None]:
+    """Share the conditions results of all the rules evaluated in this block."""
+    ctxt._cache["conditions_memo"] = ContextEvaluationMemo()
+    try:
+        yield
+    finally:
+        del ctxt._cache["conditions_memo"]
+
+
+def get_evaluation_memo(ctxt: context.Context) -> ContextEvaluationMemo:
+    """Return the conditions results of this pull request.
+
+    Identical conditions are evaluated only once, for all the rules inside a
+    `shared_evaluation_memo` block, or else for the rules of the same rule set.
+    The results are dropped as soon as the pull request data they come from
+    is replaced.
+    """
+    memo = ctxt._cache.get("conditions_memo")
+    if memo is None:
+        return ContextEvaluationMemo()
+    elif memo.is_outdated(ctxt):
+        memo = ctxt._cache["conditions_memo"] = ContextEvaluationMemo()
+    return memo
+
+
 RuleConditions = typing.NewType("RuleConditions", typing.List[filter.Filter])
 RuleMissingConditions = typing.NewType(
     "RuleMissingConditions", typing.List[filter.Filter]
@@ -191,6 +259,8 @@ class GenericRulesEvaluator(typing.Generic[T_Rule, T_EvaluatedRule]):
         hide_rule: bool,
     ) -> "GenericRulesEvaluator[T_Rule, T_EvaluatedRule]":
         self = cls(rules)
+        memo = get_evaluation_memo(ctxt)
+        evaluated, reused = memo.evaluated, memo.reused
         for rule in self.rules:
             ignore_rules = False
             next_conditions_to_validate = []
@@ -198,9 +268,9 @@ class GenericRulesEvaluator(typing.Generic[T_Rule, T_EvaluatedRule]):
                 for attrib in self.TEAM_ATTRIBUTES:
                     condition.value_expanders[attrib] = ctxt.resolve_teams
 
-                if not await condition(ctxt.pull_request):
+                if not await condition(ctxt.pull_request, memo):
                     next_conditions_to_validate.append(condition)
-                    if condition.attribute_name in self.BASE_ATTRIBUTES:
+                    if condition.get_attribute_name() in self.BASE_ATTRIBUTES:
                         ignore_rules = True
 
             if ignore_rules and hide_rule:
@@ -215,6 +285,10 @@ class GenericRulesEvaluator(typing.Generic[T_Rule, T_EvaluatedRule]):
                         rule, RuleMissingConditions(next_conditions_to_validate)
                     )
                 )
+
+        memo.update_context_data(ctxt)
+        statsd.increment("engine.conditions.evaluated", memo.evaluated - evaluated)
+        statsd.increment("engine.conditions.reused", memo.reused - reused)
         return self
 
 
@@ -351,6 +425,17 @@ DefaultsSchema = {
 }
 
 
+def InternConditions(v):
+    # NOTE(sileht): identical conditions of all rules share the same Filter
+    interned: typing.Dict[filter.TreeKeyT, filter.Filter] = {}
+    for rule in itertools.chain(v["pull_request_rules"], v["queue_rules"]):
+        rule.conditions[:] = [
+            interned.setdefault(condition.key, condition)
+            for condition in rule.conditions
+        ]
+    return v
+
+
 def FullifyPullRequestRules(v):
     try:
         for pr_rule in v["pull_request_rules"]:
@@ -372,6 +457,7 @@ UserConfigurationSchema = voluptuous.Schema(
             voluptuous.Required("defaults", default={}): DefaultsSchema,
         },
         voluptuous.Coerce(FullifyPullRequestRules),
+        voluptuous.Coerce(InternConditions),
     )
 )
 
@@ -433,6 +519,17 @@ class MergifyConfig(typing.TypedDict):
     defaults: Defaults
 
 
+def get_attributes(
+    *rules: typing.Union[PullRequestRules, QueueRules]
+) -> typing.Set[str]:
+    """Return the names of the pull request attributes used by these rules."""
+    return {
+        condition.get_attribute_name()
+        for rule in itertools.chain.from_iterable(rules)
+        for condition in rule.conditions
+    }
+
+
 def merge_config(config: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
     if defaults := config.get("defaults"):
         if defaults_actions := defaults.get("actions"):
@@ -448,9 +545,9 @@ def merge_config(config: typing.Dict[str, typing.Any]) -> typing.Dict[str, typin
     return config
 
 
-def get_mergify_config(
+def _get_merged_config(
     config_file: context.MergifyConfigFile,
-) -> MergifyConfig:
+) -> typing.Dict[str, typing.Any]:
     try:
         config = YamlSchema(config_file["decoded_content"])
     except voluptuous.Invalid as e:
@@ -461,9 +558,78 @@ def get_mergify_config(
     except voluptuous.Invalid as e:
         raise InvalidRules(e, config_file["path"])
 
-    merged_config = merge_config(config)
+    return merge_config(config)
+
 
+def _build_mergify_config(
+    merged_config: typing.Dict[str, typing.Any], path: str
+) -> MergifyConfig:
     try:
         return typing.cast(MergifyConfig, UserConfigurationSchema(merged_config))
     except voluptuous.Invalid as e:
-        raise InvalidRules(e, config_file["path"])
+        raise InvalidRules(e, path)
+
+
+def get_mergify_config(
+    config_file: context.MergifyConfigFile,
+) -> MergifyConfig:
+    return _build_mergify_config(_get_merged_config(config_file), config_file["path"])
+
+
+def _get_mergify_config_cache_key(sha: github_types.SHAType) -> str:
+    return f"mergify-config~{MERGIFY_CONFIG_CACHE_VERSION}~{sha}"
+
+
+async def get_cached_mergify_config(
+    redis: utils.RedisCache,
+    config_file: context.MergifyConfigFile,
+) -> MergifyConfig:
+    """Same as get_mergify_config(), cached by the git blob sha of the file.
+
+    Each call returns its own copy of the configuration, so the caller can
+    modify it.
+    """
+    sha = config_file["sha"]
+    mergify_config = _MERGIFY_CONFIG_CACHE.get(sha)
+    if mergify_config is not None:
+        statsd.increment("engine.mergify_config.cache.hit", tags=["cache:process"])
+        return copy.deepcopy(mergify_config)
+
+    # NOTE(sileht): Redis only stores the validated YAML with the defaults
+    # merged, so nothing read from it is executed. The objects are rebuilt
+    # from it, which is still much faster than parsing the YAML.
+    cache_key = _get_mergify_config_cache_key(sha)
+    cached = await redis.get(cache_key)
+    if cached is not None:
+        statsd.increment("engine.mergify_config.cache.hit", tags=["cache:redis"])
+        merged_config = json.loads(zlib.decompress(base64.b64decode(cached)))
+        mergify_config = _build_mergify_config(merged_config, config_file["path"])
+        _MERGIFY_CONFIG_CACHE[sha] = mergify_config
+        return copy.deepcopy(mergify_config)
+
+    statsd.increment("engine.mergify_config.cache.miss")
+    # NOTE(sileht): invalid configurations are not cached, the error is
+    # reported with the path of the file that may differ for the same sha
+    merged_config = _get_merged_config(config_file)
+    mergify_config = _build_mergify_config(merged_config, config_file["path"])
+    _MERGIFY_CONFIG_CACHE[sha] = mergify_config
+
+    try:
+        data = json.dumps(merged_config).encode()
+    except (TypeError, ValueError):
+        # NOTE(sileht): YAML types unknown to JSON, e.g. dates, it's only
+        # cached by this process
+        pass
+    else:
+        # TODO(sileht): move to msgpack when we remove redis-cache connection
+        # from decode_responses=True (eg: MRGFY-285)
+        await redis.set(
+            cache_key,
+            base64.b64encode(zlib.compress(data)).decode(),
+            ex=MERGIFY_CONFIG_CACHE_EXPIRATION,
+        )
+    return copy.deepcopy(mergify_config)
+
+
+def clear_mergify_config_cache() -> None:
+    _MERGIFY_CONFIG_CACHE.clear()
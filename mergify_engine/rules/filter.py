@@ -86,6 +86,26 @@ class GetAttrObject(typing.Protocol):
 
 GetAttrObjectT = typing.TypeVar("GetAttrObjectT", bound=GetAttrObject)
 
+TreeKeyT = typing.Tuple[typing.Any, ...]
+
+
+def get_tree_key(tree: TreeT) -> TreeKeyT:
+    """Return a hashable key, identical for identical trees."""
+    operator_name, nodes = list(tree.items())[0]
+    if operator_name in Filter.unary_operators:
+        return (operator_name, get_tree_key(typing.cast(TreeT, nodes)))
+    nodes = typing.cast(TreeBinaryLeafT, nodes)
+    return (operator_name, nodes[0], repr(nodes[1]))
+
+
+@dataclasses.dataclass
+class EvaluationMemo:
+    """Results of the (sub)trees already evaluated against the same object."""
+
+    results: typing.Dict[TreeKeyT, bool] = dataclasses.field(default_factory=dict)
+    evaluated: int = 0
+    reused: int = 0
+
 
 @dataclasses.dataclass(repr=False)
 class Filter:
@@ -122,13 +142,29 @@ class Filter:
     ] = dataclasses.field(default_factory=dict)
 
     _eval: typing.Callable[
-        ["Filter", GetAttrObjectT], typing.Awaitable[bool]
+        ["Filter", GetAttrObjectT, typing.Optional[EvaluationMemo]],
+        typing.Awaitable[bool],
     ] = dataclasses.field(init=False)
 
     def __post_init__(self) -> None:
         # https://github.com/python/mypy/issues/2427
         self._eval = self.build_evaluator(self.tree)  # type: ignore
 
+    def __getstate__(self) -> typing.Dict[str, typing.Any]:
+        # NOTE(sileht): the evaluator is made of closures, it's rebuilt from
+        # the tree when copied
+        state = self.__dict__.copy()
+        del state["_eval"]
+        return state
+
+    def __setstate__(self, state: typing.Dict[str, typing.Any]) -> None:
+        self.__dict__.update(state)
+        self.__post_init__()
+
+    @property
+    def key(self) -> TreeKeyT:
+        return get_tree_key(self.tree)
+
     def get_attribute_name(self):
         tree = self.tree.get("-", self.tree)
         name = list(tree.values())[0][0]
@@ -138,7 +174,7 @@ class Filter:
 
     @classmethod
     def parse(cls, string: str) -> "Filter":
-        return cls(parser.search.parseString(string, parseAll=True)[0])
+        return cls(typing.cast(TreeT, parser.parse(string)))
 
     def __str__(self):
         return self._tree_to_str(self.tree)
@@ -160,8 +196,15 @@ class Filter:
     def __repr__(self) -> str:  # pragma: no cover
         return f"{self.__class__.__name__}({str(self)})"
 
-    async def __call__(self, obj: GetAttrObjectT) -> bool:
-        return await self._eval(obj)
+    async def __call__(
+        self, obj: GetAttrObjectT, memo: typing.Optional[EvaluationMemo] = None
+    ) -> bool:
+        """Evaluate the filter against obj.
+
+        When a memo is passed, the result of each node of the tree is stored in it
+        and reused by the next filters evaluated against the same object.
+        """
+        return await self._eval(obj, memo)
 
     LENGTH_OPERATOR = "#"
 
@@ -198,9 +241,36 @@ class Filter:
 
         return self._to_list(values)
 
+    @staticmethod
+    def _memoize(
+        key: TreeKeyT,
+        evaluator: typing.Callable[
+            [GetAttrObjectT, typing.Optional[EvaluationMemo]], typing.Awaitable[bool]
+        ],
+    ) -> typing.Callable[
+        [GetAttrObjectT, typing.Optional[EvaluationMemo]], typing.Awaitable[bool]
+    ]:
+        async def _memoized(
+            obj: GetAttrObjectT, memo: typing.Optional[EvaluationMemo]
+        ) -> bool:
+            if memo is None:
+                return await evaluator(obj, memo)
+            try:
+                result = memo.results[key]
+            except KeyError:
+                result = memo.results[key] = await evaluator(obj, memo)
+                memo.evaluated += 1
+            else:
+                memo.reused += 1
+            return result
+
+        return _memoized
+
     def build_evaluator(
         self, tree: TreeT
-    ) -> typing.Callable[[GetAttrObjectT], typing.Awaitable[bool]]:
+    ) -> typing.Callable[
+        [GetAttrObjectT, typing.Optional[EvaluationMemo]], typing.Awaitable[bool]
+    ]:
         if len(tree) != 1:
             raise ParseError(tree)
         operator_name, nodes = list(tree.items())[0]
@@ -239,15 +309,19 @@ class Filter:
                     for ref_value in ref_values_expanded
                 )
 
-            async def _op(obj: GetAttrObjectT) -> bool:
+            async def _op(
+                obj: GetAttrObjectT, memo: typing.Optional[EvaluationMemo]
+            ) -> bool:
                 return await _cmp(await self._get_attribute_values(obj, attribute_name))
 
-            return _op
+            return self._memoize(get_tree_key(tree), _op)
 
         nodes = typing.cast(TreeT, nodes)
         element = self.build_evaluator(nodes)
 
-        async def _unary_op(values: GetAttrObjectT) -> bool:
-            return unary_op(await element(values))
+        async def _unary_op(
+            values: GetAttrObjectT, memo: typing.Optional[EvaluationMemo]
+        ) -> bool:
+            return unary_op(await element(values, memo))
 
-        return _unary_op
+        return self._memoize(get_tree_key(tree), _unary_op)
@@ -13,147 +13,334 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import dataclasses
+import re
 import typing
 
-import pyparsing
 
+# NOTE(sileht): This parser accepts exactly what the pyparsing grammar used to
+# accept, including its oddities (e.g.: whitespaces are skipped before
+# operators and logins, but are part of texts and regexps)
 
-git_branch = pyparsing.CharsNotIn("~^: []\\")
-regexp = pyparsing.CharsNotIn("")
-integer = pyparsing.Word(pyparsing.nums).setParseAction(lambda toks: int(toks[0]))
-github_login = pyparsing.Word(pyparsing.alphanums + "-[]")
-github_team = pyparsing.Combine(
-    pyparsing.Literal("@") + github_login + pyparsing.Literal("/") + github_login
-) | pyparsing.Combine(pyparsing.Literal("@") + github_login)
-text = (
-    pyparsing.QuotedString('"') | pyparsing.QuotedString("'") | pyparsing.CharsNotIn("")
+WHITESPACES = " \n\r"
+
+NEGATIONS = {"-": True, "¬": True, "+": False}
+
+# NOTE(sileht): the order matters, the first matching operator wins, so `==`
+# is never matched and `base==foo` means `base` equals `=foo`
+SIMPLE_OPERATORS = (
+    (":", "="),
+    ("=", "="),
+    ("==", "="),
+    ("!=", "!="),
+    ("≠", "!="),
+    (">=", ">="),
+    ("≥", ">="),
+    ("<=", "<="),
+    ("≤", "<="),
+    ("<", "<"),
+    (">", ">"),
 )
-milestone = pyparsing.CharsNotIn(" ")
-
-regex_operators = pyparsing.Literal("~=")
-
-simple_operators = (
-    pyparsing.Literal(":").setParseAction(pyparsing.replaceWith("="))
-    | pyparsing.Literal("=")
-    | pyparsing.Literal("==").setParseAction(pyparsing.replaceWith("="))
-    | pyparsing.Literal("!=")
-    | pyparsing.Literal("≠").setParseAction(pyparsing.replaceWith("!="))
-    | pyparsing.Literal(">=")
-    | pyparsing.Literal("≥").setParseAction(pyparsing.replaceWith(">="))
-    | pyparsing.Literal("<=")
-    | pyparsing.Literal("≤").setParseAction(pyparsing.replaceWith("<="))
-    | pyparsing.Literal("<")
-    | pyparsing.Literal(">")
+REGEX_OPERATOR = "~="
+
+GIT_BRANCH_RE = re.compile(r"[^~^: \[\]\\]+")
+GITHUB_LOGIN_RE = re.compile(r"[a-zA-Z0-9\-\[\]]+")
+INTEGER_RE = re.compile(r"[0-9]+")
+MILESTONE_RE = re.compile(r"[^ ]+")
+QUOTED_STRING_RES = (
+    re.compile(r'"[^"\n\r]*"'),
+    re.compile(r"'[^'\n\r]*'"),
 )
+ESCAPED_WHITESPACES = ((r"\t", "\t"), (r"\n", "\n"), (r"\f", "\f"), (r"\r", "\r"))
 
 
-def _match_boolean(literal: str) -> pyparsing.Token:
-    return (
-        literal
-        + pyparsing.Empty().setParseAction(pyparsing.replaceWith("="))
-        + pyparsing.Empty().setParseAction(pyparsing.replaceWith(True))
-    )
+class ConditionParsingError(Exception):
+    def __init__(self, string: str, loc: int, msg: str) -> None:
+        super().__init__(string, loc, msg)
+        self.string = string
+        self.loc = loc
+        self.msg = msg
 
+    @property
+    def lineno(self) -> int:
+        return self.string.count("\n", 0, self.loc) + 1
 
-match_integer = simple_operators + integer
+    @property
+    def column(self) -> int:
+        if 0 < self.loc < len(self.string) and self.string[self.loc - 1] == "\n":
+            return 1
+        return self.loc - self.string.rfind("\n", 0, self.loc)
 
+    def __str__(self) -> str:
+        if self.loc >= len(self.string):
+            found = ", found end of text"
+        else:
+            found = f", found {self.string[self.loc]!r}".replace("\\\\", "\\")
+        return (
+            f"{self.msg}{found}  (at char {self.loc}), "
+            f"(line:{self.lineno}, col:{self.column})"
+        )
 
-def _match_with_operator(token: pyparsing.Token) -> pyparsing.Token:
-    return (simple_operators + token) | (regex_operators + regexp)
 
+@dataclasses.dataclass
+class _Failure:
+    loc: int
+    msg: str
 
-def _token_to_dict(
-    s: str, loc: int, toks: typing.List[pyparsing.Token]
-) -> typing.Dict[str, typing.Any]:
-    if len(toks) == 5:
-        # quantifiable_attributes
-        not_, key_op, key, op, value = toks
-    elif len(toks) == 4:
-        # non_quantifiable_attributes
-        key_op = ""
-        not_, key, op, value = toks
+
+ValueT = typing.Union[str, int, bool]
+MatchT = typing.Union[typing.Tuple[str, ValueT, int], _Failure]
+ValueParserT = typing.Callable[
+    [str, int], typing.Union[typing.Tuple[ValueT, int], _Failure]
+]
+
+
+def _skip_whitespaces(string: str, loc: int) -> int:
+    while loc < len(string) and string[loc] in WHITESPACES:
+        loc += 1
+    return loc
+
+
+def _furthest(*failures: _Failure) -> _Failure:
+    # NOTE(sileht): like pyparsing, report the alternative that went the
+    # furthest, the first one on tie
+    return max(failures, key=lambda f: f.loc)
+
+
+def _parse_regex(
+    regex: typing.Pattern[str], msg: str, skip_whitespaces: bool
+) -> ValueParserT:
+    def _parse(
+        string: str, loc: int
+    ) -> typing.Union[typing.Tuple[ValueT, int], _Failure]:
+        if skip_whitespaces:
+            loc = _skip_whitespaces(string, loc)
+        m = regex.match(string, loc)
+        if m is None:
+            return _Failure(loc, msg)
+        return m.group(), m.end()
+
+    return _parse
+
+
+_parse_git_branch = _parse_regex(GIT_BRANCH_RE, "Expected branch name", False)
+_parse_github_login = _parse_regex(GITHUB_LOGIN_RE, "Expected login", True)
+_parse_milestone = _parse_regex(MILESTONE_RE, "Expected milestone", False)
+
+
+def _parse_until_end(msg: str) -> ValueParserT:
+    def _parse(
+        string: str, loc: int
+    ) -> typing.Union[typing.Tuple[ValueT, int], _Failure]:
+        if loc >= len(string):
+            return _Failure(loc, msg)
+        return string[loc:], len(string)
+
+    return _parse
+
+
+_parse_regexp = _parse_until_end("Expected regular expression")
+_parse_raw_text = _parse_until_end("Expected text")
+
+
+def _parse_integer(
+    string: str, loc: int
+) -> typing.Union[typing.Tuple[ValueT, int], _Failure]:
+    loc = _skip_whitespaces(string, loc)
+    m = INTEGER_RE.match(string, loc)
+    if m is None:
+        return _Failure(loc, "Expected integer")
+    return int(m.group()), m.end()
+
+
+def _parse_text(
+    string: str, loc: int
+) -> typing.Union[typing.Tuple[ValueT, int], _Failure]:
+    quoted_loc = _skip_whitespaces(string, loc)
+    for regex in QUOTED_STRING_RES:
+        m = regex.match(string, quoted_loc)
+        if m is not None:
+            value = m.group()[1:-1]
+            if "\\" in value:
+                for escaped, whitespace in ESCAPED_WHITESPACES:
+                    value = value.replace(escaped, whitespace)
+            return value, m.end()
+    return _parse_raw_text(string, loc)
+
+
+def _parse_github_team(
+    string: str, loc: int
+) -> typing.Union[typing.Tuple[ValueT, int], _Failure]:
+    loc = _skip_whitespaces(string, loc)
+    if not string.startswith("@", loc):
+        return _Failure(loc, "Expected team")
+    m = GITHUB_LOGIN_RE.match(string, loc + 1)
+    if m is None:
+        return _Failure(loc + 1, "Expected team")
+    end = m.end()
+    if string.startswith("/", end):
+        m = GITHUB_LOGIN_RE.match(string, end + 1)
+        if m is not None:
+            return string[loc : m.end()], m.end()
+    return string[loc:end], end
+
+
+def _parse_simple_operator(
+    string: str, loc: int
+) -> typing.Union[typing.Tuple[str, int], _Failure]:
+    loc = _skip_whitespaces(string, loc)
+    for operator, normalized in SIMPLE_OPERATORS:
+        if string.startswith(operator, loc):
+            return normalized, loc + len(operator)
+    return _Failure(loc, "Expected operator")
+
+
+def _match_simple_operator(string: str, loc: int, parse_value: ValueParserT) -> MatchT:
+    operator = _parse_simple_operator(string, loc)
+    if isinstance(operator, _Failure):
+        return operator
+    value = parse_value(string, operator[1])
+    if isinstance(value, _Failure):
+        return value
+    return operator[0], value[0], value[1]
+
+
+def _match_regex_operator(string: str, loc: int) -> MatchT:
+    loc = _skip_whitespaces(string, loc)
+    if not string.startswith(REGEX_OPERATOR, loc):
+        return _Failure(loc, "Expected operator")
+    value = _parse_regexp(string, loc + len(REGEX_OPERATOR))
+    if isinstance(value, _Failure):
+        return value
+    return REGEX_OPERATOR, value[0], value[1]
+
+
+def _match_with_operator(
+    parse_value: ValueParserT,
+) -> typing.Callable[[str, int], MatchT]:
+    def _match(string: str, loc: int) -> MatchT:
+        simple = _match_simple_operator(string, loc, parse_value)
+        if not isinstance(simple, _Failure):
+            return simple
+        regex = _match_regex_operator(string, loc)
+        if not isinstance(regex, _Failure):
+            return regex
+        return _furthest(simple, regex)
+
+    return _match
+
+
+def _match_integer(string: str, loc: int) -> MatchT:
+    return _match_simple_operator(string, loc, _parse_integer)
+
+
+_match_login = _match_with_operator(_parse_github_login)
+
+
+def _match_login_or_teams(string: str, loc: int) -> MatchT:
+    login = _match_login(string, loc)
+    if not isinstance(login, _Failure):
+        return login
+    team = _match_simple_operator(string, loc, _parse_github_team)
+    if not isinstance(team, _Failure):
+        return team
+    return _furthest(login, team)
+
+
+_match_git_branch = _match_with_operator(_parse_git_branch)
+_match_text = _match_with_operator(_parse_text)
+_match_milestone = _match_with_operator(_parse_milestone)
+
+QUANTIFIABLE_ATTRIBUTES: typing.Dict[str, typing.Callable[[str, int], MatchT]] = {
+    "head": _match_git_branch,
+    "base": _match_git_branch,
+    "author": _match_login_or_teams,
+    "merged-by": _match_login_or_teams,
+    "body": _match_text,
+    "assignee": _match_login_or_teams,
+    "label": _match_text,
+    "title": _match_text,
+    "files": _match_text,
+    "milestone": _match_milestone,
+    "number": _match_integer,
+    "review-requested": _match_login_or_teams,
+    "approved-reviews-by": _match_login_or_teams,
+    "dismissed-reviews-by": _match_login_or_teams,
+    "changes-requested-reviews-by": _match_login_or_teams,
+    "commented-reviews-by": _match_login_or_teams,
+    "status-success": _match_text,
+    "status-neutral": _match_text,
+    "status-failure": _match_text,
+    "check-success": _match_text,
+    "check-neutral": _match_text,
+    "check-failure": _match_text,
+}
+
+NON_QUANTIFIABLE_ATTRIBUTES = ("locked", "closed", "conflict", "draft", "merged")
+
+
+def _match_quantifiable_attribute(
+    string: str, loc: int
+) -> typing.Union[typing.Tuple[str, str, ValueT, int], _Failure]:
+    loc = _skip_whitespaces(string, loc)
+    if string.startswith("#", loc):
+        key_op = "#"
+        loc = _skip_whitespaces(string, loc + 1)
     else:
-        raise RuntimeError("unexpected search parser format")
+        key_op = ""
 
-    if key_op == "#":
-        value = int(value)
-    d = {op: (key_op + key, value)}
-    if not_:
-        return {"-": d}
-    return d
+    for attribute, match in QUANTIFIABLE_ATTRIBUTES.items():
+        if string.startswith(attribute, loc):
+            result = match(string, loc + len(attribute))
+            if isinstance(result, _Failure):
+                return result
+            operator, value, end = result
+            return key_op + attribute, operator, value, end
+    return _Failure(loc, "Expected attribute")
 
 
-_match_login_or_teams = _match_with_operator(github_login) | (
-    simple_operators + github_team
-)
+def _match_non_quantifiable_attribute(
+    string: str, loc: int
+) -> typing.Union[typing.Tuple[str, str, ValueT, int], _Failure]:
+    for attribute in NON_QUANTIFIABLE_ATTRIBUTES:
+        if string.startswith(attribute, loc):
+            return attribute, "=", True, loc + len(attribute)
+    return _Failure(loc, "Expected attribute")
 
-head = "head" + _match_with_operator(git_branch)
-base = "base" + _match_with_operator(git_branch)
-author = "author" + _match_login_or_teams
-merged_by = "merged-by" + _match_login_or_teams
-body = "body" + _match_with_operator(text)
-assignee = "assignee" + _match_login_or_teams
-label = "label" + _match_with_operator(text)
-title = "title" + _match_with_operator(text)
-files = "files" + _match_with_operator(text)
-milestone = "milestone" + _match_with_operator(milestone)
-number = "number" + match_integer
-review_requests = "review-requested" + _match_login_or_teams
-review_approved_by = "approved-reviews-by" + _match_login_or_teams
-review_dismissed_by = "dismissed-reviews-by" + _match_login_or_teams
-review_changes_requested_by = "changes-requested-reviews-by" + _match_login_or_teams
-review_commented_by = "commented-reviews-by" + _match_login_or_teams
-status_success = "status-success" + _match_with_operator(text)
-status_failure = "status-failure" + _match_with_operator(text)
-status_neutral = "status-neutral" + _match_with_operator(text)
-check_success = "check-success" + _match_with_operator(text)
-check_failure = "check-failure" + _match_with_operator(text)
-check_neutral = "check-neutral" + _match_with_operator(text)
-
-quantifiable_attributes = (
-    head
-    | base
-    | author
-    | merged_by
-    | body
-    | assignee
-    | label
-    | title
-    | files
-    | milestone
-    | number
-    | review_requests
-    | review_approved_by
-    | review_dismissed_by
-    | review_changes_requested_by
-    | review_commented_by
-    | status_success
-    | status_neutral
-    | status_failure
-    | check_success
-    | check_neutral
-    | check_failure
-)
 
-locked = _match_boolean("locked")
-merged = _match_boolean("merged")
-closed = _match_boolean("closed")
-conflict = _match_boolean("conflict")
-draft = _match_boolean("draft")
-
-non_quantifiable_attributes = locked | closed | conflict | draft | merged
-
-search = (
-    pyparsing.Optional(
-        (
-            pyparsing.Literal("-").setParseAction(pyparsing.replaceWith(True))
-            | pyparsing.Literal("¬").setParseAction(pyparsing.replaceWith(True))
-            | pyparsing.Literal("+").setParseAction(pyparsing.replaceWith(False))
-        ),
-        default=False,
-    )
-    + (
-        (pyparsing.Optional("#", default="") + quantifiable_attributes)
-        | non_quantifiable_attributes
-    )
-).setParseAction(_token_to_dict)
+def parse(string: str) -> typing.Dict[str, typing.Any]:
+    """Parse a condition into its filter tree.
+
+    :raise ConditionParsingError: if the condition is invalid.
+    :raise ValueError: if a `#attribute` is not compared to an integer.
+    """
+    # NOTE(sileht): pyparsing did that, positions of errors depend on it
+    string = string.expandtabs()
+
+    loc = _skip_whitespaces(string, 0)
+    if loc < len(string) and string[loc] in NEGATIONS:
+        not_ = NEGATIONS[string[loc]]
+        loc = _skip_whitespaces(string, loc + 1)
+    else:
+        not_ = False
+
+    quantifiable = _match_quantifiable_attribute(string, loc)
+    if isinstance(quantifiable, _Failure):
+        non_quantifiable = _match_non_quantifiable_attribute(string, loc)
+        if isinstance(non_quantifiable, _Failure):
+            failure = _furthest(quantifiable, non_quantifiable)
+            raise ConditionParsingError(string, failure.loc, failure.msg)
+        attribute, operator, value, loc = non_quantifiable
+    else:
+        attribute, operator, value, loc = quantifiable
+        if attribute.startswith("#"):
+            value = int(value)
+
+    loc = _skip_whitespaces(string, loc)
+    if loc < len(string):
+        raise ConditionParsingError(string, loc, "Expected end of text")
+
+    tree: typing.Dict[str, typing.Any] = {operator: (attribute, value)}
+    if not_:
+        return {"-": tree}
+    return tree
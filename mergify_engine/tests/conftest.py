@@ -7,8 +7,10 @@ from pytest_httpserver import httpserver
 
 from mergify_engine import config
 from mergify_engine import logs
+from mergify_engine import rules
 from mergify_engine import utils
 from mergify_engine.clients import github
+from mergify_engine.clients import http
 
 
 @pytest.fixture()
@@ -33,6 +35,18 @@ def setup_new_event_loop() -> None:
     asyncio.set_event_loop(asyncio.new_event_loop())
 
 
+@pytest.fixture(autouse=True)
+def reset_circuit_breakers() -> None:
+    # circuit breakers are shared by the process, don't leak them between tests
+    http.reset_circuit_breakers()
+
+
+@pytest.fixture(autouse=True)
+def clear_mergify_config_cache() -> None:
+    # parsed configurations are shared by the process, don't leak them between tests
+    rules.clear_mergify_config_cache()
+
+
 @pytest.fixture()
 async def redis_cache() -> typing.AsyncGenerator[utils.RedisCache, None]:
     async with utils.aredis_for_cache() as client:
@@ -38,6 +38,7 @@ from mergify_engine import config
 from mergify_engine import context
 from mergify_engine import duplicate_pull
 from mergify_engine import engine
+from mergify_engine import github_events
 from mergify_engine import gitter
 from mergify_engine import subscription
 from mergify_engine import user_tokens
@@ -322,6 +323,26 @@ class FunctionalTestBase(unittest.IsolatedAsyncioTestCase):
             ),
         )
 
+        # NOTE(sileht): cassettes expect opened pull requests to be listed for
+        # each batch of events, so the indexes must always look cold
+        mock.patch.object(
+            context.Repository, "_get_opened_pulls_from_index", return_value=None
+        ).start()
+        mock.patch.object(github_events, "_update_pulls_by_sha").start()
+        # NOTE(sileht): cassettes replay the requests in the order the
+        # conditions fetched the attributes lazily
+        mock.patch.object(context.Context, "prefetch_attributes").start()
+        # NOTE(sileht): cassettes expect the configuration to be downloaded on
+        # each engine run
+        mock.patch.object(
+            context.Repository, "_get_cached_config_file", return_value=None
+        ).start()
+        # NOTE(sileht): recorded rate limit headers are not related to the replay
+        # time, don't throttle on them
+        mock.patch.object(
+            github.AsyncGithubInstallationClient, "_update_rate_limit_budget"
+        ).start()
+
         if RECORD:
             github.CachedToken.STORAGE = {}
         else:
@@ -348,9 +369,11 @@ class FunctionalTestBase(unittest.IsolatedAsyncioTestCase):
                     auth.owner = config.TESTING_ORGANIZATION
                 return auth
 
-            def github_aclient(owner_name=None, owner_id=None, auth=None):
+            def github_aclient(
+                owner_name=None, owner_id=None, auth=None, redis_cache=None
+            ):
                 return github.AsyncGithubInstallationClient(
-                    get_auth(owner_name, owner_id, auth)
+                    get_auth(owner_name, owner_id, auth), redis_cache=redis_cache
                 )
 
             mock.patch.object(github, "aget_client", github_aclient).start()
@@ -597,7 +620,12 @@ class FunctionalTestBase(unittest.IsolatedAsyncioTestCase):
 
         started_at = None
         while True:
-            if w._redis_stream is None or (await w._redis_stream.zcard("streams")) > 0:
+            if w._redis_stream is None or any(
+                [
+                    await w._redis_stream.zcard(shard_key)
+                    for shard_key in worker.get_shard_keys()
+                ]
+            ):
                 started_at = None
             elif started_at is None:
                 started_at = time.monotonic()
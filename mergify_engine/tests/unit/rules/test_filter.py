@@ -13,6 +13,9 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+
+import copy
+
 import pytest
 
 from mergify_engine.rules import filter
@@ -157,3 +160,40 @@ async def test_str() -> None:
 async def test_parser() -> None:
     for string in ("head=foobar", "-base=master", "#files>3"):
         assert string == str(filter.Filter.parse(string))
+
+
+async def test_evaluation_memo() -> None:
+    class CountingPR(FakePR):
+        reads = 0
+
+        def __getattr__(self, k):
+            self.reads += 1
+            return super().__getattr__(k)
+
+    pr = CountingPR({"foo": 1, "bar": "baz"})
+    memo = filter.EvaluationMemo()
+    f1 = filter.Filter({"=": ("foo", 1)})
+    f2 = filter.Filter({"-": {"=": ("foo", 1)}})
+    f3 = filter.Filter({"=": ("foo", 1)})
+    f4 = filter.Filter({"=": ("bar", "baz")})
+    assert f1.key == f3.key
+    assert f1.key != f2.key
+
+    assert await f1(pr, memo)
+    assert not await f2(pr, memo)
+    assert await f3(pr, memo)
+    assert await f4(pr, memo)
+    assert pr.reads == 2
+    assert memo.evaluated == 3
+    assert memo.reused == 2
+
+    # Without memo, everything is evaluated
+    assert await f1(pr)
+    assert pr.reads == 3
+
+
+async def test_deepcopy() -> None:
+    f = copy.deepcopy(filter.Filter.parse("-head~=^foo"))
+    assert str(f) == "-head~=^foo"
+    assert await f(FakePR({"head": "bar"}))
+    assert not await f(FakePR({"head": "foobar"}))
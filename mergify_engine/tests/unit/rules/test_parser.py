@@ -1,6 +1,6 @@
 # -*- encoding: utf-8 -*-
 #
-# Copyright © 2018—2020 Mergify SAS
+# Copyright © 2018—2021 Mergify SAS
 #
 # Licensed under the Apache License, Version 2.0 (the "License"); you may
 # not use this file except in compliance with the License. You may obtain
@@ -13,10 +13,19 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import itertools
+import os
+import timeit
+import typing
+
 import pyparsing
 import pytest
 
 from mergify_engine.rules import parser
+from mergify_engine.tests.unit.rules import pyparsing_grammar
+
+
+BENCHMARK = bool(os.getenv("MERGIFYENGINE_BENCHMARK", False))
 
 
 @pytest.mark.parametrize(
@@ -57,7 +66,7 @@ from mergify_engine.rules import parser
     ),
 )
 def test_search(line, result):
-    assert result == tuple(parser.search.parseString(line, parseAll=True))[0]
+    assert result == parser.parse(line)
 
 
 @pytest.mark.parametrize(
@@ -75,5 +84,147 @@ def test_search(line, result):
     ),
 )
 def test_invalid(line):
-    with pytest.raises(pyparsing.ParseException):
-        parser.search.parseString(line, parseAll=True)
+    with pytest.raises(parser.ConditionParsingError):
+        parser.parse(line)
+
+
+def test_error_message():
+    with pytest.raises(parser.ConditionParsingError) as e:
+        parser.parse("locked=1")
+    assert str(e.value) == (
+        "Expected end of text, found '='  (at char 6), (line:1, col:7)"
+    )
+
+    with pytest.raises(parser.ConditionParsingError) as e:
+        parser.parse("base = main")
+    assert str(e.value) == (
+        "Expected branch name, found ' '  (at char 6), (line:1, col:7)"
+    )
+
+
+PREFIXES = ("", "-", "¬", "+", "#", "-#", " ", " - # ", "++")
+ATTRIBUTES = (
+    "head",
+    "base",
+    "author",
+    "merged-by",
+    "body",
+    "assignee",
+    "label",
+    "title",
+    "files",
+    "milestone",
+    "number",
+    "review-requested",
+    "approved-reviews-by",
+    "dismissed-reviews-by",
+    "changes-requested-reviews-by",
+    "commented-reviews-by",
+    "status-success",
+    "status-neutral",
+    "status-failure",
+    "check-success",
+    "check-neutral",
+    "check-failure",
+    "locked",
+    "closed",
+    "conflict",
+    "draft",
+    "merged",
+    "foo",
+    "headx",
+    "",
+)
+OPERATORS = (
+    ":",
+    "=",
+    "==",
+    "!=",
+    "≠",
+    ">=",
+    "≥",
+    "<=",
+    "≤",
+    "<",
+    ">",
+    "~=",
+    " = ",
+    "=~",
+    "|",
+    "",
+)
+VALUES = (
+    "master",
+    "stable/3.1",
+    "mergify[bot]",
+    "@org",
+    "@org/team",
+    "@org/",
+    "@",
+    "3",
+    " 3 ",
+    "12abc",
+    "'quoted'",
+    '"double quoted"',
+    '"unterminated',
+    "'a' b",
+    "with spaces",
+    "a:b",
+    "^stable/",
+    "%foobar",
+    '"a\\tb"',
+    "v1 2",
+    "\ttab",
+    "a\nb",
+    "",
+)
+
+
+def _parse(
+    parse: typing.Callable[[str], typing.Any], line: str
+) -> typing.Tuple[str, typing.Any]:
+    try:
+        return "tree", parse(line)
+    except ValueError as e:
+        return "value-error", str(e)
+    except (pyparsing.ParseException, parser.ConditionParsingError) as e:
+        if e.msg.startswith("Expected end of text"):
+            return "parse-error", str(e)
+        # NOTE(sileht): pyparsing describes the whole grammar in this case
+        return "parse-error", e.loc
+
+
+def _legacy_parse(line: str) -> typing.Any:
+    return pyparsing_grammar.search.parseString(line, parseAll=True)[0]
+
+
+@pytest.mark.parametrize("prefix", PREFIXES)
+def test_same_as_pyparsing(prefix):
+    for attribute, operator, value in itertools.product(ATTRIBUTES, OPERATORS, VALUES):
+        line = prefix + attribute + operator + value
+        assert _parse(parser.parse, line) == _parse(_legacy_parse, line), line
+
+
+# NOTE(sileht): timings are not reliable under coverage, asyncio debug or a
+# busy CI, run it with `tox -e bench`
+@pytest.mark.skipif(not BENCHMARK, reason="MERGIFYENGINE_BENCHMARK is not set")
+def test_parse_benchmark():
+    lines = [
+        "base=master",
+        "-label~=^(wip|do not merge)$",
+        "#approved-reviews-by>=2",
+        "status-success='continuous-integration/travis-ci/pr'",
+        "author=@mergifyio/devs",
+        "-draft",
+    ]
+
+    def parse_all(parse):
+        return lambda: [parse(line) for line in lines]
+
+    legacy = min(timeit.repeat(parse_all(_legacy_parse), number=100, repeat=5))
+    new = min(timeit.repeat(parse_all(parser.parse), number=100, repeat=5))
+    print(
+        f"pyparsing: {legacy * 10:.3f} ms, parser: {new * 10:.3f} ms "
+        f"per {len(lines)} conditions, {legacy / new:.1f}x faster"
+    )
+    assert new * 10 < legacy
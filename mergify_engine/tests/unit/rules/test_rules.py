@@ -13,9 +13,12 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import base64
 from base64 import encodebytes
+import json
 import typing
 from unittest import mock
+import zlib
 
 import pytest
 import voluptuous
@@ -247,6 +250,66 @@ async def test_get_mergify_config(valid: str, redis_cache: utils.RedisCache) ->
     assert "pull_request_rules" in schema
 
 
+@pytest.mark.asyncio
+async def test_get_cached_mergify_config(redis_cache: utils.RedisCache) -> None:
+    config_file = context.MergifyConfigFile(
+        {
+            "type": "file",
+            "content": "",
+            "path": ".mergify.yml",
+            "sha": github_types.SHAType("azertyu"),
+            "decoded_content": b"""
+pull_request_rules:
+  - name: hello
+    conditions:
+      - base=main
+    actions:
+      comment:
+        message: hello
+""",
+        }
+    )
+
+    with mock.patch.object(
+        rules, "_get_merged_config", wraps=rules._get_merged_config
+    ) as get_merged_config:
+        config = await rules.get_cached_mergify_config(redis_cache, config_file)
+        assert get_merged_config.call_count == 1
+        config["pull_request_rules"].rules.append(mock.Mock())
+
+        # Process cache
+        cached_config = await rules.get_cached_mergify_config(redis_cache, config_file)
+        assert cached_config is not config
+        assert len(cached_config["pull_request_rules"].rules) == 1
+        assert str(cached_config["pull_request_rules"].rules[0].conditions[0]) == (
+            "base=main"
+        )
+
+        # Redis cache, only the validated YAML is stored
+        cached = await redis_cache.get("mergify-config~2~azertyu")
+        assert json.loads(zlib.decompress(base64.b64decode(cached))) == {
+            "pull_request_rules": [
+                {
+                    "name": "hello",
+                    "conditions": ["base=main"],
+                    "actions": {"comment": {"message": "hello"}},
+                }
+            ]
+        }
+        rules.clear_mergify_config_cache()
+        cached_config = await rules.get_cached_mergify_config(redis_cache, config_file)
+        assert len(cached_config["pull_request_rules"].rules) == 1
+        assert str(cached_config["pull_request_rules"].rules[0].conditions[0]) == (
+            "base=main"
+        )
+        assert get_merged_config.call_count == 1
+
+        # Another sha
+        config_file["sha"] = github_types.SHAType("qsdfghj")
+        await rules.get_cached_mergify_config(redis_cache, config_file)
+        assert get_merged_config.call_count == 2
+
+
 @pytest.mark.asyncio
 async def test_get_mergify_config_with_defaults(redis_cache: utils.RedisCache) -> None:
 
@@ -318,6 +381,12 @@ pull_request_rules:
       comment:
         message: I really love Mergify
 """
+    # NOTE(sileht): the push of the new configuration clears the cache
+    await context.Repository.clear_config_file_cache(
+        redis_cache,
+        github_types.GitHubLogin("foobar"),
+        github_types.GitHubRepositoryName("xyz"),
+    )
 
     client = mock.Mock()
     client.item.return_value = item()
@@ -396,6 +465,11 @@ async def test_get_mergify_config_location_from_cache(
         ),
     ]
     repository._cache = context.RepositoryCache()
+    await context.Repository.clear_config_file_cache(
+        redis_cache,
+        github_types.GitHubLogin("foo"),
+        github_types.GitHubRepositoryName("bar"),
+    )
     await repository.get_mergify_config_file()
     assert client.item.call_count == 1
     client.item.assert_has_calls(
@@ -1219,3 +1293,94 @@ def test_merge_config():
     merged_config = rules.merge_config(config)
 
     assert merged_config == config
+
+
+def test_identical_conditions_are_interned():
+    config = rules.UserConfigurationSchema(
+        {
+            "queue_rules": [
+                {"name": "default", "conditions": ["base=main", "label!=wip"]}
+            ],
+            "pull_request_rules": [
+                {
+                    "name": "one",
+                    "conditions": ["base=main", "label≠wip"],
+                    "actions": {},
+                },
+                {
+                    "name": "two",
+                    "conditions": ["base:main", "#approved-reviews-by>=2"],
+                    "actions": {},
+                },
+            ],
+        }
+    )
+    one, two = config["pull_request_rules"].rules
+    queue_rule = config["queue_rules"]["default"]
+    assert one.conditions[0] is two.conditions[0]
+    assert one.conditions[0] is queue_rule.conditions[0]
+    assert one.conditions[1] is queue_rule.conditions[1]
+    assert str(two.conditions[1]) == "#approved-reviews-by>=2"
+
+
+def test_get_attributes():
+    config = rules.UserConfigurationSchema(
+        {
+            "queue_rules": [{"name": "default", "conditions": ["check-success=ci"]}],
+            "pull_request_rules": [
+                {
+                    "name": "one",
+                    "conditions": ["base=main", "-label=wip"],
+                    "actions": {},
+                },
+                {
+                    "name": "two",
+                    "conditions": ["#approved-reviews-by>=2"],
+                    "actions": {},
+                },
+            ],
+        }
+    )
+    assert rules.get_attributes(config["pull_request_rules"]) == {
+        "base",
+        "label",
+        "approved-reviews-by",
+    }
+    assert rules.get_attributes(
+        config["pull_request_rules"], config["queue_rules"]
+    ) == {
+        "base",
+        "label",
+        "approved-reviews-by",
+        "check-success",
+    }
+
+
+def test_shared_evaluation_memo():
+    ctxt = mock.Mock(_cache={}, pull={"number": 1})
+
+    # Not shared outside of the block
+    assert rules.get_evaluation_memo(ctxt) is not rules.get_evaluation_memo(ctxt)
+
+    with rules.shared_evaluation_memo(ctxt):
+        memo = rules.get_evaluation_memo(ctxt)
+        memo.results[("=", "base", "'main'")] = True
+        memo.update_context_data(ctxt)
+        assert rules.get_evaluation_memo(ctxt) is memo
+
+        # New data doesn't invalidate the results
+        ctxt._cache["pull_check_runs"] = []
+        assert rules.get_evaluation_memo(ctxt) is memo
+        memo.update_context_data(ctxt)
+
+        # Replaced data does
+        ctxt._cache["pull_check_runs"] = [{"name": "ci"}]
+        new_memo = rules.get_evaluation_memo(ctxt)
+        assert new_memo is not memo
+        assert new_memo.results == {}
+        new_memo.update_context_data(ctxt)
+
+        ctxt.pull = {"number": 1}
+        assert rules.get_evaluation_memo(ctxt) is not new_memo
+
+    assert "conditions_memo" not in ctxt._cache
@@ -14,10 +14,13 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import asyncio
 import datetime
+import json
 import typing
 from unittest import mock
 
+import httpx
 import pytest
 from pytest_httpserver import httpserver
 from werkzeug.http import http_date
@@ -25,8 +28,10 @@ from werkzeug.wrappers import Response
 
 from mergify_engine import exceptions
 from mergify_engine import github_types
+from mergify_engine import utils
 from mergify_engine.clients import github
 from mergify_engine.clients import http
+from mergify_engine.clients import profiler
 
 
 async def _do_test_client_installation_token(
@@ -229,6 +234,106 @@ async def test_client_temporary_HTTP_500(httpserver: httpserver.HTTPServer) -> N
     httpserver.check_assertions()
 
 
+@pytest.mark.asyncio
+async def test_client_circuit_breaker(
+    httpserver: httpserver.HTTPServer, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(http, "CIRCUIT_BREAKER_MIN_REQUESTS", 4)
+    httpserver.expect_request("/repos/owner/repo/pulls").respond_with_data(
+        "This is an 5XX error", status=500
+    )
+    httpserver.expect_request("/repos/owner/repo").respond_with_json({"id": 1})
+
+    async with http.AsyncClient() as client:
+        # The circuit opens after 4 failures, the last retry is not sent
+        with pytest.raises(http.CircuitOpen) as exc_info:
+            await client.get(httpserver.url_for("/repos/owner/repo/pulls"))
+        assert len(httpserver.log) == 4
+        assert exc_info.value.endpoint_class == "repos/pulls"
+        assert exc_info.value.countdown.total_seconds() > 0
+
+        with pytest.raises(http.CircuitOpen):
+            await client.get(httpserver.url_for("/repos/owner/repo/pulls/1"))
+        assert len(httpserver.log) == 4
+
+        # Other endpoints are not impacted
+        await client.get(httpserver.url_for("/repos/owner/repo"))
+        assert len(httpserver.log) == 5
+
+        # Once the circuit is half-opened, a successful probe closes it
+        breaker = http.get_circuit_breaker(
+            httpx.URL(httpserver.url_for("/repos/owner/repo/pulls"))
+        )
+        breaker.opened_at -= http.CIRCUIT_BREAKER_OPEN_DURATION
+        httpserver.clear()
+        httpserver.expect_request("/repos/owner/repo/pulls").respond_with_json([])
+        await client.get(httpserver.url_for("/repos/owner/repo/pulls"))
+        assert breaker.state == "closed"
+        assert len(httpserver.log) == 1
+
+
+@pytest.mark.asyncio
+async def test_client_circuit_breaker_per_tenant(
+    httpserver: httpserver.HTTPServer, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(http, "CIRCUIT_BREAKER_MIN_REQUESTS", 4)
+    httpserver.expect_request("/repos/owner/repo/pulls").respond_with_data(
+        "This is an 5XX error", status=500
+    )
+    httpserver.expect_request("/repos/other/repo/pulls").respond_with_json([])
+
+    class TenantClient(http.AsyncClient):
+        def __init__(self, tenant: str) -> None:
+            super().__init__()
+            self.tenant = tenant
+
+        def _get_circuit_breaker_tenant(self) -> str:
+            return self.tenant
+
+    async with TenantClient("owner") as client:
+        with pytest.raises(http.CircuitOpen):
+            await client.get(httpserver.url_for("/repos/owner/repo/pulls"))
+    assert len(httpserver.log) == 4
+
+    # The circuit of another tenant on the same endpoints is still closed
+    async with TenantClient("other") as client:
+        await client.get(httpserver.url_for("/repos/other/repo/pulls"))
+    assert len(httpserver.log) == 5
+
+    url = httpx.URL(httpserver.url_for("/repos/owner/repo/pulls"))
+    assert http.get_circuit_breaker(url, "owner").state == "open"
+    assert http.get_circuit_breaker(url, "other").state == "closed"
+
+
+def test_circuit_breaker_half_open() -> None:
+    breaker = http.CircuitBreaker("api.github.com", "repos/pulls")
+    for _ in range(http.CIRCUIT_BREAKER_MIN_REQUESTS - 1):
+        breaker.record(failed=True, probe=False)
+    assert not breaker.before_request()
+    breaker.record(failed=False, probe=False)
+    with pytest.raises(http.CircuitOpen):
+        breaker.before_request()
+
+    breaker.opened_at -= http.CIRCUIT_BREAKER_OPEN_DURATION
+    assert breaker.before_request()
+    assert breaker.state == "half-open"
+    # Only one probe at a time
+    with pytest.raises(http.CircuitOpen):
+        breaker.before_request()
+    # A failing probe reopens the circuit
+    breaker.record(failed=True, probe=True)
+    with pytest.raises(http.CircuitOpen):
+        breaker.before_request()
+
+    # A cancelled probe lets another one go
+    breaker.opened_at -= http.CIRCUIT_BREAKER_OPEN_DURATION
+    assert breaker.before_request()
+    breaker.cancel_probe()
+    assert breaker.before_request()
+    breaker.record(failed=False, probe=True)
+    assert not breaker.before_request()
+
+
 @pytest.mark.asyncio
 async def test_client_connection_error() -> None:
     async with http.AsyncClient() as client:
@@ -438,3 +543,648 @@ async def test_client_abuse_403_no_header(httpserver: httpserver.HTTPServer) ->
     assert len(httpserver.log) == 3
 
     httpserver.check_assertions()
+
+
+@pytest.mark.asyncio
+async def test_client_http_cache(
+    github_server: httpserver.HTTPServer, redis_cache: utils.RedisCache
+) -> None:
+    pulls_url = "/repos/owner/repo/pulls"
+    next_url = github_server.url_for(pulls_url) + "?page=2"
+    github_server.expect_oneshot_request(
+        pulls_url, query_string="per_page=2"
+    ).respond_with_json(
+        [{"number": 1}, {"number": 2}],
+        headers={"ETag": '"page1"', "Link": f'<{next_url}>; rel="next"'},
+    )
+    github_server.expect_oneshot_request(
+        pulls_url, query_string="page=2"
+    ).respond_with_json(
+        [{"number": 3}],
+        headers={"Last-Modified": http_date(datetime.datetime(2021, 1, 1))},
+    )
+    github_server.expect_oneshot_request(
+        pulls_url,
+        query_string="per_page=2",
+        headers={"If-None-Match": '"page1"'},
+    ).respond_with_response(Response(status=304))
+    github_server.expect_oneshot_request(
+        pulls_url,
+        query_string="page=2",
+        headers={"If-Modified-Since": http_date(datetime.datetime(2021, 1, 1))},
+    ).respond_with_response(Response(status=304))
+
+    for _ in range(2):
+        async with github.aget_client(
+            github_types.GitHubLogin("owner"), redis_cache=redis_cache
+        ) as client:
+            pulls = [p async for p in client.items(pulls_url, per_page=2)]
+        assert pulls == [{"number": 1}, {"number": 2}, {"number": 3}]
+
+    github_server.check_assertions()
+    assert [r.status_code for q, r in github_server.log if q.path == pulls_url] == [
+        200,
+        200,
+        304,
+        304,
+    ]
+
+    # Requests done with a user token are not cached
+    github_server.expect_oneshot_request("/").respond_with_json({})
+    github_server.expect_oneshot_request(pulls_url).respond_with_json(
+        [], headers={"ETag": '"user"'}
+    )
+    async with github.aget_client(
+        github_types.GitHubLogin("owner"), redis_cache=redis_cache
+    ) as client:
+        await client.get("/")
+        assert [
+            p async for p in client.items(pulls_url, oauth_token="<user-token>")
+        ] == []
+    assert len(await redis_cache.keys("http-cache~*")) == 2
+
+
+@pytest.mark.asyncio
+async def test_client_items_prefetch_pages(
+    github_server: httpserver.HTTPServer,
+) -> None:
+    url = "/repos/owner/repo/pulls"
+
+    def page_url(page: int) -> str:
+        return f"{github_server.url_for(url)}?per_page=2&page={page}"
+
+    for page in range(1, 5):
+        links = [f'<{page_url(4)}>; rel="last"']
+        if page < 4:
+            links.append(f'<{page_url(page + 1)}>; rel="next"')
+        github_server.expect_oneshot_request(
+            url,
+            query_string="per_page=2" if page == 1 else f"per_page=2&page={page}",
+        ).respond_with_json(
+            [{"number": page * 2 - 1}, {"number": page * 2}],
+            headers={"Link": ", ".join(links), "X-RateLimit-Remaining": "5000"},
+        )
+
+    async with github.aget_client(github_types.GitHubLogin("owner")) as client:
+        pulls = [p["number"] async for p in client.items(url, per_page=2)]
+    assert pulls == list(range(1, 9))
+    github_server.check_assertions()
+
+    github_server.expect_oneshot_request(url).respond_with_json(
+        [],
+        headers={"Link": f'<{github_server.url_for(url)}?page=101>; rel="last"'},
+    )
+    async with github.aget_client(github_types.GitHubLogin("owner")) as client:
+        with pytest.raises(github.TooManyPages):
+            [p async for p in client.items(url)]
+
+
+@pytest.mark.asyncio
+async def test_client_items_fields(
+    github_server: httpserver.HTTPServer,
+) -> None:
+    github_server.expect_request("/repos/owner/repo/pulls").respond_with_json(
+        [
+            {"number": 1, "title": "a", "head": {"sha": "aaa", "ref": "a"}},
+            {"number": 2, "title": "b", "head": {"sha": "bbb", "ref": "b"}},
+        ]
+    )
+    github_server.expect_request(
+        "/repos/owner/repo/commits/aaa/check-runs"
+    ).respond_with_json(
+        {
+            "total_count": 1,
+            "check_runs": [{"name": "ci", "conclusion": None, "pull_requests": []}],
+        }
+    )
+
+    async with github.aget_client(github_types.GitHubLogin("owner")) as client:
+        assert [
+            p
+            async for p in client.items(
+                "/repos/owner/repo/pulls", fields=("number", "head.sha")
+            )
+        ] == [
+            {"number": 1, "head": {"sha": "aaa"}},
+            {"number": 2, "head": {"sha": "bbb"}},
+        ]
+        assert [
+            c
+            async for c in client.items(
+                "/repos/owner/repo/commits/aaa/check-runs",
+                list_items="check_runs",
+                fields=("name", "conclusion"),
+            )
+        ] == [{"name": "ci", "conclusion": None}]
+
+
+@pytest.mark.parametrize(
+    "remaining, expected",
+    ((None, github.ITEMS_PREFETCH_MAX_PAGES), ("5000", 5), ("250", 2), ("10", 1)),
+)
+def test_client_items_prefetch_pages_rate_limit(
+    remaining: typing.Optional[str], expected: int
+) -> None:
+    headers = {} if remaining is None else {"X-RateLimit-Remaining": remaining}
+    response = httpx.Response(200, headers=headers)
+    assert (
+        github.AsyncGithubInstallationClient._get_prefetch_pages(response) == expected
+    )
+
+
+@pytest.mark.asyncio
+async def test_client_graphql(github_server: httpserver.HTTPServer) -> None:
+    github_server.expect_oneshot_request(
+        "/graphql",
+        method="POST",
+        json={"query": "query { viewer { login } }", "variables": {}},
+    ).respond_with_json({"data": {"viewer": {"login": "mergify"}}})
+    github_server.expect_oneshot_request(
+        "/graphql",
+        method="POST",
+        json={"query": "query { nope }", "variables": {"owner": "owner"}},
+    ).respond_with_json({"data": None, "errors": [{"message": "nope"}]})
+
+    async with github.aget_client(github_types.GitHubLogin("owner")) as client:
+        assert await client.graphql("query { viewer { login } }") == {
+            "viewer": {"login": "mergify"}
+        }
+        with pytest.raises(github.GraphQLError) as e:
+            await client.graphql("query { nope }", owner="owner")
+        assert e.value.errors == [{"message": "nope"}]
+
+    github_server.check_assertions()
+
+
+@pytest.mark.asyncio
+async def test_client_rate_limit_budget(
+    github_server: httpserver.HTTPServer, redis_cache: utils.RedisCache
+) -> None:
+    reset = int(utils.utcnow().timestamp()) + 3600
+    github_server.expect_oneshot_request("/").respond_with_json(
+        {},
+        headers={
+            "X-RateLimit-Remaining": "500",
+            "X-RateLimit-Limit": "5000",
+            "X-RateLimit-Reset": str(reset),
+        },
+    )
+    github_server.expect_oneshot_request("/").respond_with_json(
+        {},
+        headers={
+            "X-RateLimit-Remaining": "10",
+            "X-RateLimit-Limit": "5000",
+            "X-RateLimit-Reset": str(reset),
+        },
+    )
+
+    async with github.aget_client(
+        github_types.GitHubLogin("owner"), redis_cache=redis_cache
+    ) as client:
+        await client.get("/")
+        assert await redis_cache.hgetall("rate-limit-budget~owner~core") == {
+            "remaining": "500",
+            "limit": "5000",
+            "reset": str(reset),
+        }
+        assert 3500 < await redis_cache.ttl("rate-limit-budget~owner~core") <= 3600
+
+        # Low priority requests are deferred, others are still sent
+        with github.low_priority():
+            with pytest.raises(exceptions.RateLimited) as e:
+                await client.get("/")
+        assert e.value.remaining == 500
+        await client.get("/")
+
+    async with github.aget_client(
+        github_types.GitHubLogin("owner"), redis_cache=redis_cache
+    ) as client:
+        # The budget is shared by all clients of the installation
+        with pytest.raises(exceptions.RateLimited) as e:
+            await client.get("/")
+        assert e.value.remaining == 10
+        assert datetime.timedelta(minutes=59) < e.value.countdown
+
+    github_server.check_assertions()
+    assert len([r for r, _ in github_server.log if r.path == "/"]) == 2
+
+
+@pytest.mark.asyncio
+async def test_client_rate_limit_budget_per_resource(
+    github_server: httpserver.HTTPServer, redis_cache: utils.RedisCache
+) -> None:
+    reset = int(utils.utcnow().timestamp()) + 3600
+    github_server.expect_oneshot_request("/").respond_with_json(
+        {},
+        headers={
+            "X-RateLimit-Remaining": "4000",
+            "X-RateLimit-Limit": "5000",
+            "X-RateLimit-Reset": str(reset),
+            "X-RateLimit-Resource": "core",
+        },
+    )
+    github_server.expect_request("/graphql", method="POST").respond_with_json(
+        {"data": {}},
+        headers={
+            "X-RateLimit-Remaining": "10",
+            "X-RateLimit-Limit": "5000",
+            "X-RateLimit-Reset": str(reset),
+            "X-RateLimit-Resource": "graphql",
+        },
+    )
+    github_server.expect_oneshot_request("/after").respond_with_json({})
+
+    async with github.aget_client(
+        github_types.GitHubLogin("owner"), redis_cache=redis_cache
+    ) as client:
+        await client.get("/")
+        await client.graphql("query { viewer { login } }")
+
+        # GraphQL responses don't lower the REST budget
+        assert (await redis_cache.hgetall("rate-limit-budget~owner~core"))[
+            "remaining"
+        ] == "4000"
+        assert (await redis_cache.hgetall("rate-limit-budget~owner~graphql"))[
+            "remaining"
+        ] == "10"
+        await client.get("/after")
+
+        # But the GraphQL budget is checked for GraphQL queries
+        with pytest.raises(exceptions.RateLimited) as e:
+            await client.graphql("query { viewer { login } }")
+        assert e.value.remaining == 10
+
+    github_server.check_assertions()
+
+
+@pytest.mark.asyncio
+async def test_client_low_priority_concurrent_tasks(
+    github_server: httpserver.HTTPServer, redis_cache: utils.RedisCache
+) -> None:
+    reset = int(utils.utcnow().timestamp()) + 3600
+    await redis_cache.hmset(
+        "rate-limit-budget~owner~core",
+        {"remaining": 500, "limit": 5000, "reset": reset},
+    )
+    for path in ("/other", "/interleaved", "/after"):
+        github_server.expect_oneshot_request(path).respond_with_json({})
+
+    a_entered = asyncio.Event()
+    b_entered = asyncio.Event()
+    a_exited = asyncio.Event()
+
+    async with github.aget_client(
+        github_types.GitHubLogin("owner"), redis_cache=redis_cache
+    ) as client:
+
+        async def task_a() -> None:
+            with github.low_priority():
+                a_entered.set()
+                await b_entered.wait()
+                with pytest.raises(exceptions.RateLimited):
+                    await client.get("/deferred")
+            a_exited.set()
+
+        async def task_b() -> None:
+            await a_entered.wait()
+            with github.low_priority():
+                b_entered.set()
+                await a_exited.wait()
+            # Blocks exited in another order than entered must not leave the
+            # requests of this task low priority
+            await client.get("/interleaved")
+
+        async def task_c() -> None:
+            await a_entered.wait()
+            # The low priority block of another task doesn't apply here
+            await client.get("/other")
+
+        await asyncio.gather(task_a(), task_b(), task_c())
+        await client.get("/after")
+
+    github_server.check_assertions()
+    assert [
+        r.path
+        for r, _ in github_server.log
+        if r.path in ("/deferred", "/other", "/interleaved", "/after")
+    ] == ["/other", "/interleaved", "/after"]
+
+
+@pytest.mark.asyncio
+async def test_client_shared_connection_pool(
+    httpserver: httpserver.HTTPServer,
+) -> None:
+    httpserver.expect_request("/").respond_with_json({})
+
+    transports = []
+    with mock.patch.object(http.statsd, "increment") as increment:
+        # NOTE(sileht): the test server doesn't keep connections alive, but the
+        # pool must survive the client that used it
+        for _ in range(2):
+            async with http.AsyncClient(base_url=httpserver.url_for("/")) as client:
+                await client.get("/")
+            transports.append(client._transport)
+
+    assert transports[0] is transports[1] is http.get_shared_connection_pool()
+    increment.assert_called_with(
+        "http.client.connections.created", tags=["hostname:localhost"]
+    )
+
+    await http.shutdown_shared_connection_pool()
+    assert http.get_shared_connection_pool() is not client._transport
+
+
+@pytest.mark.asyncio
+async def test_client_installation_token_shared_in_redis(
+    github_server: httpserver.HTTPServer, redis_cache: utils.RedisCache
+) -> None:
+    github_server.expect_request("/").respond_with_json({})
+
+    def get_auth_requests() -> typing.List[str]:
+        return [r.path for r, _ in github_server.log if r.path != "/"]
+
+    async with github.aget_client(
+        github_types.GitHubLogin("owner"), redis_cache=redis_cache
+    ) as client:
+        await client.get("/")
+    assert get_auth_requests() == [
+        "/users/owner/installation",
+        "/app/installations/12345/access_tokens",
+    ]
+    encrypted = await redis_cache.get("installation-token~12345")
+    assert "<app_token>" not in encrypted
+
+    # Another process, with an empty in-process cache
+    github.CachedToken.STORAGE.clear()
+    async with github.aget_client(
+        github_types.GitHubLogin("owner"), redis_cache=redis_cache
+    ) as client:
+        await client.get("/")
+        assert client.auth.installation == {
+            "id": 12345,
+            "target_type": "User",
+            "permissions": {
+                "checks": "write",
+                "contents": "write",
+                "pull_requests": "write",
+            },
+            "account": {"login": "owner", "id": 12345},
+        }
+    assert len(get_auth_requests()) == 2
+    token = github.CachedToken.get(github_types.GitHubInstallationIdType(12345))
+    assert token is not None and token.token == "<app_token>"
+
+    # Token about to expire are renewed
+    await redis_cache.delete("installation-token~12345")
+    github.CachedToken(
+        github_types.GitHubInstallationIdType(12345),
+        "<old_token>",
+        datetime.datetime.utcnow() + datetime.timedelta(minutes=1),
+    )
+    async with github.aget_client(
+        github_types.GitHubLogin("owner"), redis_cache=redis_cache
+    ) as client:
+        await client.get("/")
+    assert get_auth_requests()[-1] == "/app/installations/12345/access_tokens"
+    assert github_server.log[-1][0].headers["Authorization"] == "token <app_token>"
+
+
+@pytest.mark.asyncio
+async def test_client_installation_token_unlock_owner_only(
+    redis_cache: utils.RedisCache,
+) -> None:
+    installation_id = github_types.GitHubInstallationIdType(12345)
+    lock_key = "installation-token-lock~12345"
+
+    expired_token = await github.CachedToken.lock(redis_cache, installation_id)
+    assert expired_token is not None
+    assert await github.CachedToken.lock(redis_cache, installation_id) is None
+
+    # The lock expired and another process took it
+    await redis_cache.delete(lock_key)
+    lock_token = await github.CachedToken.lock(redis_cache, installation_id)
+    assert lock_token is not None
+
+    await github.CachedToken.unlock(redis_cache, installation_id, expired_token)
+    assert await redis_cache.get(lock_key) == lock_token
+
+    await github.CachedToken.unlock(redis_cache, installation_id, lock_token)
+    assert await redis_cache.get(lock_key) is None
+
+
+@pytest.mark.asyncio
+async def test_client_installation_token_single_flight(
+    github_server: httpserver.HTTPServer, redis_cache: utils.RedisCache
+) -> None:
+    github_server.expect_request("/").respond_with_json({})
+    installation_id = github_types.GitHubInstallationIdType(12345)
+    lock_token = await github.CachedToken.lock(redis_cache, installation_id)
+    assert lock_token is not None
+
+    async def create_token_elsewhere() -> None:
+        await asyncio.sleep(0.5)
+        token = github.CachedToken(
+            installation_id,
+            "<other_token>",
+            datetime.datetime(2100, 12, 31),
+        )
+        await token.save_to_redis(redis_cache)
+        github.CachedToken.STORAGE.clear()
+        assert lock_token is not None
+        await github.CachedToken.unlock(redis_cache, installation_id, lock_token)
+
+    task = asyncio.create_task(create_token_elsewhere())
+    async with github.aget_client(
+        github_types.GitHubLogin("owner"), redis_cache=redis_cache
+    ) as client:
+        await client.get("/")
+    await task
+
+    assert "/app/installations/12345/access_tokens" not in [
+        r.path for r, _ in github_server.log
+    ]
+    assert github_server.log[-1][0].headers["Authorization"] == "token <other_token>"
+
+
+@pytest.mark.asyncio
+async def test_client_installation_cached_but_reinstalled(
+    github_server: httpserver.HTTPServer, redis_cache: utils.RedisCache
+) -> None:
+    github_server.expect_request("/").respond_with_json({})
+    github_server.expect_request(
+        "/app/installations/999/access_tokens"
+    ).respond_with_json({"message": "Not Found"}, status=404)
+    github_server.expect_request("/user/12345/installation").respond_with_json(
+        {
+            "id": 12345,
+            "target_type": "User",
+            "permissions": {
+                "checks": "write",
+                "contents": "write",
+                "pull_requests": "write",
+            },
+            "account": {"login": "owner", "id": 12345},
+        }
+    )
+    await redis_cache.set(
+        "installation~owner",
+        json.dumps(
+            {
+                "id": 999,
+                "target_type": "User",
+                "permissions": {
+                    "checks": "write",
+                    "contents": "write",
+                    "pull_requests": "write",
+                },
+                "account": {"login": "owner", "id": 12345},
+            }
+        ),
+    )
+
+    async with github.aget_client(
+        github_types.GitHubLogin("owner"), redis_cache=redis_cache
+    ) as client:
+        await client.get("/")
+
+    assert [r.path for r, _ in github_server.log] == [
+        "/app/installations/999/access_tokens",
+        "/user/12345/installation",
+        "/app/installations/12345/access_tokens",
+        "/",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_client_coalesce_identical_requests(
+    github_server: httpserver.HTTPServer,
+) -> None:
+    github_server.expect_request("/repos/owner/repo").respond_with_json({"id": 1})
+    github_server.expect_request("/repos/owner/repo/pulls").respond_with_json([])
+    github_server.expect_request("/repos/owner/repo/branches/main").respond_with_json(
+        {"message": "Not Found"}, status=404
+    )
+
+    async with github.aget_client(github_types.GitHubLogin("owner")) as client:
+        with mock.patch.object(github.statsd, "increment") as increment:
+            results = await asyncio.gather(
+                client.item("/repos/owner/repo"),
+                client.item("/repos/owner/repo"),
+                client.item("/repos/owner/repo/pulls"),
+                client.item("/repos/owner/repo/pulls", state="open"),
+                client.item("/repos/owner/repo/branches/main"),
+                client.item("/repos/owner/repo/branches/main"),
+                return_exceptions=True,
+            )
+        assert results[:4] == [{"id": 1}, {"id": 1}, [], []]
+        assert isinstance(results[4], http.HTTPNotFound)
+        assert isinstance(results[5], http.HTTPNotFound)
+        assert client._inflight_requests == {}
+
+        # Once done, the next request is sent again
+        assert await client.item("/repos/owner/repo") == {"id": 1}
+
+    coalesced = [
+        c
+        for c in increment.call_args_list
+        if c[0][0] == "http.client.requests.coalesced"
+    ]
+    assert len(coalesced) == 2
+    assert [r.path for r, _ in github_server.log].count("/repos/owner/repo") == 2
+    assert [r.path for r, _ in github_server.log].count(
+        "/repos/owner/repo/branches/main"
+    ) == 1
+
+
+@pytest.mark.parametrize(
+    "url,template",
+    (
+        ("/", "/"),
+        ("/graphql", "/graphql"),
+        ("/users/owner/installation", "/users/{user}/installation"),
+        (
+            "/app/installations/12345/access_tokens",
+            "/app/installations/{number}/access_tokens",
+        ),
+        ("/repos/owner/repo", "/repos/{owner}/{repo}"),
+        (
+            "https://api.github.com/repos/owner/repo/pulls/42/files?page=2",
+            "/repos/{owner}/{repo}/pulls/{number}/files",
+        ),
+        (
+            "/repos/owner/repo/commits/6dcb09b5b57875f334f61aebed695e2e4193db5e/status",
+            "/repos/{owner}/{repo}/commits/{ref}/status",
+        ),
+        (
+            "/repos/owner/repo/statuses/6dcb09b5b57875f334f61aebed695e2e4193db5e",
+            "/repos/{owner}/{repo}/statuses/{sha}",
+        ),
+        (
+            "/repos/owner/repo/branches/main/protection",
+            "/repos/{owner}/{repo}/branches/{branch}/protection",
+        ),
+        (
+            "/repos/owner/repo/git/refs/heads/feature/foo",
+            "/repos/{owner}/{repo}/git/refs/{ref}",
+        ),
+        (
+            "/repos/owner/repo/contents/.github/mergify.yml",
+            "/repos/{owner}/{repo}/contents/{path}",
+        ),
+        (
+            "/repos/owner/repo/collaborators/someone/permission",
+            "/repos/{owner}/{repo}/collaborators/{user}/permission",
+        ),
+    ),
+)
+def test_endpoint_template(url: str, template: str) -> None:
+    assert profiler.get_endpoint_template(url) == template
+
+
+@pytest.mark.asyncio
+async def test_client_requests_profile(
+    github_server: httpserver.HTTPServer,
+) -> None:
+    github_server.expect_request("/repos/owner/repo/pulls/1/files").respond_with_json(
+        [{"filename": "a"}]
+    )
+    github_server.expect_request(
+        "/repos/owner/repo/pulls/2/files", query_string="page=2"
+    ).respond_with_json([{"filename": "c"}])
+    next_url = github_server.url_for("/repos/owner/repo/pulls/2/files?page=2")
+    github_server.expect_request("/repos/owner/repo/pulls/2/files").respond_with_json(
+        [{"filename": "b"}], headers={"Link": f'<{next_url}>; rel="next"'}
+    )
+    github_server.expect_request("/repos/owner/repo/pulls/3/files").respond_with_json(
+        {"message": "Not Found"}, status=404
+    )
+
+    async with github.aget_client(github_types.GitHubLogin("owner")) as client:
+        await client.item("/repos/owner/repo/pulls/1/files")
+        with profiler.phase("rules"):
+            assert [
+                f["filename"]
+                async for f in client.items("/repos/owner/repo/pulls/2/files")
+            ] == ["b", "c"]
+            with pytest.raises(http.HTTPNotFound):
+                await client.item("/repos/owner/repo/pulls/3/files")
+
+        endpoint = "/repos/{owner}/{repo}/pulls/{number}/files"
+        engine_cost = client.profile.costs[("engine", "GET", endpoint)]
+        assert engine_cost.requests == 1
+        assert engine_cost.pages == 0
+        assert engine_cost.errors == 0
+        assert engine_cost.bytes > 0
+        rules_cost = client.profile.costs[("rules", "GET", endpoint)]
+        assert rules_cost.requests == 3
+        assert rules_cost.pages == 1
+        assert rules_cost.errors == 1
+
+        # NOTE(sileht): installation and access token requests are not
+        # accounted, they don't use the installation quota
+        assert client.profile.nb_requests == 4
+        assert client.profile.summary(limit=1) == {f"rules GET {endpoint}": 3}
+        dump = client.profile.dump().split("\n")
+        assert dump[1].split()[:4] == ["rules", "GET", endpoint, "3"]
+
+    assert client.profile.costs == {}
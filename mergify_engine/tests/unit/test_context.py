@@ -13,6 +13,11 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import asyncio
+import base64
+import typing
+from unittest import mock
+
 import pytest
 
 from mergify_engine import context
@@ -20,6 +25,7 @@ from mergify_engine import github_types
 from mergify_engine import subscription
 from mergify_engine import utils
 from mergify_engine.clients import github
+from mergify_engine.clients import http
 
 
 @pytest.mark.asyncio
@@ -238,3 +244,217 @@ async def test_team_members_cache(redis_cache: utils.RedisCache) -> None:
     assert client.called == 7
     assert (await installation.get_team_members(team_slug3)) == []
     assert client.called == 7
+
+
+@pytest.mark.asyncio
+async def test_opened_pulls_cache(redis_cache: utils.RedisCache) -> None:
+    class FakeClient(github.AsyncGithubInstallationClient):
+        called: int
+
+        def __init__(self, owner, repo):
+            super().__init__(auth=None)
+            self.owner = owner
+            self.repo = repo
+            self.called = 0
+
+        async def items(self, url, *args, **kwargs):
+            self.called += 1
+            if url == f"/repos/{self.owner}/{self.repo}/pulls":
+                yield {"number": 2, "base": {"ref": "main"}, "head": {"sha": "b"}}
+                yield {"number": 1, "base": {"ref": "stable"}, "head": {"sha": "a"}}
+            else:
+                raise ValueError(f"Unknown test URL `{url}` for repo {self.repo}")
+
+    gh_owner = github_types.GitHubAccount(
+        {
+            "id": github_types.GitHubAccountIdType(123),
+            "login": github_types.GitHubLogin("jd"),
+            "type": "User",
+            "avatar_url": "",
+        }
+    )
+    gh_repo = github_types.GitHubRepository(
+        {
+            "id": github_types.GitHubRepositoryIdType(0),
+            "owner": gh_owner,
+            "full_name": "",
+            "archived": False,
+            "url": "",
+            "default_branch": github_types.GitHubRefType(""),
+            "name": github_types.GitHubRepositoryName("test"),
+            "private": False,
+        }
+    )
+
+    def make_pull(number, state, ref, sha):
+        return {
+            "number": number,
+            "state": state,
+            "base": {"ref": ref, "repo": gh_repo},
+            "head": {"sha": sha},
+        }
+
+    def make_repository():
+        sub = subscription.Subscription(redis_cache, 0, False, "", frozenset())
+        installation = context.Installation(
+            gh_owner["id"], gh_owner["login"], sub, client, redis_cache
+        )
+        return context.Repository(installation, gh_repo["name"], gh_repo["id"])
+
+    client = FakeClient(gh_owner["login"], gh_repo["name"])
+
+    # NOTE(sileht): events received while the index is cold are ignored
+    await context.Repository.update_opened_pulls_cache(
+        redis_cache, make_pull(3, "open", "main", "c")
+    )
+    assert await make_repository().get_opened_pulls() == [
+        {"number": 2, "base_ref": "main", "head_sha": "b"},
+        {"number": 1, "base_ref": "stable", "head_sha": "a"},
+    ]
+    assert client.called == 1
+
+    await context.Repository.update_opened_pulls_cache(
+        redis_cache, make_pull(3, "open", "main", "c")
+    )
+    await context.Repository.update_opened_pulls_cache(
+        redis_cache, make_pull(2, "open", "stable", "d")
+    )
+    await context.Repository.update_opened_pulls_cache(
+        redis_cache, make_pull(1, "closed", "stable", "a")
+    )
+    assert await make_repository().get_opened_pulls() == [
+        {"number": 3, "base_ref": "main", "head_sha": "c"},
+        {"number": 2, "base_ref": "stable", "head_sha": "d"},
+    ]
+    assert client.called == 1
+
+    await context.Repository.update_opened_pulls_cache(
+        redis_cache, make_pull(3, "closed", "main", "c")
+    )
+    await context.Repository.update_opened_pulls_cache(
+        redis_cache, make_pull(2, "closed", "stable", "d")
+    )
+    assert await make_repository().get_opened_pulls() == []
+    assert client.called == 1
+
+    await redis_cache.delete(
+        context.Repository._opened_pulls_cache_key_for_repo(
+            gh_owner["id"], gh_repo["name"]
+        )
+    )
+    assert len(await make_repository().get_opened_pulls()) == 2
+    assert client.called == 2
+
+
+@pytest.mark.asyncio
+async def test_prefetch_attributes(redis_cache: utils.RedisCache) -> None:
+    class FakeClient(github.AsyncGithubInstallationClient):
+        def __init__(self):
+            super().__init__(auth=None)
+            self.called: typing.List[str] = []
+            self.running = 0
+            self.max_running = 0
+
+        async def items(self, url, *args, **kwargs):
+            self.called.append(url)
+            self.running += 1
+            self.max_running = max(self.running, self.max_running)
+            await asyncio.sleep(0)
+            self.running -= 1
+            return
+            yield
+
+    client = FakeClient()
+    sub = subscription.Subscription(redis_cache, 0, False, "", frozenset())
+    installation = context.Installation(
+        github_types.GitHubAccountIdType(123),
+        github_types.GitHubLogin("jd"),
+        sub,
+        client,
+        redis_cache,
+    )
+    repository = context.Repository(
+        installation,
+        github_types.GitHubRepositoryName("test"),
+        github_types.GitHubRepositoryIdType(0),
+    )
+
+    def make_context():
+        return context.Context(
+            repository,
+            {"number": 1, "head": {"sha": "azertyuiop"}},
+        )
+
+    ctxt = make_context()
+    await ctxt.prefetch_attributes({"base", "label"})
+    assert client.called == []
+    await ctxt.prefetch_attributes({"base", "label", "approved-reviews-by"})
+    assert client.called == ["/repos/jd/test/pulls/1/reviews"]
+
+    client.called = []
+    ctxt = make_context()
+    await ctxt.prefetch_attributes({"base", "files", "check-success"})
+    assert sorted(client.called) == [
+        "/repos/jd/test/commits/azertyuiop/check-runs",
+        "/repos/jd/test/commits/azertyuiop/status",
+        "/repos/jd/test/pulls/1/files?per_page=100",
+    ]
+    assert client.max_running == 3
+
+    # Already fetched
+    client.called = []
+    await ctxt.prefetch_attributes({"files", "status-failure"})
+    assert client.called == []
+
+
+@pytest.mark.asyncio
+async def test_config_file_cache(redis_cache: utils.RedisCache) -> None:
+    class FakeClient(github.AsyncGithubInstallationClient):
+        def __init__(self):
+            super().__init__(auth=None)
+            self.called = 0
+
+        async def item(self, url, *args, **kwargs):
+            self.called += 1
+            if url == "/repos/jd/test/contents/.mergify.yml":
+                return {
+                    "type": "file",
+                    "content": base64.b64encode(b"pull_request_rules:").decode(),
+                    "path": ".mergify.yml",
+                    "sha": "azertyuiop",
+                }
+            raise http.HTTPNotFound(
+                message="Not found", request=mock.Mock(), response=mock.Mock()
+            )
+
+    client = FakeClient()
+
+    def make_repository():
+        sub = subscription.Subscription(redis_cache, 0, False, "", frozenset())
+        installation = context.Installation(
+            github_types.GitHubAccountIdType(123),
+            github_types.GitHubLogin("jd"),
+            sub,
+            client,
+            redis_cache,
+        )
+        return context.Repository(
+            installation, github_types.GitHubRepositoryName("test")
+        )
+
+    config_file = await make_repository().get_mergify_config_file()
+    assert config_file is not None
+    assert config_file["decoded_content"] == b"pull_request_rules:"
+    assert client.called == 1
+
+    cached_config_file = await make_repository().get_mergify_config_file()
+    assert cached_config_file == config_file
+    assert client.called == 1
+
+    await context.Repository.clear_config_file_cache(
+        redis_cache,
+        github_types.GitHubLogin("jd"),
+        github_types.GitHubRepositoryName("test"),
+    )
+    assert await make_repository().get_mergify_config_file() == config_file
+    assert client.called == 2
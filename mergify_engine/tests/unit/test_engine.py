@@ -15,16 +15,20 @@
 # under the License.
 
 import base64
+import datetime
+from unittest import mock
 
 import pytest
 from pytest_httpserver import httpserver
 
 from mergify_engine import context
 from mergify_engine import engine
+from mergify_engine import exceptions
 from mergify_engine import github_types
 from mergify_engine import subscription
 from mergify_engine import utils
 from mergify_engine.clients import github
+from mergify_engine.engine import actions_runner
 
 
 FAKE_MERGIFY_CONTENT = base64.b64encode(b"pull_request_rules:").decode()
@@ -432,3 +436,31 @@ async def test_configuration_initial(
         assert changed
 
     github_server.check_assertions()
+
+
+@pytest.mark.asyncio
+@mock.patch(
+    "mergify_engine.engine.actions_runner.gen_summary",
+    new_callable=mock.AsyncMock,
+    return_value=("new title", "new summary"),
+)
+async def test_post_summary_deferred(_):
+    ctxt = mock.Mock(sources=[])
+    ctxt.user_refresh_requested.return_value = False
+    ctxt.admin_refresh_requested.return_value = False
+    summary_check = {"output": {"title": "title", "summary": "summary"}}
+    countdown = datetime.timedelta(minutes=10)
+
+    # The budget is too low to rewrite the summary now
+    ctxt.set_summary_check = mock.AsyncMock(
+        side_effect=exceptions.RateLimitBudgetExhausted(countdown, 50)
+    )
+    await actions_runner.post_summary(ctxt, None, summary_check, {}, {})
+    ctxt.set_summary_check.assert_awaited_once()
+
+    # GitHub refused the request, the run must be retried
+    ctxt.set_summary_check = mock.AsyncMock(
+        side_effect=exceptions.RateLimited(countdown, 0)
+    )
+    with pytest.raises(exceptions.RateLimited):
+        await actions_runner.post_summary(ctxt, None, summary_check, {}, {})
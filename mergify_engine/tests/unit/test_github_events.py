@@ -16,6 +16,7 @@
 
 import json
 import os
+import typing
 from unittest import mock
 
 import pytest
@@ -24,6 +25,7 @@ from mergify_engine import context
 from mergify_engine import github_events
 from mergify_engine import github_types
 from mergify_engine import utils
+from mergify_engine import worker
 
 
 async def _do_test_event_to_pull_check_run(redis_cache, filename, expected_pulls):
@@ -37,9 +39,14 @@ async def _do_test_event_to_pull_check_run(redis_cache, filename, expected_pulls
     ) as f:
         data = json.load(f)
 
-    installation = context.Installation(123, owner, {}, mock.Mock(), redis_cache)
+    async def items(*args, **kwargs):
+        for pull in []:
+            yield pull
+
+    client = mock.Mock(items=items)
+    installation = context.Installation(123, owner, {}, client, redis_cache)
     pulls = await github_events.extract_pull_numbers_from_event(
-        installation, repo, event_type, data, []
+        installation, repo, event_type, data
     )
     assert pulls == expected_pulls
 
@@ -58,6 +65,66 @@ async def test_event_to_pull_check_run_same_repo(redis_cache):
     )
 
 
+@pytest.mark.asyncio
+async def test_event_to_pull_status_from_pulls_by_sha(redis_cache):
+    owner = github_types.GitHubLogin("owner")
+    repo = github_types.GitHubRepositoryName("repo")
+
+    def make_event(action, number, state, sha, before=None):
+        event = {
+            "action": action,
+            "repository": {"name": repo, "owner": {"login": owner}},
+            "pull_request": {"number": number, "state": state, "head": {"sha": sha}},
+        }
+        if before is not None:
+            event["before"] = before
+        return event
+
+    async def items(url, *args, **kwargs):
+        assert url == f"/repos/{owner}/{repo}/pulls"
+        yield {"number": 4, "base": {"ref": "main"}, "head": {"sha": "cold"}}
+
+    client = mock.Mock(items=mock.Mock(side_effect=items))
+
+    async def get_pulls(sha):
+        return await github_events.extract_pull_numbers_from_event(
+            context.Installation(123, owner, {}, client, redis_cache),
+            repo,
+            "status",
+            {"sha": sha},
+        )
+
+    await github_events._update_pulls_by_sha(
+        redis_cache, make_event("opened", 1, "open", "shared")
+    )
+    await github_events._update_pulls_by_sha(
+        redis_cache, make_event("opened", 2, "open", "shared")
+    )
+    await github_events._update_pulls_by_sha(
+        redis_cache, make_event("opened", 3, "open", "other")
+    )
+    assert await get_pulls("shared") == [1, 2]
+    assert await get_pulls("other") == [3]
+    assert client.items.call_count == 0
+
+    await github_events._update_pulls_by_sha(
+        redis_cache, make_event("synchronize", 2, "open", "new", before="shared")
+    )
+    await github_events._update_pulls_by_sha(
+        redis_cache, make_event("closed", 3, "closed", "other")
+    )
+    assert await get_pulls("shared") == [1]
+    assert await get_pulls("new") == [2]
+    assert client.items.call_count == 0
+
+    # NOTE(sileht): unknown sha are looked up in the opened pull requests
+    assert await get_pulls("cold") == [4]
+    assert client.items.call_count == 1
+    assert await get_pulls("cold") == [4]
+    assert await get_pulls("other") == []
+    assert client.items.call_count == 1
+
+
 GITHUB_SAMPLE_EVENTS = {}
 _EVENT_DIR = os.path.join(os.path.dirname(__file__), "events")
 for filename in os.listdir(_EVENT_DIR):
@@ -89,3 +156,80 @@ async def test_filter_and_dispatch(
         assert e.event_type == event_type
         assert e.event_id == event_id
         assert isinstance(e.reason, str)
+
+
+@pytest.mark.asyncio
+async def test_send_pull_refreshes(redis_stream: utils.RedisStream) -> None:
+    repository = github_types.GitHubRepository(
+        {
+            "id": github_types.GitHubRepositoryIdType(456),
+            "name": github_types.GitHubRepositoryName("repo"),
+            "owner": {
+                "login": github_types.GitHubLogin("owner"),
+                "id": github_types.GitHubAccountIdType(123),
+                "type": "User",
+                "avatar_url": "",
+            },
+        }  # type: ignore[typeddict-item]
+    )
+    await github_events.send_pull_refreshes(
+        redis_stream,
+        repository,
+        [github_types.GitHubPullRequestNumber(p) for p in (1, 2, 3)],
+        action="internal",
+    )
+
+    messages = await redis_stream.xrange("stream~owner~123")
+    headers = [worker.unpack_message(m)[0] for _, m in messages]
+    assert [h["pull_number"] for h in headers] == [1, 2, 3]
+    for header in headers:
+        assert header["repo"] == "repo"
+        source = worker.EventSource.from_record(
+            await redis_stream.hget(
+                f"pending~stream~owner~123~repo~{header['pull_number']}", "0"
+            )
+        )
+        assert source.event_type == "refresh"
+        data = typing.cast(github_types.GitHubEventRefresh, source.data)
+        assert data["action"] == "internal"
+        assert data["ref"] is None
+
+
+@pytest.mark.parametrize(
+    "ref, forced, modified, cleared",
+    (
+        ("refs/heads/master", False, [".mergify.yml"], True),
+        ("refs/heads/master", False, ["README.md"], False),
+        ("refs/heads/master", True, ["README.md"], True),
+        ("refs/heads/stable", False, [".mergify.yml"], False),
+    ),
+)
+@mock.patch("mergify_engine.worker.push")
+@pytest.mark.asyncio
+async def test_push_event_clears_config_file_cache(
+    worker_push: mock.Mock,
+    ref: str,
+    forced: bool,
+    modified: typing.List[str],
+    cleared: bool,
+    redis_cache: utils.RedisCache,
+    redis_stream: utils.RedisStream,
+) -> None:
+    _, event = GITHUB_SAMPLE_EVENTS["push_event.json"]
+    event = dict(
+        event,
+        ref=ref,
+        forced=forced,
+        commits=[
+            {"id": "azertyuiop", "added": [], "removed": [], "modified": modified}
+        ],
+    )
+    key = context.Repository.get_config_file_cache_key(
+        event["repository"]["owner"]["login"], event["repository"]["name"]
+    )
+    await redis_cache.hset(key, "sha", "azertyuiop")
+
+    await github_events.filter_and_dispatch(
+        redis_cache, redis_stream, "push", "my_event_id", event
+    )
+    assert await redis_cache.exists(key) != cleared
@@ -0,0 +1,206 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2021 Mergify SAS
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import datetime
+from unittest import mock
+
+import httpx
+import pytest
+
+from mergify_engine import config
+from mergify_engine import context
+from mergify_engine import exceptions
+from mergify_engine import github_types
+from mergify_engine import graphql_loader
+from mergify_engine import subscription
+from mergify_engine.clients import github
+from mergify_engine.clients import http
+
+
+@pytest.fixture
+def repository(redis_cache):
+    installation = context.Installation(
+        github_types.GitHubAccountIdType(123),
+        github_types.GitHubLogin("user"),
+        subscription.Subscription(redis_cache, 0, False, "", frozenset()),
+        mock.Mock(),
+        redis_cache,
+    )
+    return context.Repository(
+        installation,
+        github_types.GitHubRepositoryName("name"),
+        github_types.GitHubRepositoryIdType(123),
+    )
+
+
+def fake_context(repository, number):
+    return context.Context(
+        repository,
+        {
+            "number": number,
+            "head": {"sha": f"sha{number}"},
+        },
+    )
+
+
+def test_get_cache_keys():
+    attributes = {
+        "base",
+        "approved-reviews-by",
+        "files",
+        "check-success",
+        "status-failure",
+    }
+    assert graphql_loader.get_cache_keys(attributes) == {
+        "reviews",
+        "files",
+        "pull_statuses",
+    }
+
+
+@pytest.mark.asyncio
+async def test_load(repository):
+    ctxt1 = fake_context(repository, 1)
+    ctxt2 = fake_context(repository, 2)
+    ctxt2._cache["files"] = []
+
+    repository.installation.client.graphql = mock.AsyncMock(
+        return_value={
+            "repository": {
+                "pull_1": {
+                    "reviews": {
+                        "pageInfo": {"hasNextPage": False},
+                        "nodes": [
+                            {
+                                "databaseId": 42,
+                                "state": "APPROVED",
+                                "body": "LGTM",
+                                "author": {
+                                    "__typename": "User",
+                                    "login": "jd",
+                                    "avatarUrl": "https://avatar",
+                                    "databaseId": 7,
+                                },
+                            }
+                        ],
+                    },
+                    "files": {
+                        "pageInfo": {"hasNextPage": False},
+                        "nodes": [{"path": "README.md"}],
+                    },
+                },
+                "pull_2": {
+                    "reviews": {
+                        "pageInfo": {"hasNextPage": True},
+                        "nodes": [],
+                    },
+                },
+                "statuses_1": {
+                    "status": {
+                        "contexts": [
+                            {
+                                "context": "ci",
+                                "state": "EXPECTED",
+                                "description": "",
+                                "targetUrl": "https://ci",
+                                "avatarUrl": "",
+                            }
+                        ]
+                    }
+                },
+                "statuses_2": {"status": None},
+            }
+        }
+    )
+
+    await graphql_loader.load([ctxt1, ctxt2], {"reviews", "files", "pull_statuses"})
+
+    repository.installation.client.graphql.assert_awaited_once()
+    query = repository.installation.client.graphql.call_args[0][0]
+    assert "pull_1: pullRequest(number: 1)" in query
+    assert 'statuses_2: object(oid: "sha2")' in query
+    assert query.count("files(first: 100)") == 1
+
+    assert ctxt1._cache["reviews"] == [
+        {
+            "id": 42,
+            "user": {
+                "id": 7,
+                "login": "jd",
+                "type": "User",
+                "avatar_url": "https://avatar",
+            },
+            "body": "LGTM",
+            "state": "APPROVED",
+        }
+    ]
+    assert ctxt1._cache["files"] == [
+        {
+            "filename": "README.md",
+            "contents_url": f"{config.GITHUB_API_URL}/repos/user/name/contents/README.md?ref=sha1",
+        }
+    ]
+    assert ctxt1._cache["pull_statuses"] == [
+        {
+            "context": "ci",
+            "state": "pending",
+            "description": "",
+            "target_url": "https://ci",
+            "avatar_url": "",
+        }
+    ]
+    assert "reviews" not in ctxt2._cache
+    assert ctxt2._cache["files"] == []
+    assert ctxt2._cache["pull_statuses"] == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "error",
+    [
+        github.GraphQLError([{"message": "boom"}]),
+        http.HTTPServerSideError(
+            "boom",
+            request=httpx.Request("POST", "https://api.github.com/graphql"),
+            response=httpx.Response(502),
+        ),
+        http.CircuitOpen("api.github.com", "graphql", datetime.timedelta(seconds=30)),
+        exceptions.RateLimited(datetime.timedelta(seconds=30), 0),
+    ],
+)
+async def test_load_fallback_to_rest(repository, error):
+    ctxt = fake_context(repository, 1)
+    repository.installation.client.graphql = mock.AsyncMock(side_effect=error)
+    await graphql_loader.load([ctxt], {"reviews"})
+    assert "reviews" not in ctxt._cache
+
+
+def test_to_files_quote_path(repository):
+    ctxt = fake_context(repository, 1)
+    files = graphql_loader._to_files(
+        ctxt,
+        {
+            "files": {
+                "pageInfo": {"hasNextPage": False},
+                "nodes": [{"path": "docs/a file#1?.md"}],
+            }
+        },
+    )
+    assert files == [
+        {
+            "filename": "docs/a file#1?.md",
+            "contents_url": f"{config.GITHUB_API_URL}/repos/user/name/contents/docs/a%20file%231%3F.md?ref=sha1",
+        }
+    ]
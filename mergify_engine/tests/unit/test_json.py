@@ -56,3 +56,23 @@ def test_encode_enum() -> None:
 def test_decode_enum() -> None:
     json_file = mergify_json.dumps(with_enum)
     assert mergify_json.loads(json_file) == with_enum
+
+
+def test_project() -> None:
+    tree = mergify_json.get_fields_tree(
+        ("number", "head.sha", "base.repo.owner", "labels.name", "missing.field")
+    )
+    pull = {
+        "number": 1,
+        "title": "hello",
+        "head": {"sha": "azertyuiop", "ref": "feature"},
+        "base": {"repo": {"owner": {"login": "foo"}, "name": "bar"}},
+        "labels": [{"name": "a", "color": "red"}, {"name": "b", "color": "blue"}],
+    }
+    assert mergify_json.project(pull, tree) == {
+        "number": 1,
+        "head": {"sha": "azertyuiop"},
+        "base": {"repo": {"owner": {"login": "foo"}}},
+        "labels": [{"name": "a"}, {"name": "b"}],
+    }
+    assert mergify_json.project(pull, {}) is pull
@@ -21,8 +21,10 @@ from unittest import mock
 
 from freezegun import freeze_time
 import httpx
+import msgpack
 import pytest
 
+from mergify_engine import config
 from mergify_engine import context
 from mergify_engine import exceptions
 from mergify_engine import logs
@@ -30,12 +32,16 @@ from mergify_engine import worker
 from mergify_engine.clients import http
 
 
+async def get_streams_count(redis_stream):
+    return sum([await redis_stream.zcard(key) for key in worker.get_shard_keys()])
+
+
 async def run_worker(test_timeout=10, **kwargs):
     w = worker.Worker(**kwargs)
     w.start()
     started_at = time.monotonic()
     while (
-        w._redis_stream is None or (await w._redis_stream.zcard("streams")) > 0
+        w._redis_stream is None or (await get_streams_count(w._redis_stream)) > 0
     ) and time.monotonic() - started_at < test_timeout:
         await asyncio.sleep(0.5)
     w.stop()
@@ -77,15 +83,15 @@ async def test_worker_with_waiting_tasks(
                 )
 
     # Check everything we push are in redis
-    assert 8 == (await redis_stream.zcard("streams"))
+    assert 8 == (await get_streams_count(redis_stream))
     assert 8 == len(await redis_stream.keys("stream~*"))
     for stream_name in stream_names:
-        assert 6 == (await redis_stream.xlen(stream_name))
+        assert 2 == (await redis_stream.xlen(stream_name))
 
     await run_worker()
 
     # Check redis is empty
-    assert 0 == (await redis_stream.zcard("streams"))
+    assert 0 == (await get_streams_count(redis_stream))
     assert 0 == len(await redis_stream.keys("stream~*"))
     assert 0 == len(await redis_stream.hgetall("attempts"))
 
@@ -166,14 +172,14 @@ async def test_worker_expanded_events(
         {"payload": "foobar"},
     )
 
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
     assert 2 == (await redis_stream.xlen("stream~owner~123"))
 
     await run_worker()
 
     # Check redis is empty
-    assert 0 == (await redis_stream.zcard("streams"))
+    assert 0 == (await get_streams_count(redis_stream))
     assert 0 == len(await redis_stream.keys("stream~*"))
     assert 0 == len(await redis_stream.hgetall("attempts"))
 
@@ -247,14 +253,14 @@ async def test_worker_with_one_task(
         {"payload": "foobar"},
     )
 
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
-    assert 2 == (await redis_stream.xlen("stream~owner~123"))
+    assert 1 == (await redis_stream.xlen("stream~owner~123"))
 
     await run_worker()
 
     # Check redis is empty
-    assert 0 == (await redis_stream.zcard("streams"))
+    assert 0 == (await get_streams_count(redis_stream))
     assert 0 == len(await redis_stream.keys("stream~*"))
     assert 0 == len(await redis_stream.hgetall("attempts"))
 
@@ -315,9 +321,9 @@ async def test_consume_good_stream(
         {"payload": "foobar"},
     )
 
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
-    assert 2 == await redis_stream.xlen("stream~owner~123")
+    assert 1 == await redis_stream.xlen("stream~owner~123")
     assert 0 == len(await redis_stream.hgetall("attempts"))
 
     p = worker.StreamProcessor(redis_stream, redis_cache)
@@ -343,7 +349,7 @@ async def test_consume_good_stream(
     )
 
     # Check redis is empty
-    assert 0 == (await redis_stream.zcard("streams"))
+    assert 0 == (await get_streams_count(redis_stream))
     assert 0 == len(await redis_stream.keys("stream~*"))
     assert 0 == len(await redis_stream.hgetall("attempts"))
 
@@ -386,7 +392,7 @@ async def test_stream_processor_retrying_pull(
         {"payload": "foobar"},
     )
 
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
     assert 2 == await redis_stream.xlen("stream~owner~123")
     assert 0 == len(await redis_stream.hgetall("attempts"))
@@ -423,7 +429,7 @@ async def test_stream_processor_retrying_pull(
     ]
 
     # Check stream still there and attempts recorded
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
     assert {
         b"pull~owner~repo~42": b"1",
@@ -431,7 +437,7 @@ async def test_stream_processor_retrying_pull(
     } == await redis_stream.hgetall("attempts")
 
     await p.consume("stream~owner~123")
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
     assert 1 == len(await redis_stream.hgetall("attempts"))
     assert len(run_engine.mock_calls) == 4
@@ -452,7 +458,7 @@ async def test_stream_processor_retrying_pull(
     assert logger.error.mock_calls[0].args == (
         "failed to process pull request, abandoning",
     )
-    assert 0 == (await redis_stream.zcard("streams"))
+    assert 0 == (await get_streams_count(redis_stream))
     assert 0 == len(await redis_stream.keys("stream~*"))
     assert 0 == len(await redis_stream.hgetall("attempts"))
 
@@ -492,9 +498,9 @@ async def test_stream_processor_retrying_stream_recovered(
         {"payload": "foobar"},
     )
 
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
-    assert 2 == await redis_stream.xlen("stream~owner~123")
+    assert 1 == await redis_stream.xlen("stream~owner~123")
     assert 0 == len(await redis_stream.hgetall("attempts"))
 
     p = worker.StreamProcessor(redis_stream, redis_cache)
@@ -520,7 +526,7 @@ async def test_stream_processor_retrying_stream_recovered(
     )
 
     # Check stream still there and attempts recorded
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
     assert 1 == len(await redis_stream.hgetall("attempts"))
 
@@ -530,7 +536,7 @@ async def test_stream_processor_retrying_stream_recovered(
 
     await p.consume("stream~owner~123")
     assert len(run_engine.mock_calls) == 2
-    assert 0 == (await redis_stream.zcard("streams"))
+    assert 0 == (await get_streams_count(redis_stream))
     assert 0 == len(await redis_stream.keys("stream~*"))
     assert 0 == len(await redis_stream.hgetall("attempts"))
 
@@ -574,9 +580,9 @@ async def test_stream_processor_retrying_stream_failure(
         {"payload": "foobar"},
     )
 
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
-    assert 2 == await redis_stream.xlen("stream~owner~123")
+    assert 1 == await redis_stream.xlen("stream~owner~123")
     assert 0 == len(await redis_stream.hgetall("attempts"))
 
     p = worker.StreamProcessor(redis_stream, redis_cache)
@@ -602,7 +608,7 @@ async def test_stream_processor_retrying_stream_failure(
     )
 
     # Check stream still there and attempts recorded
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
     assert 1 == len(await redis_stream.hgetall("attempts"))
 
@@ -621,7 +627,7 @@ async def test_stream_processor_retrying_stream_failure(
     assert logger.info.mock_calls[0].args == ("failed to process stream, retrying",)
     assert logger.info.mock_calls[1].args == ("failed to process stream, retrying",)
     assert logger.info.mock_calls[2].args == ("failed to process stream, retrying",)
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
     assert 1 == len(await redis_stream.hgetall("attempts"))
 
@@ -657,11 +663,114 @@ async def test_stream_processor_pull_unexpected_error(
     assert len(logger.error.mock_calls) == 2
     assert logger.error.mock_calls[0].args == ("failed to process pull request",)
     assert logger.error.mock_calls[1].args == ("failed to process pull request",)
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
     assert 0 == len(await redis_stream.hgetall("attempts"))
 
 
+@pytest.mark.asyncio
+@mock.patch("mergify_engine.worker.subscription.Subscription.get_subscription")
+@mock.patch("mergify_engine.worker.run_engine")
+async def test_stream_processor_push_before_ack(
+    run_engine, _, redis_stream, redis_cache, monkeypatch, logger_checker
+):
+    await worker.push(
+        redis_stream,
+        123,
+        "owner",
+        "repo",
+        123,
+        "pull_request",
+        {"payload": "first"},
+    )
+
+    eval = redis_stream.eval
+    pushed = []
+
+    async def push_then_eval(script, *args):
+        # An event is received while the processed sources are acked
+        if script == worker.StreamProcessor.ACK_PENDING_MARKER_SCRIPT and not pushed:
+            pushed.append(
+                await worker.push(
+                    redis_stream,
+                    123,
+                    "owner",
+                    "repo",
+                    123,
+                    "comment",
+                    {"payload": "second"},
+                )
+            )
+        return await eval(script, *args)
+
+    monkeypatch.setattr(redis_stream, "eval", push_then_eval)
+
+    p = worker.StreamProcessor(redis_stream, redis_cache)
+    await p.consume("stream~owner~123")
+    assert pushed
+    assert 1 == await redis_stream.xlen("stream~owner~123")
+    await p.consume("stream~owner~123")
+    assert 0 == await redis_stream.xlen("stream~owner~123")
+
+    # Each source is consumed once
+    assert [
+        [source["data"] for source in call.args[3]] for call in run_engine.mock_calls
+    ] == [[{"payload": "first"}], [{"payload": "second"}]]
+
+
+@pytest.mark.asyncio
+@mock.patch("mergify_engine.worker.subscription.Subscription.get_subscription")
+@mock.patch("mergify_engine.worker.run_engine")
+async def test_stream_processor_refresh_deferred(
+    run_engine, _, redis_stream, redis_cache, logger_checker
+):
+    reset = int(time.time()) + 3600
+    await redis_cache.hmset(
+        "rate-limit-budget~owner~core",
+        {"remaining": 500, "limit": 5000, "reset": reset},
+    )
+
+    await worker.push(
+        redis_stream,
+        123,
+        "owner",
+        "repo",
+        None,
+        "refresh",
+        {"action": "user", "ref": None},
+    )
+    await worker.push(
+        redis_stream,
+        123,
+        "owner",
+        "repo",
+        123,
+        "pull_request",
+        {"payload": "whatever"},
+    )
+    assert 2 == await redis_stream.xlen("stream~owner~123")
+    shard_key = worker.get_shard_key_for("stream~owner~123")
+
+    p = worker.StreamProcessor(redis_stream, redis_cache)
+    await p.consume("stream~owner~123")
+
+    # The pull request behind the refresh is processed right away, the refresh
+    # moved to the end of the stream
+    assert len(run_engine.mock_calls) == 1
+    assert 1 == await redis_stream.xlen("stream~owner~123")
+    assert await redis_stream.zscore(shard_key, "stream~owner~123") < time.time() + 1
+
+    await p.consume("stream~owner~123")
+
+    # Only the refresh is left, the stream waits for the budget reset
+    assert len(run_engine.mock_calls) == 1
+    assert 1 == await redis_stream.xlen("stream~owner~123")
+    assert await redis_stream.zscore(shard_key, "stream~owner~123") == pytest.approx(
+        reset, abs=1
+    )
+    assert 0 == len(await redis_stream.hgetall("attempts"))
+
+
 @pytest.mark.asyncio
 @mock.patch("mergify_engine.worker.subscription.Subscription.get_subscription")
 @mock.patch("mergify_engine.worker.run_engine")
@@ -694,7 +803,7 @@ async def test_stream_processor_date_scheduling(
         )
         wanted_owner_id = "owner2"
 
-    assert 2 == (await redis_stream.zcard("streams"))
+    assert 2 == (await get_streams_count(redis_stream))
     assert 2 == len(await redis_stream.keys("stream~*"))
     assert 0 == len(await redis_stream.hgetall("attempts"))
 
@@ -713,7 +822,7 @@ async def test_stream_processor_date_scheduling(
         assert stream_name is not None
         await p.consume(stream_name)
 
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
     assert 0 == len(await redis_stream.hgetall("attempts"))
     assert received == [wanted_owner_id]
@@ -722,7 +831,7 @@ async def test_stream_processor_date_scheduling(
         stream_name = await s.next_stream()
         assert stream_name is None
 
-    assert 1 == (await redis_stream.zcard("streams"))
+    assert 1 == (await get_streams_count(redis_stream))
     assert 1 == len(await redis_stream.keys("stream~*"))
     assert 0 == len(await redis_stream.hgetall("attempts"))
     assert received == [wanted_owner_id]
@@ -733,7 +842,7 @@ async def test_stream_processor_date_scheduling(
         assert stream_name is not None
         await p.consume(stream_name)
 
-    assert 0 == (await redis_stream.zcard("streams"))
+    assert 0 == (await get_streams_count(redis_stream))
     assert 0 == len(await redis_stream.keys("stream~*"))
     assert 0 == len(await redis_stream.hgetall("attempts"))
     assert received == [wanted_owner_id, unwanted_owner_id]
@@ -782,6 +891,39 @@ async def test_stream_processor_retrying_after_read_error(
             await worker.run_engine(installation, "repo", 1234, [])
 
 
+@pytest.mark.asyncio
+@mock.patch("mergify_engine.worker.subscription.Subscription.get_subscription")
+@mock.patch("mergify_engine.worker.run_engine")
+async def test_stream_processor_retrying_circuit_open(
+    run_engine, _, redis_stream, redis_cache
+):
+    run_engine.side_effect = http.CircuitOpen(
+        "api.github.com", "repos/pulls", datetime.timedelta(seconds=10)
+    )
+
+    await worker.push(
+        redis_stream,
+        123,
+        "owner",
+        "repo",
+        123,
+        "pull_request",
+        {"payload": "whatever"},
+    )
+
+    p = worker.StreamProcessor(redis_stream, redis_cache)
+    await p.consume("stream~owner~123")
+
+    assert len(run_engine.mock_calls) == 1
+    # Rescheduled later without counting an attempt
+    assert 1 == await redis_stream.xlen("stream~owner~123")
+    assert 0 == len(await redis_stream.hgetall("attempts"))
+    score = await redis_stream.zscore(
+        worker.get_shard_key_for("stream~owner~123"), "stream~owner~123"
+    )
+    assert score > time.time() + 5
+
+
 @pytest.mark.asyncio
 @mock.patch("mergify_engine.worker.subscription.Subscription.get_subscription")
 @mock.patch("mergify_engine.worker.run_engine")
@@ -810,7 +952,7 @@ async def test_stream_processor_ignore_503(
     await run_worker()
 
     # Check redis is empty
-    assert 0 == (await redis_stream.zcard("streams"))
+    assert 0 == (await get_streams_count(redis_stream))
     assert 0 == len(await redis_stream.keys("stream~*"))
     assert 0 == len(await redis_stream.hgetall("attempts"))
 
@@ -840,10 +982,10 @@ async def test_worker_with_multiple_workers(
                 )
 
     # Check everything we push are in redis
-    assert 100 == (await redis_stream.zcard("streams"))
+    assert 100 == (await get_streams_count(redis_stream))
     assert 100 == len(await redis_stream.keys("stream~*"))
     for stream_name in stream_names:
-        assert 6 == (await redis_stream.xlen(stream_name))
+        assert 2 == (await redis_stream.xlen(stream_name))
 
     process_count = 4
     worker_per_process = 3
@@ -860,7 +1002,7 @@ async def test_worker_with_multiple_workers(
     )
 
     # Check redis is empty
-    assert 0 == (await redis_stream.zcard("streams"))
+    assert 0 == (await get_streams_count(redis_stream))
     assert 0 == len(await redis_stream.keys("stream~*"))
     assert 0 == len(await redis_stream.hgetall("attempts"))
 
@@ -885,7 +1027,8 @@ async def test_worker_reschedule(
         {"payload": "whatever"},
     )
 
-    score = (await redis_stream.zrange("streams", 0, -1, withscores=True))[0][1]
+    shard_key = worker.get_shard_key_for("stream~owner~123")
+    score = (await redis_stream.zrange(shard_key, 0, -1, withscores=True))[0][1]
     planned_for = datetime.datetime.utcfromtimestamp(score)
 
     monkeypatch.setattr("sys.argv", ["mergify-worker-rescheduler", "other"])
@@ -893,7 +1036,7 @@ async def test_worker_reschedule(
     assert ret == 1
 
     score_not_rescheduled = (
-        await redis_stream.zrange("streams", 0, -1, withscores=True)
+        await redis_stream.zrange(shard_key, 0, -1, withscores=True)
     )[0][1]
     planned_for_not_rescheduled = datetime.datetime.utcfromtimestamp(
         score_not_rescheduled
@@ -904,7 +1047,7 @@ async def test_worker_reschedule(
     ret = await worker.async_reschedule_now()
     assert ret == 0
 
-    score_rescheduled = (await redis_stream.zrange("streams", 0, -1, withscores=True))[
+    score_rescheduled = (await redis_stream.zrange(shard_key, 0, -1, withscores=True))[
         0
     ][1]
     planned_for_rescheduled = datetime.datetime.utcfromtimestamp(score_rescheduled)
@@ -931,3 +1074,652 @@ async def test_worker_stuck_shutdown(
         {"payload": "whatever"},
     )
     await run_worker(test_timeout=2, shutdown_timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_push_to_stream_shard(redis_stream):
+    await worker.push(
+        redis_stream,
+        123,
+        "owner",
+        "repo",
+        123,
+        "pull_request",
+        {"payload": "whatever"},
+    )
+
+    shard_key = worker.get_shard_key_for("stream~owner~123")
+    assert [b"stream~owner~123"] == await redis_stream.zrange(shard_key, 0, -1)
+    for key in worker.get_shard_keys():
+        if key != shard_key:
+            assert 0 == await redis_stream.zcard(key)
+    assert 0 == await redis_stream.zcard(worker.LEGACY_STREAMS_KEY)
+
+
+@pytest.mark.asyncio
+async def test_stream_selector_only_reads_its_shards(redis_stream):
+    for installation_id in range(20):
+        await worker.push(
+            redis_stream,
+            installation_id,
+            f"owner-{installation_id}",
+            "repo",
+            123,
+            "pull_request",
+            {"payload": "whatever"},
+        )
+
+    worker_count = worker.get_shard_count()
+    selected = set()
+    with freeze_time(datetime.datetime.utcnow() + datetime.timedelta(minutes=1)):
+        for worker_id in range(worker_count):
+            s = worker.StreamSelector(redis_stream, worker_id, worker_count)
+            assert s.get_shard_keys() == [worker.get_shard_key(worker_id)]
+            stream_name = await s.next_stream()
+            if stream_name is None:
+                continue
+            assert s.get_worker_id_for(stream_name.encode()) == worker_id
+            selected.add(stream_name)
+
+    assert len(selected) == len(
+        [key for key in worker.get_shard_keys() if await redis_stream.zcard(key)]
+    )
+
+
+@pytest.mark.asyncio
+async def test_migrate_legacy_streams(redis_stream):
+    await redis_stream.zadd(
+        worker.LEGACY_STREAMS_KEY,
+        **{f"stream~owner-{i}~{i}": 1000 + i for i in range(10)},
+    )
+    # Already in its shard, the score must not be changed
+    await redis_stream.zadd(
+        worker.get_shard_key_for("stream~owner-0~0"), **{"stream~owner-0~0": 42}
+    )
+
+    assert 10 == await worker.migrate_legacy_streams(redis_stream, batch_size=3)
+    assert 0 == await redis_stream.zcard(worker.LEGACY_STREAMS_KEY)
+    assert 10 == await get_streams_count(redis_stream)
+    for i in range(10):
+        stream_name = f"stream~owner-{i}~{i}"
+        assert await redis_stream.zscore(
+            worker.get_shard_key_for(stream_name), stream_name
+        ) == (42 if i == 0 else 1000 + i)
+
+    assert 0 == await worker.migrate_legacy_streams(redis_stream)
+
+
+@pytest.mark.asyncio
+async def test_stream_selector_wait_for_stream(redis_stream, monkeypatch):
+    s = worker.StreamSelector(redis_stream, 0, 1)
+
+    # Nothing to do, wait until the timeout
+    started_at = time.monotonic()
+    await s.wait_for_stream(0.2)
+    assert time.monotonic() - started_at >= 0.2
+
+    # Woken up as soon as something is pushed
+    monkeypatch.setattr("mergify_engine.worker.WORKER_PROCESSING_DELAY", 0.5)
+    waiter = asyncio.create_task(s.wait_for_stream(10))
+    await asyncio.sleep(0.1)
+    assert not waiter.done()
+    await worker.push(
+        redis_stream,
+        123,
+        "owner",
+        "repo",
+        123,
+        "pull_request",
+        {"payload": "whatever"},
+    )
+    await asyncio.wait_for(waiter, timeout=1)
+    assert await s.next_stream() is None
+
+    # Only wait for the stream to be ready
+    started_at = time.monotonic()
+    await s.wait_for_stream(10)
+    assert time.monotonic() - started_at < 1
+    assert await s.next_stream() == "stream~owner~123"
+
+
+def test_hash_ring_minimal_reassignment():
+    keys = [f"stream~owner-{i}~{i}".encode() for i in range(2000)]
+    ring7 = worker.HashRing(7)
+    ring8 = worker.HashRing(8)
+
+    assert sum(ring8.get_layout().values()) == pytest.approx(1)
+    assert set(ring7.get_node(key) for key in keys) == set(range(7))
+
+    moved = [key for key in keys if ring7.get_node(key) != ring8.get_node(key)]
+    # Only the slice taken by the new node moves
+    assert {ring8.get_node(key) for key in moved} == {7}
+    assert len(moved) < len(keys) * 0.25
+
+
+@pytest.mark.asyncio
+async def test_stream_selector_moves_streams_of_other_shards(redis_stream, monkeypatch):
+    for installation_id in range(30):
+        await worker.push(
+            redis_stream,
+            installation_id,
+            f"owner-{installation_id}",
+            "repo",
+            123,
+            "pull_request",
+            {"payload": "whatever"},
+        )
+
+    old_shard_count = worker.get_shard_count()
+    monkeypatch.setattr(config, "STREAM_WORKERS_PER_PROCESS", old_shard_count + 1)
+    new_shard_count = worker.get_shard_count()
+
+    moved = {
+        f"stream~owner-{i}~{i}"
+        for i in range(30)
+        if worker.get_shard_for(f"stream~owner-{i}~{i}", old_shard_count)
+        != worker.get_shard_for(f"stream~owner-{i}~{i}", new_shard_count)
+    }
+    assert moved
+
+    await asyncio.sleep(0.02)
+    selected = set()
+    for worker_id in range(new_shard_count):
+        s = worker.StreamSelector(redis_stream, worker_id, new_shard_count)
+        while (stream_name := await s.next_stream()) is not None:
+            assert worker.get_shard_key_for(stream_name) == worker.get_shard_key(
+                worker_id
+            )
+            selected.add(stream_name)
+            await redis_stream.zrem(worker.get_shard_key(worker_id), stream_name)
+
+    assert moved <= selected
+    assert len(selected) == 30
+
+
+@pytest.mark.asyncio
+async def test_stream_selector_doesnt_move_back_streams(redis_stream, monkeypatch):
+    monkeypatch.setattr(config, "STREAM_WORKERS_PER_PROCESS", 10)
+    assert 0 == await worker.rebalance_orphan_shards(redis_stream)
+    stream_name = next(
+        f"stream~owner-{i}~{i}"
+        for i in range(100)
+        if worker.get_shard_for(f"stream~owner-{i}~{i}", 10) == 9
+    )
+    owner, owner_id = stream_name.split("~")[1:]
+    await worker.push(
+        redis_stream,
+        int(owner_id),
+        owner,
+        "repo",
+        123,
+        "pull_request",
+        {"payload": "whatever"},
+    )
+    await asyncio.sleep(0.02)
+
+    # The workers are scaled down, the monitoring moves the stream to its new
+    # shard
+    monkeypatch.setattr(config, "STREAM_WORKERS_PER_PROCESS", 9)
+    new_shard = worker.get_shard_for(stream_name, 9)
+    assert 1 == await worker.rebalance_orphan_shards(redis_stream)
+    assert b"9" == await redis_stream.get(worker.get_moved_key(stream_name))
+
+    # A worker still running with the old number of shards consumes it instead
+    # of moving it back to the orphan shard
+    monkeypatch.setattr(config, "STREAM_WORKERS_PER_PROCESS", 10)
+    s = worker.StreamSelector(redis_stream, new_shard, 10)
+    assert await s.next_stream() == stream_name
+    assert await redis_stream.zscore(worker.get_shard_key(new_shard), stream_name)
+    assert not await redis_stream.zcard(worker.get_shard_key(9))
+
+
+@pytest.mark.asyncio
+async def test_stream_selector_lease(redis_stream):
+    await worker.push(
+        redis_stream,
+        123,
+        "owner",
+        "repo",
+        123,
+        "pull_request",
+        {"payload": "whatever"},
+    )
+    shard_key = worker.get_shard_key_for("stream~owner~123")
+    score = await redis_stream.zscore(shard_key, "stream~owner~123")
+
+    s1 = worker.StreamSelector(redis_stream, 0, 1)
+    s2 = worker.StreamSelector(redis_stream, 0, 1)
+    async with s1.lease("stream~owner~123") as leased:
+        assert leased
+        assert await redis_stream.exists(worker.get_lease_key("stream~owner~123"))
+        async with s2.lease("stream~owner~123") as leased:
+            assert not leased
+        assert await redis_stream.zscore(shard_key, "stream~owner~123") > score
+
+    assert not await redis_stream.exists(worker.get_lease_key("stream~owner~123"))
+    async with s2.lease("stream~owner~123") as leased:
+        assert leased
+
+
+@pytest.mark.asyncio
+async def test_rebalance_orphan_shards(redis_stream, monkeypatch):
+    monkeypatch.setattr(config, "STREAM_WORKERS_PER_PROCESS", 10)
+    assert 0 == await worker.rebalance_orphan_shards(redis_stream)
+    for installation_id in range(30):
+        await worker.push(
+            redis_stream,
+            installation_id,
+            f"owner-{installation_id}",
+            "repo",
+            123,
+            "pull_request",
+            {"payload": "whatever"},
+        )
+    orphans = await redis_stream.zcard(worker.get_shard_key(9))
+    assert orphans > 0
+
+    monkeypatch.setattr(config, "STREAM_WORKERS_PER_PROCESS", 9)
+    assert orphans == await worker.rebalance_orphan_shards(redis_stream)
+    assert 0 == await redis_stream.zcard(worker.get_shard_key(9))
+    assert 30 == await get_streams_count(redis_stream)
+    for installation_id in range(30):
+        stream_name = f"stream~owner-{installation_id}~{installation_id}"
+        assert await redis_stream.zscore(
+            worker.get_shard_key_for(stream_name), stream_name
+        )
+
+    # The orphan shards are scanned until they stayed empty for the grace period
+    assert 0 == await worker.rebalance_orphan_shards(redis_stream)
+    assert b"10" == await redis_stream.get(worker.KNOWN_SHARD_COUNT_KEY)
+    assert await redis_stream.exists(worker.ORPHAN_SHARDS_DRAINED_KEY)
+
+    monkeypatch.setattr(worker, "ORPHAN_SHARDS_GRACE_PERIOD", 0)
+    assert 0 == await worker.rebalance_orphan_shards(redis_stream)
+    assert b"9" == await redis_stream.get(worker.KNOWN_SHARD_COUNT_KEY)
+    assert not await redis_stream.exists(worker.ORPHAN_SHARDS_DRAINED_KEY)
+
+    await redis_stream.zadd(worker.get_shard_key(9), **{"stream~late~1": 1})
+    assert 0 == await worker.rebalance_orphan_shards(redis_stream)
+    assert 1 == await redis_stream.zcard(worker.get_shard_key(9))
+
+
+@pytest.mark.asyncio
+@mock.patch("mergify_engine.worker.subscription.Subscription.get_subscription")
+@mock.patch("mergify_engine.worker.run_engine")
+async def test_stream_processor_concurrent_repositories(
+    run_engine, _, redis_stream, redis_cache, monkeypatch
+):
+    monkeypatch.setattr(config, "STREAM_MAX_CONCURRENT_REPOSITORIES", 3)
+
+    events = []
+    in_flight = 0
+    max_in_flight = 0
+
+    async def fake_engine(installation, repo, pull_number, sources):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        events.append(("start", repo, pull_number))
+        await asyncio.sleep(0.05)
+        events.append(("end", repo, pull_number))
+        in_flight -= 1
+
+    run_engine.side_effect = fake_engine
+
+    for repo, pull_number in (
+        ("repo-a", 1),
+        ("repo-b", 1),
+        ("repo-a", 2),
+        ("repo-c", 1),
+        ("repo-a", 3),
+        ("repo-d", 1),
+    ):
+        await worker.push(
+            redis_stream,
+            123,
+            "owner",
+            repo,
+            pull_number,
+            "pull_request",
+            {"payload": "whatever"},
+        )
+
+    p = worker.StreamProcessor(redis_stream, redis_cache)
+    await p.consume("stream~owner~123")
+
+    assert len(run_engine.mock_calls) == 6
+    assert max_in_flight == 3
+
+    # Pull requests of the same repository are processed one after the other
+    repo_a_events = [e for e in events if e[1] == "repo-a"]
+    assert repo_a_events == [
+        ("start", "repo-a", 1),
+        ("end", "repo-a", 1),
+        ("start", "repo-a", 2),
+        ("end", "repo-a", 2),
+        ("start", "repo-a", 3),
+        ("end", "repo-a", 3),
+    ]
+
+    assert 0 == (await get_streams_count(redis_stream))
+    assert 0 == len(await redis_stream.keys("stream~*"))
+    assert 0 == len(await redis_stream.hgetall("attempts"))
+
+
+@pytest.mark.asyncio
+@mock.patch("mergify_engine.worker.subscription.Subscription.get_subscription")
+@mock.patch("mergify_engine.worker.run_engine")
+async def test_stream_processor_concurrent_repositories_retrying_stream(
+    run_engine, _, redis_stream, redis_cache, monkeypatch
+):
+    monkeypatch.setattr(config, "STREAM_MAX_CONCURRENT_REPOSITORIES", 3)
+
+    response = mock.Mock()
+    response.json.return_value = {"message": "boom"}
+    response.status_code = 401
+
+    async def fake_engine(installation, repo, pull_number, sources):
+        if repo == "repo-a":
+            return
+        await asyncio.sleep(0.01)
+        raise http.HTTPClientSideError(
+            message="foobar", request=response.request, response=response
+        )
+
+    run_engine.side_effect = fake_engine
+
+    for repo in ("repo-a", "repo-b", "repo-c", "repo-d", "repo-e"):
+        await worker.push(
+            redis_stream,
+            123,
+            "owner",
+            repo,
+            123,
+            "pull_request",
+            {"payload": "whatever"},
+        )
+
+    p = worker.StreamProcessor(redis_stream, redis_cache)
+    await p.consume("stream~owner~123")
+
+    # repo-e is never started, the stream already failed
+    assert len(run_engine.mock_calls) == 4
+    assert 1 == (await get_streams_count(redis_stream))
+    assert 4 == await redis_stream.xlen("stream~owner~123")
+    assert {b"stream~owner~123": b"1"} == await redis_stream.hgetall("attempts")
+
+
+@pytest.mark.asyncio
+@mock.patch("mergify_engine.worker.subscription.Subscription.get_subscription")
+@mock.patch("mergify_engine.worker.run_engine")
+async def test_stream_processor_slice_budget(
+    run_engine, get_subscription, redis_stream, redis_cache, monkeypatch
+):
+    monkeypatch.setattr(worker, "STREAM_SLICE_QUANTUM", 0.5)
+    get_subscription.return_value.active = False
+
+    async def fake_engine(installation, repo, pull_number, sources):
+        await asyncio.sleep(0.3)
+
+    run_engine.side_effect = fake_engine
+
+    for pull_number in range(4):
+        await worker.push(
+            redis_stream,
+            123,
+            "owner",
+            "repo",
+            pull_number,
+            "pull_request",
+            {"payload": "whatever"},
+        )
+
+    p = worker.StreamProcessor(redis_stream, redis_cache)
+    await p.consume("stream~owner~123")
+
+    # Budget exhausted after the second pull request, the others are kept
+    assert [c.args[2] for c in run_engine.mock_calls] == [0, 1]
+    assert 1 == (await get_streams_count(redis_stream))
+    assert 2 == await redis_stream.xlen("stream~owner~123")
+    deficit = float(await redis_stream.hget("deficits", "stream~owner~123"))
+    assert -0.5 <= deficit < 0
+
+    # The debt is paid back, then the stream is consumed entirely
+    await redis_stream.hset("deficits", "stream~owner~123", -0.5)
+    await p.consume("stream~owner~123")
+    assert len(run_engine.mock_calls) == 2
+    assert 2 == await redis_stream.xlen("stream~owner~123")
+
+    await p.consume("stream~owner~123")
+    assert [c.args[2] for c in run_engine.mock_calls] == [0, 1, 2, 3]
+    assert 0 == (await get_streams_count(redis_stream))
+    assert 0 == len(await redis_stream.keys("stream~*"))
+    assert 0 == len(await redis_stream.hgetall("deficits"))
+
+
+@pytest.mark.asyncio
+async def test_stream_processor_slice_quantum(redis_stream, redis_cache):
+    free = mock.Mock(active=False)
+    paid = mock.Mock(active=True)
+    assert worker.StreamProcessor.get_slice_quantum(
+        paid
+    ) == worker.StreamProcessor.get_slice_quantum(free) * (
+        worker.STREAM_PAID_WEIGHT / worker.STREAM_FREE_WEIGHT
+    )
+
+
+@pytest.mark.asyncio
+async def test_push_many(redis_stream):
+    pipeline = redis_stream.pipeline
+    with mock.patch.object(redis_stream, "pipeline", side_effect=pipeline) as p:
+        messages = await worker.push_many(
+            redis_stream,
+            123,
+            "owner",
+            "repo",
+            [
+                (pull_number, "refresh", {"payload": pull_number})
+                for pull_number in range(1, 301)
+            ],
+        )
+    assert len(p.mock_calls) == 1
+
+    assert len(messages) == 300
+    assert 1 == (await get_streams_count(redis_stream))
+    assert 300 == await redis_stream.xlen("stream~owner~123")
+    stream = await redis_stream.xrange("stream~owner~123")
+    assert [message_id for message_id, _ in messages] == [
+        message_id for message_id, _ in stream
+    ]
+    assert [payload for _, payload in messages] == [payload for _, payload in stream]
+
+    assert [] == await worker.push_many(redis_stream, 123, "owner", "repo", [])
+
+
+@pytest.mark.asyncio
+@mock.patch("mergify_engine.worker.subscription.Subscription.get_subscription")
+@mock.patch("mergify_engine.worker.run_engine")
+async def test_push_coalesces_pull_request_events(
+    run_engine, _, redis_stream, redis_cache
+):
+    for data in range(5):
+        await worker.push(
+            redis_stream,
+            123,
+            "owner",
+            "repo",
+            123,
+            "status",
+            {"payload": data},
+        )
+    await worker.push(
+        redis_stream,
+        123,
+        "owner",
+        "repo",
+        456,
+        "status",
+        {"payload": "other"},
+    )
+
+    assert 2 == await redis_stream.xlen("stream~owner~123")
+
+    # Events received during the processing are kept for the next run
+    async def fake_engine(installation, repo, pull_number, sources):
+        if len(run_engine.mock_calls) == 1:
+            await worker.push(
+                redis_stream,
+                123,
+                "owner",
+                "repo",
+                123,
+                "status",
+                {"payload": "late"},
+            )
+
+    run_engine.side_effect = fake_engine
+
+    p = worker.StreamProcessor(redis_stream, redis_cache)
+    await p.consume("stream~owner~123")
+
+    assert len(run_engine.mock_calls) == 2
+    assert run_engine.mock_calls[0].args[2] == 123
+    assert [s["data"] for s in run_engine.mock_calls[0].args[3]] == [
+        {"payload": data} for data in range(5)
+    ]
+    assert run_engine.mock_calls[1].args[2] == 456
+    assert [s["data"] for s in run_engine.mock_calls[1].args[3]] == [
+        {"payload": "other"}
+    ]
+
+    assert 1 == await redis_stream.xlen("stream~owner~123")
+    assert 1 == (await get_streams_count(redis_stream))
+
+    await p.consume("stream~owner~123")
+    assert len(run_engine.mock_calls) == 3
+    assert [s["data"] for s in run_engine.mock_calls[2].args[3]] == [
+        {"payload": "late"}
+    ]
+
+    assert 0 == (await get_streams_count(redis_stream))
+    assert 0 == len(await redis_stream.keys("stream~*"))
+    assert 0 == len(await redis_stream.keys("pending~*"))
+
+
+@pytest.mark.asyncio
+@mock.patch("mergify_engine.worker.subscription.Subscription.get_subscription")
+@mock.patch("mergify_engine.worker.run_engine")
+async def test_push_bounded_pending_sources(
+    run_engine, _, redis_stream, redis_cache, monkeypatch
+):
+    monkeypatch.setattr(worker, "MAX_PENDING_SOURCES", 3)
+    for data in range(5):
+        await worker.push(
+            redis_stream,
+            123,
+            "owner",
+            "repo",
+            123,
+            "status",
+            {"payload": data},
+        )
+
+    assert 1 == await redis_stream.xlen("stream~owner~123")
+
+    p = worker.StreamProcessor(redis_stream, redis_cache)
+    await p.consume("stream~owner~123")
+
+    assert len(run_engine.mock_calls) == 1
+    assert [s["data"] for s in run_engine.mock_calls[0].args[3]] == [
+        {"payload": data} for data in (2, 3, 4)
+    ]
+    assert 0 == len(await redis_stream.keys("pending~*"))
+
+
+@pytest.mark.asyncio
+async def test_push_with_dropped_stream(redis_stream):
+    await worker.push(
+        redis_stream,
+        123,
+        "owner",
+        "repo",
+        123,
+        "status",
+        {"payload": "whatever"},
+    )
+    await redis_stream.delete("stream~owner~123")
+
+    # The marker is gone with the stream, a new one must be added
+    await worker.push(
+        redis_stream,
+        123,
+        "owner",
+        "repo",
+        123,
+        "status",
+        {"payload": "whatever"},
+    )
+    assert 1 == await redis_stream.xlen("stream~owner~123")
+
+
+def test_event_source_record():
+    record = worker.EventSource.pack_record(
+        "pull_request", "2021-06-01T00:00:00", {"payload": "whatever"}
+    )
+    source = worker.EventSource.from_record(record)
+    assert source.event_type == "pull_request"
+    assert source.timestamp == "2021-06-01T00:00:00"
+    # The body is not decoded until needed
+    assert "data" not in source.__dict__
+    assert source.body.obj is record
+    assert source.to_payload_source() == {
+        "event_type": "pull_request",
+        "data": {"payload": "whatever"},
+        "timestamp": "2021-06-01T00:00:00",
+    }
+
+
+@pytest.mark.asyncio
+@mock.patch("mergify_engine.worker.subscription.Subscription.get_subscription")
+@mock.patch("mergify_engine.worker.run_engine")
+async def test_stream_processor_legacy_messages(
+    run_engine, _, redis_stream, redis_cache
+):
+    await redis_stream.xadd(
+        "stream~owner~123",
+        {
+            b"event": msgpack.packb(
+                {
+                    "owner_id": 123,
+                    "owner": "owner",
+                    "repo": "repo",
+                    "pull_number": 123,
+                    "source": {
+                        "event_type": "pull_request",
+                        "data": {"payload": "legacy"},
+                        "timestamp": "2021-06-01T00:00:00",
+                    },
+                },
+                use_bin_type=True,
+            )
+        },
+    )
+    await worker.push(
+        redis_stream,
+        123,
+        "owner",
+        "repo",
+        123,
+        "pull_request",
+        {"payload": "whatever"},
+    )
+
+    p = worker.StreamProcessor(redis_stream, redis_cache)
+    await p.consume("stream~owner~123")
+
+    assert len(run_engine.mock_calls) == 1
+    assert [s["data"] for s in run_engine.mock_calls[0].args[3]] == [
+        {"payload": "legacy"},
+        {"payload": "whatever"},
+    ]
+    assert 0 == len(await redis_stream.keys("stream~*"))
@@ -74,6 +74,7 @@ async def shutdown() -> None:
     LOG.info("asgi: waiting redis pending tasks to complete")
     await utils.stop_pending_aredis_tasks()
     LOG.info("asgi: finished redis shutdown")
+    await http.shutdown_shared_connection_pool()
 
 
 @app.get("/installation")  # noqa: FS003
@@ -60,7 +60,7 @@ async def token(request: requests.Request) -> None:
                 options = http.DEFAULT_CLIENT_OPTIONS.copy()
                 options["headers"]["Authorization"] = authorization  # type: ignore
                 async with http.AsyncClient(
-                    base_url=config.GITHUB_API_URL, **options  # type: ignore
+                    base_url=config.GITHUB_API_URL, **options
                 ) as client:
                     await client.get("/user")
                     return
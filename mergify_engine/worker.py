@@ -14,6 +14,7 @@
 
 import argparse
 import asyncio
+import bisect
 import collections
 import contextlib
 import dataclasses
@@ -25,6 +26,7 @@ import os
 import signal
 import time
 import typing
+import uuid
 
 import aredis
 import daiquiri
@@ -43,6 +45,7 @@ from mergify_engine import subscription
 from mergify_engine import utils
 from mergify_engine.clients import github
 from mergify_engine.clients import http
+from mergify_engine.clients import profiler
 from mergify_engine.queue import merge_train
 
 
@@ -70,6 +73,135 @@ STREAM_ATTEMPTS_LOGGING_THRESHOLD: int = 20
 
 StreamNameType = typing.NewType("StreamNameType", str)
 
+# NOTE(sileht): legacy sorted set that used to contain all streams, it's now
+# only drained by the migration code
+LEGACY_STREAMS_KEY = "streams"
+
+
+# NOTE(sileht): biggest number of shards in use, shards above the current
+# number of shards are drained by the monitoring task. It's lowered once these
+# shards stayed empty for ORPHAN_SHARDS_GRACE_PERIOD seconds, the time for the
+# processes still using the old number of shards to be stopped.
+KNOWN_SHARD_COUNT_KEY = "streams-shard-count"
+ORPHAN_SHARDS_DRAINED_KEY = "streams-shard-count~drained"
+ORPHAN_SHARDS_GRACE_PERIOD: float = 600
+
+# NOTE(sileht): during a rolling deploy, workers with the old and the new
+# number of shards run together and disagree on the shard of some streams. A
+# moved stream is marked with the number of shards of the worker that moved
+# it, workers with another number of shards don't move it back.
+STREAM_MOVED_TTL: int = 60
+
+RING_VIRTUAL_NODES: int = 64
+STREAM_LEASE_TTL: int = 60
+STREAM_LEASE_RETRY_DELAY: float = 5
+
+# NOTE(sileht): Streams are consumed with a deficit round-robin, each time a stream
+# is selected it earns a time budget of STREAM_SLICE_QUANTUM * weight seconds,
+# when the budget is exhausted the remaining messages are kept for the next
+# slice. A slice that overruns its budget is paid back by the next one.
+STREAM_SLICE_QUANTUM: float = 15
+STREAM_FREE_WEIGHT: int = 1
+STREAM_PAID_WEIGHT: int = 4
+DEFICITS_KEY = "deficits"
+
+
+@dataclasses.dataclass
+class HashRing:
+    """Consistent hashing ring that maps a key to a node.
+
+    Each node is placed on the ring many times (virtual nodes) to spread the
+    keyspace evenly, when a node is added or removed only the keys of the
+    affected slices move.
+    """
+
+    nodes: int
+    virtual_nodes: int = RING_VIRTUAL_NODES
+
+    _points: typing.List[int] = dataclasses.field(init=False, default_factory=list)
+    _owners: typing.List[int] = dataclasses.field(init=False, default_factory=list)
+
+    def __post_init__(self) -> None:
+        points = sorted(
+            (self._hash(f"{node}~{vnode}".encode()), node)
+            for node in range(self.nodes)
+            for vnode in range(self.virtual_nodes)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key: bytes) -> int:
+        return int(hashlib.md5(key).hexdigest()[:16], 16)  # nosec
+
+    def get_node(self, key: bytes) -> int:
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[index]
+
+    def get_layout(self) -> typing.Dict[int, float]:
+        """Return the share of the ring owned by each node."""
+        ring_size = float(2 ** 64)
+        layout = {node: 0.0 for node in range(self.nodes)}
+        previous_point = self._points[-1] - 2 ** 64
+        for point, node in zip(self._points, self._owners):
+            layout[node] += (point - previous_point) / ring_size
+            previous_point = point
+        return layout
+
+
+@functools.lru_cache(maxsize=8)
+def get_ring(shard_count: int) -> HashRing:
+    return HashRing(shard_count)
+
+
+def get_shard_count() -> int:
+    return config.STREAM_PROCESSES * config.STREAM_WORKERS_PER_PROCESS
+
+
+def get_shard_for(stream_name: typing.Union[str, bytes], shard_count: int) -> int:
+    if isinstance(stream_name, str):
+        stream_name = stream_name.encode()
+    return get_ring(shard_count).get_node(stream_name)
+
+
+def get_shard_key(shard: int) -> str:
+    return f"streams~{shard}"
+
+
+def get_shard_keys() -> typing.List[str]:
+    return [get_shard_key(shard) for shard in range(get_shard_count())]
+
+
+def get_shard_key_for(stream_name: typing.Union[str, bytes]) -> str:
+    return get_shard_key(get_shard_for(stream_name, get_shard_count()))
+
+
+def get_wakeup_key(shard_key: str) -> str:
+    return f"{shard_key}~wakeup"
+
+
+def get_lease_key(stream_name: typing.Union[str, bytes]) -> str:
+    if isinstance(stream_name, bytes):
+        stream_name = stream_name.decode()
+    return f"lease~{stream_name}"
+
+
+def get_moved_key(stream_name: typing.Union[str, bytes]) -> str:
+    if isinstance(stream_name, bytes):
+        stream_name = stream_name.decode()
+    return f"stream-moved~{stream_name}"
+
+
+async def wakeup_shard(
+    redis: aredis.StrictRedis,
+    shard_key: str,
+) -> None:
+    # NOTE(sileht): idle workers are blocked with BLPOP on this list, one token
+    # is enough to wake them up, so we don't let the list grow
+    wakeup_key = get_wakeup_key(shard_key)
+    await redis.rpush(wakeup_key, b"1")
+    await redis.ltrim(wakeup_key, 0, 0)
+
 
 class IgnoredException(Exception):
     pass
@@ -106,12 +238,273 @@ class T_PayloadEvent(typing.TypedDict):
     source: context.T_PayloadEventSource
 
 
+# NOTE(sileht): Events are stored as a small header and a body containing the
+# event data. The header is enough to group events by pull request and to
+# compute metrics, the body is only decoded when the engine needs it.
+class T_EventHeader(typing.TypedDict, total=False):
+    owner_id: github_types.GitHubAccountIdType
+    owner: github_types.GitHubLogin
+    repo: github_types.GitHubRepositoryName
+    pull_number: typing.Optional[github_types.GitHubPullRequestNumber]
+    event_type: github_types.GitHubEventType
+    timestamp: str
+    pending: bool
+
+
+def pack_event_header(header: T_EventHeader) -> bytes:
+    return typing.cast(bytes, msgpack.packb(header, use_bin_type=True))
+
+
+def pack_event_body(data: github_types.GitHubEvent) -> bytes:
+    return typing.cast(bytes, msgpack.packb(data, use_bin_type=True))
+
+
+@dataclasses.dataclass
+class EventSource:
+    event_type: github_types.GitHubEventType
+    timestamp: typing.Optional[str]
+    body: memoryview
+
+    @functools.cached_property
+    def data(self) -> github_types.GitHubEvent:
+        return typing.cast(
+            github_types.GitHubEvent, msgpack.unpackb(self.body, raw=False)
+        )
+
+    def to_payload_source(self) -> context.T_PayloadEventSource:
+        source: typing.Dict[str, typing.Any] = {
+            "event_type": self.event_type,
+            "data": self.data,
+        }
+        if self.timestamp is not None:
+            source["timestamp"] = self.timestamp
+        return typing.cast(context.T_PayloadEventSource, source)
+
+    @classmethod
+    def from_payload_source(cls, source: context.T_PayloadEventSource) -> "EventSource":
+        return cls(
+            source["event_type"],
+            source.get("timestamp"),
+            memoryview(pack_event_body(source["data"])),
+        )
+
+    @staticmethod
+    def pack_record(
+        event_type: github_types.GitHubEventType,
+        timestamp: str,
+        data: github_types.GitHubEvent,
+    ) -> bytes:
+        return pack_event_header(
+            {"event_type": event_type, "timestamp": timestamp}
+        ) + pack_event_body(data)
+
+    @classmethod
+    def from_record(cls, record: bytes) -> "EventSource":
+        """Load a source packed with `pack_record`, the body is not decoded."""
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(record)
+        header: T_EventHeader = unpacker.unpack()
+        return cls(
+            header["event_type"],
+            header["timestamp"],
+            memoryview(record)[unpacker.tell() :],
+        )
+
+
+def unpack_message(
+    message: T_MessagePayload,
+) -> typing.Tuple[T_EventHeader, typing.Optional[EventSource]]:
+    """Return the header of a stream message and its source, if any."""
+    if b"header" in message:
+        header: T_EventHeader = msgpack.unpackb(message[b"header"], raw=False)
+        if header.get("pending"):
+            return header, None
+        return header, EventSource(
+            header["event_type"],
+            header["timestamp"],
+            memoryview(message[b"body"]),
+        )
+
+    # NOTE(sileht): messages pushed before the header/body split
+    data = msgpack.unpackb(message[b"event"], raw=False)
+    return (
+        typing.cast(T_EventHeader, data),
+        EventSource.from_payload_source(data["source"]),
+    )
+
+
+T_PushedEvent = typing.Tuple[
+    typing.Optional[github_types.GitHubPullRequestNumber],
+    github_types.GitHubEventType,
+    github_types.GitHubEvent,
+]
+
+
+# NOTE(sileht): Events of a pull request are not added one by one to the stream,
+# their sources are stored in a pending hash and only one marker per pull request
+# is added to the stream, so the stream size depends on the number of pull
+# requests and not on the number of events.
+#
+# The pending hash of a pull request contains:
+# * marker: the stream message id of the marker
+# * first/next: the range of sequence numbers of the stored sources
+# * <seq>: the sources packed with EventSource.pack_record
+MAX_PENDING_SOURCES: int = 100
+PENDING_SOURCES_TTL: int = 7 * 24 * 60 * 60
+
+
+def get_pending_key(
+    stream_name: StreamNameType,
+    repo: github_types.GitHubRepositoryName,
+    pull_number: github_types.GitHubPullRequestNumber,
+) -> str:
+    return f"pending~{stream_name}~{repo}~{pull_number}"
+
+
+def get_marker_payload(
+    owner_id: github_types.GitHubAccountIdType,
+    owner: github_types.GitHubLogin,
+    repo: github_types.GitHubRepositoryName,
+    pull_number: github_types.GitHubPullRequestNumber,
+) -> T_MessagePayload:
+    return T_MessagePayload(
+        {
+            b"header": pack_event_header(
+                {
+                    "owner_id": owner_id,
+                    "owner": owner,
+                    "repo": repo,
+                    "pull_number": pull_number,
+                    "pending": True,
+                }
+            ),
+        }
+    )
+
+
+# NOTE(sileht): The marker is checked in the stream too, as the stream may have
+# been dropped without cleaning the pending hash
+PUSH_PENDING_SOURCE_SCRIPT = """
+local stream_name = KEYS[1]
+local pending_key = KEYS[2]
+local source = ARGV[1]
+local marker = ARGV[2]
+local max_sources = tonumber(ARGV[3])
+local ttl = ARGV[4]
+
+local seq = redis.call("HINCRBY", pending_key, "next", 1) - 1
+redis.call("HSET", pending_key, seq, source)
+
+local first = tonumber(redis.call("HGET", pending_key, "first") or "0")
+local dropped = 0
+while seq - first >= max_sources do
+    redis.call("HDEL", pending_key, first)
+    first = first + 1
+    dropped = dropped + 1
+end
+redis.call("HSET", pending_key, "first", first)
+
+local coalesced = 1
+local message_id = redis.call("HGET", pending_key, "marker")
+if not message_id or #redis.call("XRANGE", stream_name, message_id, message_id) == 0 then
+    message_id = redis.call("XADD", stream_name, "*", "header", marker)
+    redis.call("HSET", pending_key, "marker", message_id)
+    coalesced = 0
+end
+redis.call("EXPIRE", pending_key, ttl)
+return {message_id, coalesced, dropped}
+"""
+
+
 @tenacity.retry(
     wait=tenacity.wait_exponential(multiplier=0.2),
     stop=tenacity.stop_after_attempt(5),
     retry=tenacity.retry_if_exception_type(aredis.ConnectionError),
     reraise=True,
 )
+async def push_many(
+    redis: utils.RedisStream,
+    owner_id: github_types.GitHubAccountIdType,
+    owner: github_types.GitHubLogin,
+    repo: github_types.GitHubRepositoryName,
+    events: typing.Sequence[T_PushedEvent],
+) -> typing.List[typing.Tuple[T_MessageID, T_MessagePayload]]:
+    """Push events of one repository to the worker in one round trip.
+
+    Events of a pull request are coalesced behind its stream marker, the
+    returned message is the marker.
+    """
+    if not events:
+        return []
+
+    stream_name = StreamNameType(f"stream~{owner}~{owner_id}")
+    shard_key = get_shard_key_for(stream_name)
+    scheduled_at = utils.utcnow() + datetime.timedelta(seconds=WORKER_PROCESSING_DELAY)
+    score = scheduled_at.timestamp()
+    timestamp = datetime.datetime.utcnow().isoformat()
+    transaction = await redis.pipeline()
+    payloads = []
+    for pull_number, event_type, data in events:
+        if pull_number is None:
+            # NOTE(sileht): Add this event to the stream, it will be unpacked
+            # into pull request events by the worker
+            payload = T_MessagePayload(
+                {
+                    b"header": pack_event_header(
+                        {
+                            "owner_id": owner_id,
+                            "owner": owner,
+                            "repo": repo,
+                            "pull_number": pull_number,
+                            "event_type": event_type,
+                            "timestamp": timestamp,
+                        }
+                    ),
+                    b"body": pack_event_body(data),
+                }
+            )
+            await transaction.xadd(stream_name, payload)
+        else:
+            payload = get_marker_payload(owner_id, owner, repo, pull_number)
+            await transaction.eval(
+                PUSH_PENDING_SOURCE_SCRIPT,
+                2,
+                stream_name,
+                get_pending_key(stream_name, repo, pull_number),
+                EventSource.pack_record(event_type, timestamp, data),
+                payload[b"header"],
+                MAX_PENDING_SOURCES,
+                PENDING_SOURCES_TTL,
+            )
+        payloads.append(payload)
+
+    # NOTE(sileht): Add pull request stream to process to the list of its shard,
+    # only if it does not exists, to not update the score(date)
+    await transaction.zaddoption(shard_key, "NX", **{stream_name: score})
+    await wakeup_shard(transaction, shard_key)
+    results = (await transaction.execute())[: len(payloads)]
+
+    messages = []
+    for (pull_number, event_type, _), payload, result in zip(events, payloads, results):
+        if pull_number is None:
+            message_id = result
+        else:
+            message_id, coalesced, dropped = result
+            if coalesced:
+                statsd.increment("engine.streams.events.coalesced")
+            if dropped:
+                statsd.increment("engine.streams.events.dropped", dropped)
+        messages.append((message_id, payload))
+        LOG.debug(
+            "pushed to worker",
+            gh_owner=owner,
+            gh_repo=repo,
+            gh_pull=pull_number,
+            event_type=event_type,
+        )
+    return messages
+
+
 async def push(
     redis: utils.RedisStream,
     owner_id: github_types.GitHubAccountIdType,
@@ -121,43 +514,123 @@ async def push(
     event_type: github_types.GitHubEventType,
     data: github_types.GitHubEvent,
 ) -> typing.Tuple[T_MessageID, T_MessagePayload]:
-    stream_name = f"stream~{owner}~{owner_id}"
-    scheduled_at = utils.utcnow() + datetime.timedelta(seconds=WORKER_PROCESSING_DELAY)
-    score = scheduled_at.timestamp()
-    transaction = await redis.pipeline()
-    # NOTE(sileht): Add this event to the pull request stream
-    payload = T_MessagePayload(
-        {
-            b"event": msgpack.packb(
-                {
-                    "owner_id": owner_id,
-                    "owner": owner,
-                    "repo": repo,
-                    "pull_number": pull_number,
-                    "source": {
-                        "event_type": event_type,
-                        "data": data,
-                        "timestamp": datetime.datetime.utcnow().isoformat(),
-                    },
-                },
-                use_bin_type=True,
-            ),
-        }
-    )
+    return (
+        await push_many(redis, owner_id, owner, repo, [(pull_number, event_type, data)])
+    )[0]
+
+
+# NOTE(sileht): Move streams from a sorted set to their shard, the score is kept
+# and a stream already present in its shard is not rescheduled
+ATOMIC_MOVE_STREAMS_SCRIPT = """
+local source_key = KEYS[1]
+local shard_count = ARGV[1]
+local moved_ttl = ARGV[2]
+
+for i = 3, #ARGV do
+    local stream_name = ARGV[i]
+    local shard_key = KEYS[(i - 3) * 3 + 2]
+    local wakeup_key = KEYS[(i - 3) * 3 + 3]
+    local moved_key = KEYS[(i - 3) * 3 + 4]
+    local score = redis.call("ZSCORE", source_key, stream_name)
+    if score then
+        redis.call("ZADD", shard_key, "NX", score, stream_name)
+        redis.call("ZREM", source_key, stream_name)
+        redis.call("RPUSH", wakeup_key, "1")
+        redis.call("LTRIM", wakeup_key, 0, 0)
+        redis.call("SET", moved_key, shard_count, "EX", moved_ttl)
+    end
+end
+"""
 
-    await transaction.xadd(stream_name, payload)
-    # NOTE(sileht): Add pull request stream to process to the list, only if it
-    # does not exists, to not update the score(date)
-    await transaction.zaddoption("streams", "NX", **{stream_name: score})
-    message_id: T_MessageID = (await transaction.execute())[0]
-    LOG.debug(
-        "pushed to worker",
-        gh_owner=owner,
-        gh_repo=repo,
-        gh_pull=pull_number,
-        event_type=event_type,
+
+async def move_streams_to_their_shard(
+    redis: utils.RedisStream,
+    source_key: str,
+    streams: typing.List[bytes],
+) -> None:
+    shard_keys = [get_shard_key_for(stream) for stream in streams]
+    await redis.eval(
+        ATOMIC_MOVE_STREAMS_SCRIPT,
+        len(streams) * 3 + 1,
+        source_key,
+        *itertools.chain.from_iterable(
+            (shard_key, get_wakeup_key(shard_key), get_moved_key(stream))
+            for shard_key, stream in zip(shard_keys, streams)
+        ),
+        get_shard_count(),
+        STREAM_MOVED_TTL,
+        *streams,
     )
-    return (message_id, payload)
+
+
+async def _drain_streams(
+    redis: utils.RedisStream, source_key: str, batch_size: int
+) -> int:
+    moved = 0
+    while True:
+        streams = await redis.zrange(source_key, 0, batch_size - 1)
+        if not streams:
+            break
+        await move_streams_to_their_shard(redis, source_key, streams)
+        moved += len(streams)
+    return moved
+
+
+async def migrate_legacy_streams(
+    redis: utils.RedisStream, batch_size: int = 100
+) -> int:
+    migrated = await _drain_streams(redis, LEGACY_STREAMS_KEY, batch_size)
+    if migrated:
+        LOG.info("legacy streams migrated to shards", count=migrated)
+    return migrated
+
+
+# NOTE(sileht): the number of shards is only lowered if no process raised it
+# in the meantime
+LOWER_KNOWN_SHARD_COUNT_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    redis.call("SET", KEYS[1], ARGV[2])
+end
+redis.call("DEL", KEYS[2])
+"""
+
+
+async def rebalance_orphan_shards(
+    redis: utils.RedisStream, batch_size: int = 100
+) -> int:
+    # NOTE(sileht): When the number of workers decreases, the shards of the
+    # removed workers are not owned by anyone anymore, their streams are moved
+    # to their new shard.
+    shard_count = get_shard_count()
+    known_shard_count = int(await redis.get(KNOWN_SHARD_COUNT_KEY) or 0)
+    if known_shard_count < shard_count:
+        await redis.set(KNOWN_SHARD_COUNT_KEY, shard_count)
+
+    moved = 0
+    for shard in range(shard_count, known_shard_count):
+        moved += await _drain_streams(redis, get_shard_key(shard), batch_size)
+
+    if moved:
+        LOG.info("orphan streams moved to their shard", count=moved)
+        await redis.delete(ORPHAN_SHARDS_DRAINED_KEY)
+    elif known_shard_count > shard_count:
+        await redis.set(ORPHAN_SHARDS_DRAINED_KEY, time.time(), nx=True)
+        drained_at = float(await redis.get(ORPHAN_SHARDS_DRAINED_KEY) or time.time())
+        if time.time() - drained_at >= ORPHAN_SHARDS_GRACE_PERIOD:
+            await redis.eval(
+                LOWER_KNOWN_SHARD_COUNT_SCRIPT,
+                2,
+                KNOWN_SHARD_COUNT_KEY,
+                ORPHAN_SHARDS_DRAINED_KEY,
+                known_shard_count,
+                shard_count,
+            )
+            LOG.info(
+                "orphan shards drained",
+                shard_count=shard_count,
+                known_shard_count=known_shard_count,
+            )
+    return moved
 
 
 async def run_engine(
@@ -194,12 +667,20 @@ PullsToConsume = typing.NewType(
             github_types.GitHubRepositoryName, github_types.GitHubPullRequestNumber
         ],
         typing.Tuple[
-            typing.List[T_MessageID], typing.List[context.T_PayloadEventSource]
+            typing.List[T_MessageID],
+            typing.List[EventSource],
+            typing.List["PendingMarker"],
         ],
     ],
 )
 
 
+class PendingMarker(typing.NamedTuple):
+    message_id: T_MessageID
+    # NOTE(sileht): sources with a lower sequence number have been read
+    upto: int
+
+
 @dataclasses.dataclass
 class StreamSelector:
     redis_stream: utils.RedisStream
@@ -207,25 +688,174 @@ class StreamSelector:
     worker_count: int
 
     def get_worker_id_for(self, stream: bytes) -> int:
-        return int(hashlib.md5(stream).hexdigest(), 16) % self.worker_count  # nosec
+        return get_shard_for(stream, get_shard_count()) % self.worker_count
 
-    def _is_stream_for_me(self, stream: bytes) -> bool:
-        return self.get_worker_id_for(stream) == self.worker_id
+    def get_shard_keys(self) -> typing.List[str]:
+        # NOTE(sileht): When the number of workers and shards are the same (the
+        # default), each worker owns exactly one shard.
+        return [
+            get_shard_key(shard)
+            for shard in range(get_shard_count())
+            if shard % self.worker_count == self.worker_id
+        ]
 
     async def next_stream(self) -> typing.Optional[StreamNameType]:
-        now = time.time()
-        for stream in await self.redis_stream.zrangebyscore(
-            "streams",
-            min=0,
-            max=now,
-        ):
-            if self._is_stream_for_me(stream):
-                statsd.increment(
-                    "engine.streams.selected", tags=[f"worker_id:{self.worker_id}"]
+        shard_keys = self.get_shard_keys()
+        if not shard_keys:
+            return None
+
+        while True:
+            now = time.time()
+            pipe = await self.redis_stream.pipeline()
+            for shard_key in shard_keys:
+                await pipe.zrangebyscore(
+                    shard_key, min=0, max=now, start=0, num=1, withscores=True
+                )
+            candidates: typing.List[typing.Tuple[float, bytes, str]] = [
+                (score, stream, shard_key)
+                for shard_key, streams in zip(shard_keys, await pipe.execute())
+                for stream, score in streams
+            ]
+            if not candidates:
+                return None
+
+            _, stream, shard_key = min(candidates)
+            if get_shard_key_for(stream) == shard_key:
+                break
+
+            # NOTE(sileht): a worker with another number of shards just moved
+            # it here, we consume it instead of moving it back, the lease
+            # prevents two workers from consuming it at the same time
+            moved_by = await self.redis_stream.get(get_moved_key(stream))
+            if moved_by is not None and int(moved_by) != get_shard_count():
+                break
+
+            # NOTE(sileht): The number of shards has changed, the stream is not
+            # owned by this shard anymore, move it to its new owner
+            LOG.info(
+                "moving stream to its new shard",
+                stream_name=stream,
+                shard_key=shard_key,
+                worker_id=self.worker_id,
+            )
+            await move_streams_to_their_shard(self.redis_stream, shard_key, [stream])
+            statsd.increment(
+                "engine.streams.rebalanced", tags=[f"worker_id:{self.worker_id}"]
+            )
+
+        statsd.increment(
+            "engine.streams.selected", tags=[f"worker_id:{self.worker_id}"]
+        )
+        return StreamNameType(stream.decode())
+
+    RENEW_LEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+    RELEASE_LEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+    @contextlib.asynccontextmanager
+    async def lease(self, stream_name: StreamNameType) -> typing.AsyncIterator[bool]:
+        """Take the ownership of a stream while it's consumed.
+
+        During a rolling deploy, the old and new workers may not agree on the
+        owner of a stream. The lease ensures only one of them consumes it, the
+        other one postpones the stream.
+        """
+        lease_key = get_lease_key(stream_name)
+        token = f"{self.worker_id}~{uuid.uuid4()}"
+        acquired = await self.redis_stream.set(
+            lease_key, token, px=STREAM_LEASE_TTL * 1000, nx=True
+        )
+        if not acquired:
+            LOG.info(
+                "stream is leased by another worker, postponing it",
+                stream_name=stream_name,
+                worker_id=self.worker_id,
+            )
+            retry_at = time.time() + STREAM_LEASE_RETRY_DELAY
+            await self.redis_stream.zaddoption(
+                get_shard_key_for(stream_name), "XX", **{stream_name: retry_at}
+            )
+            statsd.increment(
+                "engine.streams.lease_conflict", tags=[f"worker_id:{self.worker_id}"]
+            )
+            yield False
+            return
+
+        released = asyncio.Event()
+        renewer = asyncio.create_task(self._renew_lease(lease_key, token, released))
+        try:
+            yield True
+        finally:
+            released.set()
+            await renewer
+            try:
+                await self.redis_stream.eval(
+                    self.RELEASE_LEASE_SCRIPT, 1, lease_key, token
+                )
+            except aredis.exceptions.ConnectionError:
+                LOG.warning(
+                    "fail to release stream lease, it will expire",
+                    stream_name=stream_name,
                 )
-                return StreamNameType(stream.decode())
 
-        return None
+    async def _renew_lease(
+        self, lease_key: str, token: str, released: asyncio.Event
+    ) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(released.wait(), timeout=STREAM_LEASE_TTL / 3)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+            try:
+                await self.redis_stream.eval(
+                    self.RENEW_LEASE_SCRIPT,
+                    1,
+                    lease_key,
+                    token,
+                    STREAM_LEASE_TTL * 1000,
+                )
+            except aredis.exceptions.ConnectionError:
+                LOG.warning("fail to renew stream lease", lease_key=lease_key)
+
+    async def wait_for_stream(self, timeout: float) -> None:
+        """Block until a stream of our shards may be ready or timeout expires.
+
+        The worker wakes up when a stream is pushed to one of its shards or when
+        the earliest scheduled stream of its shards becomes due.
+        """
+        shard_keys = self.get_shard_keys()
+        if not shard_keys:
+            return
+
+        pipe = await self.redis_stream.pipeline()
+        for shard_key in shard_keys:
+            await pipe.zrange(shard_key, 0, 0, withscores=True)
+        scores = [score for streams in await pipe.execute() for _, score in streams]
+        if scores:
+            timeout = min(timeout, min(scores) - time.time())
+            if timeout <= 0:
+                return
+
+        # NOTE(sileht): Redis converts the BLPOP timeout to milliseconds by
+        # truncating it, anything that ends up to zero means forever. 1ms itself is
+        # not safe due to float rounding.
+        timeout = max(timeout, 0.002)
+        statsd.increment("engine.streams.idle", tags=[f"worker_id:{self.worker_id}"])
+        await self.redis_stream.blpop(
+            [get_wakeup_key(shard_key) for shard_key in shard_keys], timeout=timeout
+        )
 
 
 @dataclasses.dataclass
@@ -233,6 +863,19 @@ class StreamProcessor:
     redis_stream: utils.RedisStream
     redis_cache: utils.RedisCache
 
+    @staticmethod
+    def get_slice_quantum(sub: subscription.Subscription) -> float:
+        weight = STREAM_PAID_WEIGHT if sub.active else STREAM_FREE_WEIGHT
+        return STREAM_SLICE_QUANTUM * weight
+
+    async def _get_slice_budget(
+        self, stream_name: StreamNameType, quantum: float
+    ) -> float:
+        deficit = await self.redis_stream.hget(DEFICITS_KEY, stream_name)
+        if deficit is None:
+            return quantum
+        return float(deficit) + quantum
+
     @contextlib.asynccontextmanager
     async def _translate_exception_to_retries(
         self,
@@ -272,14 +915,16 @@ class StreamProcessor:
                 await self.redis_stream.hdel("attempts", stream_name)
                 raise IgnoredException()
 
-            if isinstance(e, exceptions.RateLimited):
+            # NOTE(sileht): GitHub is rate limiting us or is down, the stream is
+            # rescheduled without counting an attempt
+            if isinstance(e, (exceptions.RateLimited, http.CircuitOpen)):
                 retry_at = utils.utcnow() + e.countdown
                 score = retry_at.timestamp()
                 if attempts_key:
                     await self.redis_stream.hdel("attempts", attempts_key)
                 await self.redis_stream.hdel("attempts", stream_name)
                 await self.redis_stream.zaddoption(
-                    "streams", "XX", **{stream_name: score}
+                    get_shard_key_for(stream_name), "XX", **{stream_name: score}
                 )
                 raise StreamRetry(stream_name, 0, retry_at)
 
@@ -293,7 +938,9 @@ class StreamProcessor:
             retry_in = 3 ** min(attempts, 3) * backoff
             retry_at = utils.utcnow() + retry_in
             score = retry_at.timestamp()
-            await self.redis_stream.zaddoption("streams", "XX", **{stream_name: score})
+            await self.redis_stream.zaddoption(
+                get_shard_key_for(stream_name), "XX", **{stream_name: score}
+            )
             raise StreamRetry(stream_name, attempts, retry_at)
 
     def _extract_owner(
@@ -309,22 +956,40 @@ class StreamProcessor:
         owner_login, owner_id = self._extract_owner(stream_name)
         LOG.debug("consoming stream", gh_owner=owner_login)
 
+        started_at = time.monotonic()
+        quantum = STREAM_SLICE_QUANTUM
+        budget = quantum
         try:
             async with self._translate_exception_to_retries(stream_name):
                 sub = await subscription.Subscription.get_subscription(
                     self.redis_cache, owner_id
                 )
-            async with github.aget_client(owner_login) as client:
-                installation = context.Installation(
-                    owner_id, owner_login, sub, client, self.redis_cache
+                quantum = self.get_slice_quantum(sub)
+                budget = await self._get_slice_budget(stream_name, quantum)
+
+            if budget <= 0:
+                # NOTE(sileht): previous slices overran their budget, this one is
+                # skipped to pay it back
+                LOG.debug(
+                    "stream slice skipped", gh_owner=owner_login, slice_budget=budget
                 )
-                async with self._translate_exception_to_retries(stream_name):
-                    pulls = await self._extract_pulls_from_stream(installation)
-                if pulls:
-                    client.set_requests_ratio(len(pulls))
-                    await self._consume_pulls(installation, pulls)
+                statsd.increment("engine.streams.slice.skipped")
+            else:
+                async with github.aget_client(
+                    owner_login, redis_cache=self.redis_cache
+                ) as client:
+                    installation = context.Installation(
+                        owner_id, owner_login, sub, client, self.redis_cache
+                    )
+                    async with self._translate_exception_to_retries(stream_name):
+                        pulls = await self._extract_pulls_from_stream(installation)
+                    if pulls:
+                        client.set_requests_ratio(len(pulls))
+                        await self._consume_pulls(
+                            installation, pulls, started_at + budget
+                        )
 
-                await self._refresh_merge_trains(installation)
+                    await self._refresh_merge_trains(installation)
 
         except StreamUnused:
             LOG.info("unused stream, dropping it", gh_owner=owner_login, exc_info=True)
@@ -353,17 +1018,26 @@ class StreamProcessor:
                 stream_name, count=config.STREAM_MAX_BATCH
             )
             for message_id, message in messages:
-                LOG.info(msgpack.unpackb(message[b"event"], raw=False))
+                LOG.info(unpack_message(message)[0])
                 await self.redis_stream.execute_command("XDEL", stream_name, message_id)
 
         except Exception:
             # Ignore it, it will retried later
             LOG.error("failed to process stream", gh_owner=owner_login, exc_info=True)
 
+        # NOTE(sileht): the debt is capped to one quantum, so a slow pull request
+        # can't starve its installation for many rounds
+        deficit = max(budget - (time.monotonic() - started_at), -quantum)
+
         LOG.debug("cleanup stream start", stream_name=stream_name)
         try:
             await self.redis_stream.eval(
-                self.ATOMIC_CLEAN_STREAM_SCRIPT, 1, stream_name.encode(), time.time()
+                self.ATOMIC_CLEAN_STREAM_SCRIPT,
+                2,
+                stream_name.encode(),
+                get_shard_key_for(stream_name),
+                time.time(),
+                min(deficit, 0),
             )
         except aredis.exceptions.ConnectionError:
             LOG.warning(
@@ -376,24 +1050,29 @@ class StreamProcessor:
         async with self._translate_exception_to_retries(
             installation.stream_name,
         ):
-            async for train in merge_train.Train.iter_trains(installation):
-                await train.load()
-                await train.refresh()
+            with profiler.phase("merge_train"):
+                async for train in merge_train.Train.iter_trains(installation):
+                    await train.load()
+                    await train.refresh()
 
     # NOTE(sileht): If the stream still have messages, we update the score to reschedule the
     # pull later
     ATOMIC_CLEAN_STREAM_SCRIPT = """
 local stream_name = KEYS[1]
+local shard_key = KEYS[2]
 local score = ARGV[1]
+local deficit = ARGV[2]
 
 redis.call("HDEL", "attempts", stream_name)
 
 local len = tonumber(redis.call("XLEN", stream_name))
 if len == 0 then
-    redis.call("ZREM", "streams", stream_name)
+    redis.call("ZREM", shard_key, stream_name)
     redis.call("DEL", stream_name)
+    redis.call("HDEL", "deficits", stream_name)
 else
-    redis.call("ZADD", "streams", score, stream_name)
+    redis.call("ZADD", shard_key, score, stream_name)
+    redis.call("HSET", "deficits", stream_name, deficit)
 end
 """
 
@@ -413,21 +1092,41 @@ end
         statsd.histogram("engine.streams.size", len(messages))
         statsd.gauge("engine.streams.max_size", config.STREAM_MAX_BATCH)
 
-        # TODO(sileht): Put this cache in Repository context
-        opened_pulls_by_repo: typing.Dict[
-            github_types.GitHubRepositoryName,
-            typing.List[github_types.GitHubPullRequest],
-        ] = {}
-
         # Groups stream by pull request
         pulls: PullsToConsume = PullsToConsume(collections.OrderedDict())
+        markers: typing.Dict[
+            typing.Tuple[
+                github_types.GitHubRepositoryName,
+                github_types.GitHubPullRequestNumber,
+            ],
+            T_MessageID,
+        ] = {}
+        deferred: typing.Optional[exceptions.RateLimitBudgetExhausted] = None
+        deferred_message_ids: typing.List[T_MessageID] = []
         for message_id, message in messages:
-            data = msgpack.unpackb(message[b"event"], raw=False)
-            repo = github_types.GitHubRepositoryName(data["repo"])
-            source = typing.cast(context.T_PayloadEventSource, data["source"])
-            if data["pull_number"] is not None:
-                key = (repo, github_types.GitHubPullRequestNumber(data["pull_number"]))
-                group = pulls.setdefault(key, ([], []))
+            header, source = unpack_message(message)
+            repo = github_types.GitHubRepositoryName(header["repo"])
+            if source is None:
+                # NOTE(sileht): sources are read once all markers are known, the
+                # unpacked events may point to a marker we already saw
+                key = (
+                    repo,
+                    typing.cast(
+                        github_types.GitHubPullRequestNumber, header["pull_number"]
+                    ),
+                )
+                group = pulls.setdefault(key, ([], [], []))
+                if message_id not in group[0]:
+                    group[0].append(message_id)
+                    markers[key] = message_id
+                continue
+
+            if header["pull_number"] is not None:
+                key = (
+                    repo,
+                    github_types.GitHubPullRequestNumber(header["pull_number"]),
+                )
+                group = pulls.setdefault(key, ([], [], []))
                 group[0].append(message_id)
                 group[1].append(source)
             else:
@@ -435,27 +1134,30 @@ end
                     __name__,
                     gh_repo=repo,
                     gh_owner=installation.owner_login,
-                    source=source,
+                    event_type=source.event_type,
                 )
-                if repo not in opened_pulls_by_repo:
-                    try:
-                        opened_pulls_by_repo[repo] = [
-                            p
-                            async for p in installation.client.items(
-                                f"/repos/{installation.owner_login}/{repo}/pulls"
+                if source.event_type == "refresh":
+                    # NOTE(sileht): refreshing a whole repository or branch can
+                    # wait until the budget is back, the event is moved to the end
+                    # of the stream to not hold the events behind it
+                    if deferred is None:
+                        try:
+                            await installation.client.check_rate_limit_budget(
+                                low_priority=True
                             )
-                        ]
-                    except Exception as e:
-                        if exceptions.should_be_ignored(e):
-                            opened_pulls_by_repo[repo] = []
-                        else:
-                            raise
-
+                        except exceptions.RateLimitBudgetExhausted as e:
+                            deferred = e
+                    if deferred is not None:
+                        logger.info("refresh deferred, rate limit budget is low")
+                        statsd.increment("engine.streams.events.deferred")
+                        deferred_message_ids.append(
+                            await self._move_message_to_stream_end(
+                                installation.stream_name, message_id, message
+                            )
+                        )
+                        continue
                 converted_messages = await self._convert_event_to_messages(
-                    installation,
-                    repo,
-                    source,
-                    opened_pulls_by_repo[repo],
+                    installation, repo, source
                 )
 
                 logger.debug("event unpacked into %s messages", len(converted_messages))
@@ -480,14 +1182,64 @@ end
                             deleted,
                             contents,
                         )
+
+        if markers:
+            await self._read_pending_sources(installation, pulls, markers)
+
+        if deferred is not None and not pulls:
+            head = await self.redis_stream.xrange(installation.stream_name, count=1)
+            if head and head[0][0] in deferred_message_ids:
+                # NOTE(sileht): only deferred events are left, the stream is
+                # rescheduled when the budget is back
+                raise deferred
         return pulls
 
+    async def _move_message_to_stream_end(
+        self,
+        stream_name: StreamNameType,
+        message_id: T_MessageID,
+        message: T_MessagePayload,
+    ) -> T_MessageID:
+        transaction = await self.redis_stream.pipeline()
+        await transaction.xdel(stream_name, message_id)
+        await transaction.xadd(stream_name, message)
+        return typing.cast(T_MessageID, (await transaction.execute())[1])
+
+    async def _read_pending_sources(
+        self,
+        installation: context.Installation,
+        pulls: PullsToConsume,
+        markers: typing.Dict[
+            typing.Tuple[
+                github_types.GitHubRepositoryName,
+                github_types.GitHubPullRequestNumber,
+            ],
+            T_MessageID,
+        ],
+    ) -> None:
+        pipe = await self.redis_stream.pipeline()
+        for repo, pull_number in markers:
+            await pipe.hgetall(
+                get_pending_key(installation.stream_name, repo, pull_number)
+            )
+        pendings: typing.List[typing.Dict[bytes, bytes]] = await pipe.execute()
+
+        for (key, message_id), pending in zip(markers.items(), pendings):
+            first = int(pending.get(b"first", 0))
+            upto = int(pending.get(b"next", 0))
+            _, sources, pending_markers = pulls[key]
+            for seq in range(first, upto):
+                record = pending.get(str(seq).encode())
+                if record is not None:
+                    sources.append(EventSource.from_record(record))
+            if pending.get(b"marker") == typing.cast(bytes, message_id):
+                pending_markers.append(PendingMarker(message_id, upto))
+
     async def _convert_event_to_messages(
         self,
         installation: context.Installation,
         repo_name: github_types.GitHubRepositoryName,
-        source: context.T_PayloadEventSource,
-        pulls: typing.List[github_types.GitHubPullRequest],
+        source: EventSource,
     ) -> typing.List[typing.Tuple[T_MessageID, T_MessagePayload]]:
         # NOTE(sileht): the event is incomplete (push, refresh, checks, status)
         # So we get missing pull numbers, add them to the stream to
@@ -497,98 +1249,303 @@ end
         pull_numbers = await github_events.extract_pull_numbers_from_event(
             installation,
             repo_name,
-            source["event_type"],
-            source["data"],
-            pulls,
+            source.event_type,
+            source.data,
         )
 
-        messages = []
         for pull_number in pull_numbers:
             if pull_number is None:
                 # NOTE(sileht): even it looks not possible, this is a safeguard to ensure
                 # we didn't generate a ending loop of events, because when pull_number is
                 # None, this method got called again and again.
                 raise RuntimeError("Got an empty pull number")
-            messages.append(
-                await push(
-                    self.redis_stream,
-                    installation.owner_id,
-                    installation.owner_login,
-                    repo_name,
-                    pull_number,
-                    source["event_type"],
-                    source["data"],
-                )
-            )
-        return messages
+        return await push_many(
+            self.redis_stream,
+            installation.owner_id,
+            installation.owner_login,
+            repo_name,
+            [
+                (pull_number, source.event_type, source.data)
+                for pull_number in pull_numbers
+            ],
+        )
 
     async def _consume_pulls(
         self,
         installation: context.Installation,
         pulls: PullsToConsume,
+        deadline: float,
     ) -> None:
         LOG.debug(
             "stream contains %d pulls", len(pulls), stream_name=installation.stream_name
         )
-        for (repo, pull_number), (message_ids, sources) in pulls.items():
-
-            statsd.histogram("engine.streams.batch-size", len(sources))
-            for source in sources:
-                if "timestamp" in source:
-                    statsd.histogram(
-                        "engine.streams.events.latency",
-                        (
-                            datetime.datetime.utcnow()
-                            - datetime.datetime.fromisoformat(source["timestamp"])
-                        ).total_seconds(),
+
+        # NOTE(sileht): pull requests of the same repository share the queues and
+        # the merge trains, so they are always processed one after the other in
+        # the stream order. Only different repositories are processed concurrently.
+        pulls_by_repo: typing.Dict[
+            github_types.GitHubRepositoryName,
+            typing.List[
+                typing.Tuple[
+                    github_types.GitHubPullRequestNumber,
+                    typing.List[T_MessageID],
+                    typing.List[EventSource],
+                    typing.List[PendingMarker],
+                ]
+            ],
+        ] = collections.OrderedDict()
+        for (repo, pull_number), (
+            message_ids,
+            sources,
+            pending_markers,
+        ) in pulls.items():
+            pulls_by_repo.setdefault(repo, []).append(
+                (pull_number, message_ids, sources, pending_markers)
+            )
+
+        semaphore = asyncio.Semaphore(config.STREAM_MAX_CONCURRENT_REPOSITORIES)
+        stream_failure_lock = asyncio.Lock()
+        stream_failures: typing.List[Exception] = []
+        postponed_pulls: typing.List[github_types.GitHubPullRequestNumber] = []
+
+        async def _consume_repository_pulls(
+            repo: github_types.GitHubRepositoryName,
+            repo_pulls: typing.List[
+                typing.Tuple[
+                    github_types.GitHubPullRequestNumber,
+                    typing.List[T_MessageID],
+                    typing.List[EventSource],
+                    typing.List[PendingMarker],
+                ]
+            ],
+        ) -> None:
+            async with semaphore:
+                for i, (
+                    pull_number,
+                    message_ids,
+                    sources,
+                    pending_markers,
+                ) in enumerate(repo_pulls):
+                    if stream_failures:
+                        # NOTE(sileht): the stream will be retried or dropped, no
+                        # need to process more pull requests
+                        return
+                    if time.monotonic() >= deadline:
+                        # NOTE(sileht): the slice budget is exhausted, the messages
+                        # are kept in the stream for the next slice
+                        postponed_pulls.extend(p[0] for p in repo_pulls[i:])
+                        return
+                    await self._consume_pull(
+                        installation,
+                        repo,
+                        pull_number,
+                        message_ids,
+                        sources,
+                        pending_markers,
+                        stream_failure_lock,
+                        stream_failures,
                     )
 
-            logger = daiquiri.getLogger(
-                __name__,
-                gh_repo=repo,
-                gh_owner=installation.owner_login,
-                gh_pull=pull_number,
+        repositories = list(pulls_by_repo.items())
+        if not repositories:
+            return
+
+        # NOTE(sileht): The installation client authenticates itself lazily on its
+        # first request and its auth flow is not safe to run concurrently, so the
+        # first pull request is processed alone before starting the other ones.
+        first_repo, first_repo_pulls = repositories[0]
+        await _consume_repository_pulls(first_repo, first_repo_pulls[:1])
+        repositories[0] = (first_repo, first_repo_pulls[1:])
+
+        results = await asyncio.gather(
+            *(
+                _consume_repository_pulls(repo, repo_pulls)
+                for repo, repo_pulls in repositories
+                if repo_pulls
+            ),
+            return_exceptions=True,
+        )
+        if stream_failures:
+            raise stream_failures[0]
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+        if postponed_pulls:
+            LOG.debug(
+                "stream slice budget exhausted, %d pulls postponed",
+                len(postponed_pulls),
+                stream_name=installation.stream_name,
             )
+            statsd.increment("engine.streams.slice.exhausted")
 
-            attempts_key = f"pull~{installation.owner_login}~{repo}~{pull_number}"
-            try:
-                async with self._translate_exception_to_retries(
-                    installation.stream_name, attempts_key
-                ):
-                    await run_engine(installation, repo, pull_number, sources)
-                await self.redis_stream.hdel("attempts", attempts_key)
-                await self.redis_stream.execute_command(
-                    "XDEL", installation.stream_name, *message_ids
-                )
-            except IgnoredException:
-                await self.redis_stream.execute_command(
-                    "XDEL", installation.stream_name, *message_ids
-                )
-                logger.debug("failed to process pull request, ignoring", exc_info=True)
-            except MaxPullRetry as e:
-                await self.redis_stream.execute_command(
-                    "XDEL", installation.stream_name, *message_ids
-                )
-                logger.error(
-                    "failed to process pull request, abandoning",
-                    attempts=e.attempts,
-                    exc_info=True,
+    # NOTE(sileht): Drop the sources read with the marker, if new events have been
+    # received in the meantime a new marker is added to the stream
+    ACK_PENDING_MARKER_SCRIPT = """
+local stream_name = KEYS[1]
+local pending_key = KEYS[2]
+local marker_id = ARGV[1]
+local upto = tonumber(ARGV[2])
+local marker = ARGV[3]
+
+redis.call("XDEL", stream_name, marker_id)
+if redis.call("HGET", pending_key, "marker") ~= marker_id then
+    return
+end
+
+local first = tonumber(redis.call("HGET", pending_key, "first") or "0")
+local last = tonumber(redis.call("HGET", pending_key, "next") or "0")
+for seq = first, math.min(upto, last) - 1 do
+    redis.call("HDEL", pending_key, seq)
+end
+first = math.max(first, upto)
+if first >= last then
+    redis.call("DEL", pending_key)
+else
+    redis.call("HSET", pending_key, "first", first)
+    local message_id = redis.call("XADD", stream_name, "*", "header", marker)
+    redis.call("HSET", pending_key, "marker", message_id)
+end
+"""
+
+    async def _ack_messages(
+        self,
+        installation: context.Installation,
+        repo: github_types.GitHubRepositoryName,
+        pull_number: github_types.GitHubPullRequestNumber,
+        message_ids: typing.List[T_MessageID],
+        pending_markers: typing.List[PendingMarker],
+    ) -> None:
+        # NOTE(sileht): markers are deleted by the script, deleting them before
+        # would let an event pushed in the meantime add a new marker and keep
+        # the sources we have processed
+        marker_ids = {pending_marker.message_id for pending_marker in pending_markers}
+        message_ids = [
+            message_id for message_id in message_ids if message_id not in marker_ids
+        ]
+        if message_ids:
+            await self.redis_stream.execute_command(
+                "XDEL", installation.stream_name, *message_ids
+            )
+        for pending_marker in pending_markers:
+            await self.redis_stream.eval(
+                self.ACK_PENDING_MARKER_SCRIPT,
+                2,
+                installation.stream_name,
+                get_pending_key(installation.stream_name, repo, pull_number),
+                pending_marker.message_id,
+                pending_marker.upto,
+                get_marker_payload(
+                    installation.owner_id, installation.owner_login, repo, pull_number
+                )[b"header"],
+            )
+
+    async def _consume_pull(
+        self,
+        installation: context.Installation,
+        repo: github_types.GitHubRepositoryName,
+        pull_number: github_types.GitHubPullRequestNumber,
+        message_ids: typing.List[T_MessageID],
+        sources: typing.List[EventSource],
+        pending_markers: typing.List[PendingMarker],
+        stream_failure_lock: asyncio.Lock,
+        stream_failures: typing.List[Exception],
+    ) -> None:
+        statsd.histogram("engine.streams.batch-size", len(sources))
+        for source in sources:
+            if source.timestamp is not None:
+                latency = (
+                    datetime.datetime.utcnow()
+                    - datetime.datetime.fromisoformat(source.timestamp)
+                ).total_seconds()
+                statsd.histogram("engine.streams.events.latency", latency)
+                # NOTE(sileht): distributions are aggregated server side, so we
+                # get the percentiles of each weight class to check the fairness,
+                # tagging by owner would create one serie per installation
+                statsd.distribution(
+                    "engine.streams.installation.latency",
+                    latency,
+                    tags=[
+                        "subscription:paid"
+                        if installation.subscription.active
+                        else "subscription:free"
+                    ],
                 )
-            except PullRetry as e:
-                logger.info(
-                    "failed to process pull request, retrying",
-                    attempts=e.attempts,
-                    exc_info=True,
+
+        logger = daiquiri.getLogger(
+            __name__,
+            gh_repo=repo,
+            gh_owner=installation.owner_login,
+            gh_pull=pull_number,
+        )
+
+        attempts_key = f"pull~{installation.owner_login}~{repo}~{pull_number}"
+        try:
+            try:
+                await run_engine(
+                    installation,
+                    repo,
+                    pull_number,
+                    [source.to_payload_source() for source in sources],
                 )
-            except StreamRetry:
-                raise
-            except StreamUnused:
-                raise
-            except vcr_errors_CannotOverwriteExistingCassetteException:
-                raise
             except Exception:
-                # Ignore it, it will retried later
-                logger.error("failed to process pull request", exc_info=True)
+                # NOTE(sileht): pull requests of other repositories may fail at the
+                # same time for the same reason (eg: GitHub is down), the stream
+                # must be rescheduled and its attempts increased only once.
+                async with stream_failure_lock:
+                    if stream_failures:
+                        # NOTE(sileht): the messages are kept, they will be
+                        # replayed with the stream
+                        logger.debug(
+                            "failed to process pull request, postponed with the stream",
+                            exc_info=True,
+                        )
+                        return
+                    try:
+                        async with self._translate_exception_to_retries(
+                            installation.stream_name, attempts_key
+                        ):
+                            raise
+                    except (
+                        StreamRetry,
+                        StreamUnused,
+                        vcr_errors_CannotOverwriteExistingCassetteException,
+                    ) as e:
+                        stream_failures.append(e)
+                        raise
+            await self.redis_stream.hdel("attempts", attempts_key)
+            await self._ack_messages(
+                installation, repo, pull_number, message_ids, pending_markers
+            )
+        except IgnoredException:
+            await self._ack_messages(
+                installation, repo, pull_number, message_ids, pending_markers
+            )
+            logger.debug("failed to process pull request, ignoring", exc_info=True)
+        except MaxPullRetry as e:
+            await self._ack_messages(
+                installation, repo, pull_number, message_ids, pending_markers
+            )
+            logger.error(
+                "failed to process pull request, abandoning",
+                attempts=e.attempts,
+                exc_info=True,
+            )
+        except PullRetry as e:
+            logger.info(
+                "failed to process pull request, retrying",
+                attempts=e.attempts,
+                exc_info=True,
+            )
+        except StreamRetry:
+            raise
+        except StreamUnused:
+            raise
+        except vcr_errors_CannotOverwriteExistingCassetteException:
+            raise
+        except Exception:
+            # Ignore it, it will retried later
+            logger.error("failed to process pull request", exc_info=True)
 
 
 def get_process_index_from_env() -> int:
@@ -602,6 +1559,7 @@ def get_process_index_from_env() -> int:
 @dataclasses.dataclass
 class Worker:
     idle_sleep_time: float = 0.42
+    idle_max_block_time: float = 60
     shutdown_timeout: float = config.WORKER_SHUTDOWN_TIMEOUT
     worker_per_process: int = config.STREAM_WORKERS_PER_PROCESS
     process_count: int = config.STREAM_PROCESSES
@@ -653,19 +1611,28 @@ class Worker:
             try:
                 stream_name = await stream_selector.next_stream()
                 if stream_name:
-                    LOG.debug("worker %s take stream: %s", worker_id, stream_name)
-                    try:
-                        with statsd.timed("engine.stream.consume.time"):
-                            await stream_processor.consume(stream_name)
-                    finally:
-                        LOG.debug(
-                            "worker %s release stream: %s",
-                            worker_id,
-                            stream_name,
-                        )
+                    async with stream_selector.lease(stream_name) as leased:
+                        if not leased:
+                            continue
+                        LOG.debug("worker %s take stream: %s", worker_id, stream_name)
+                        try:
+                            with statsd.timed("engine.stream.consume.time"):
+                                await stream_processor.consume(stream_name)
+                        finally:
+                            LOG.debug(
+                                "worker %s release stream: %s",
+                                worker_id,
+                                stream_name,
+                            )
                 else:
-                    LOG.debug("worker %s has nothing to do, sleeping a bit", worker_id)
-                    await self._sleep_or_stop()
+                    LOG.debug(
+                        "worker %s has nothing to do, waiting for work", worker_id
+                    )
+                    if stream_selector.get_shard_keys():
+                        await stream_selector.wait_for_stream(self.idle_max_block_time)
+                    else:
+                        # NOTE(sileht): more workers than shards, this one is useless
+                        await self._sleep_or_stop(self.idle_max_block_time)
             except asyncio.CancelledError:
                 LOG.debug("worker %s killed", worker_id)
                 return
@@ -692,22 +1659,33 @@ class Worker:
 
         while not self._stopping.is_set():
             try:
+                await migrate_legacy_streams(self._redis_stream)
+                await rebalance_orphan_shards(self._redis_stream)
+
                 now = time.time()
-                streams = await self._redis_stream.zrangebyscore(
-                    "streams",
-                    min=0,
-                    max=now,
-                    withscores=True,
-                )
-                # NOTE(sileht): The latency may not be exact with the next StreamSelector
-                # based on hash+modulo
-                if len(streams) > self.worker_count:
-                    latency = now - streams[self.worker_count][1]
+                shard_keys = get_shard_keys()
+                pipe = await self._redis_stream.pipeline()
+                for shard_key in shard_keys:
+                    await pipe.zcount(shard_key, min=0, max=now)
+                    # NOTE(sileht): the first stream of a shard is the one being
+                    # processed, the second one is the one that waits
+                    await pipe.zrangebyscore(
+                        shard_key, min=0, max=now, start=1, num=1, withscores=True
+                    )
+                results = await pipe.execute()
+
+                backlog = sum(results[::2])
+                waiting_scores = [
+                    score for streams in results[1::2] for _, score in streams
+                ]
+                if waiting_scores:
+                    latency = now - min(waiting_scores)
                     statsd.timing("engine.streams.latency", latency)
                 else:
                     statsd.timing("engine.streams.latency", 0)
 
-                statsd.gauge("engine.streams.backlog", len(streams))
+                statsd.gauge("engine.streams.backlog", backlog)
+                statsd.gauge("engine.streams.shards.count", len(shard_keys))
                 statsd.gauge("engine.workers.count", self.worker_count)
                 statsd.gauge("engine.processes.count", self.process_count)
                 statsd.gauge(
@@ -762,6 +1740,7 @@ class Worker:
         tasks = []
         if "stream" in self.enabled_services:
             tasks.extend(self._worker_tasks)
+            await self._wakeup_idle_workers()
         if "stream-monitoring" in self.enabled_services:
             tasks.append(self._stream_monitoring_task)
 
@@ -789,9 +1768,26 @@ class Worker:
         await utils.stop_pending_aredis_tasks()
         LOG.info("redis finalized")
 
+        await http.shutdown_shared_connection_pool()
+
         self._tombstone.set()
         LOG.info("shutdown finished")
 
+    async def _wakeup_idle_workers(self) -> None:
+        if self._redis_stream is None:
+            return
+
+        try:
+            pipe = await self._redis_stream.pipeline()
+            for worker_id in self.get_worker_ids():
+                for shard_key in StreamSelector(
+                    self._redis_stream, worker_id, self.worker_count
+                ).get_shard_keys():
+                    await wakeup_shard(pipe, shard_key)
+            await pipe.execute()
+        except aredis.exceptions.ConnectionError:
+            LOG.warning("fail to wake up idle workers", exc_info=True)
+
     def start(self):
         self._start_task = asyncio.create_task(self._run())
 
@@ -839,21 +1835,40 @@ async def async_status() -> None:
     redis_stream = await utils.create_aredis_for_stream()
     stream_selector = StreamSelector(redis_stream, 0, worker_count)
 
+    ring = get_ring(get_shard_count())
+    print(f"Ring: {ring.nodes} shards, {ring.virtual_nodes} virtual nodes per shard")
+    for shard, share in sorted(ring.get_layout().items()):
+        shard_key = get_shard_key(shard)
+        streams_count = await redis_stream.zcard(shard_key)
+        print(
+            f"{{{shard % worker_count:02}}} {shard_key}: "
+            f"{share:.1%} of the ring, {streams_count} streams"
+        )
+
     def sorter(item):
         stream, score = item
         return stream_selector.get_worker_id_for(stream)
 
-    streams = sorted(
-        await redis_stream.zrangebyscore("streams", min=0, max="+inf", withscores=True),
-        key=sorter,
-    )
+    streams = []
+    for shard_key in get_shard_keys():
+        streams.extend(
+            await redis_stream.zrangebyscore(
+                shard_key, min=0, max="+inf", withscores=True
+            )
+        )
+    streams = sorted(streams, key=sorter)
 
     for worker_id, streams_by_worker in itertools.groupby(streams, key=sorter):
         for stream, score in streams_by_worker:
             owner = stream.split(b"~")[1]
             date = datetime.datetime.utcfromtimestamp(score).isoformat(" ", "seconds")
             items = await redis_stream.xlen(stream)
-            print(f"{{{worker_id:02}}} [{date}] {owner.decode()}: {items} events")
+            leased = (
+                " (leased)" if await redis_stream.exists(get_lease_key(stream)) else ""
+            )
+            print(
+                f"{{{worker_id:02}}} [{date}] {owner.decode()}: {items} events{leased}"
+            )
 
 
 def status() -> None:
@@ -866,22 +1881,25 @@ async def async_reschedule_now() -> int:
     args = parser.parse_args()
 
     redis = await utils.create_aredis_for_stream()
-    streams = await redis.zrangebyscore("streams", min=0, max="+inf")
     expected_stream = f"stream~{args.org.lower()}~"
-    for stream in streams:
-        if stream.decode().lower().startswith(expected_stream):
-            scheduled_at = utils.utcnow()
-            score = scheduled_at.timestamp()
-            transaction = await redis.pipeline()
-            await transaction.hdel("attempts", stream)
-            await transaction.zadd("streams", **{stream.decode(): score})
-            # NOTE(sileht): Do we need to cleanup the per PR attempt?
-            # await transaction.hdel("attempts", attempts_key)
-            await transaction.execute()
-            return 0
-    else:
-        print(f"Stream for {args.org} not found")
-        return 1
+    for shard_key in get_shard_keys():
+        streams = await redis.zrangebyscore(shard_key, min=0, max="+inf")
+        for stream in streams:
+            if stream.decode().lower().startswith(expected_stream):
+                scheduled_at = utils.utcnow()
+                score = scheduled_at.timestamp()
+                transaction = await redis.pipeline()
+                await transaction.hdel("attempts", stream)
+                await transaction.hdel(DEFICITS_KEY, stream)
+                await transaction.zadd(shard_key, **{stream.decode(): score})
+                await wakeup_shard(transaction, shard_key)
+                # NOTE(sileht): Do we need to cleanup the per PR attempt?
+                # await transaction.hdel("attempts", attempts_key)
+                await transaction.execute()
+                return 0
+
+    print(f"Stream for {args.org} not found")
+    return 1
 
 
 def reschedule_now() -> int: